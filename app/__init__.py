@@ -1,3 +1,5 @@
+import time
+
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -9,21 +11,36 @@ from jose import JWTError, jwt
 from sqlalchemy.orm import Session
 from . import database, models
 from .config import get_settings
+from .sharedcache import shared_or_local
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 3600
 
-models.Base.metadata.create_all(bind=database.engine)
-
-def get_db():
+async def get_db():
     session: Session = database.SessionLocal()
     try:
         yield session
     finally:
-        session.close()
+        await database.run_db(session.close)
+
+async def get_async_db(session: Session = Depends(get_db))-> database.AsyncSession:
+    """The request's session, for handlers that await their queries"""
+    return database.AsyncSession(session)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
+# token -> (jwt claims, detached User without its request count)
+# tagged with the user's public id, shared with the other workers when there are several
+auth_cache = shared_or_local("auth", get_settings().AUTH_CACHE_SIZE, get_settings().AUTH_CACHE_TTL,
+                             tag=lambda entry: entry[1].public_id)
+
+async def invalidate_user(public_id: str):
+    """
+    Drops every cached login of a user in every worker, call it after committing changes to them.
+    The drop can wait on the other workers' writes, so it runs on the database threads.
+    """
+    await database.run_db(auth_cache.discard_tagged, public_id)
+
 
 def create_access_token(data: dict, 
                         expires_delta: Optional[timedelta] = None,
@@ -40,8 +57,8 @@ def create_access_token(data: dict,
 
     return encoded_jwt
 
-def login(form):
-    user: models.User = models.User.authenticate(form.username, form.password)
+async def login(form):
+    user: models.User = await models.User.authenticate(form.username, form.password)
     
     if not user:
         raise HTTPException(
@@ -68,18 +85,39 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    try:
-        payload = jwt.decode(token, config.SECRET_KEY, algorithms=[ALGORITHM])
-        public_id: str = payload.get("sub")
-        
-        if public_id is None:
+    entry = auth_cache.get(token)
+    if entry is None:
+        try:
+            payload = jwt.decode(token, config.SECRET_KEY, algorithms=[ALGORITHM])
+            public_id: str = payload.get("sub")
+            
+            if public_id is None:
+                raise credentials_exception
+            
+        except JWTError:
             raise credentials_exception
         
-    except JWTError:
-        raise credentials_exception
-    
-    user: models.User = session.query(models.User).filter(models.User.public_id.ilike(public_id)).one_or_none()
-    if user is None:
-        raise credentials_exception
+        def load_snapshot()-> Optional[models.User]:
+            snapshot: models.User = (session.query(models.User)
+                                            .filter(models.User.public_id == public_id)
+                                            .one_or_none()
+                                    )
+            if snapshot is not None:
+                # expired rather than deferred, a deferred column doesn't survive pickling for other workers
+                session.expire(snapshot, ["requests_made"])
+                session.expunge(snapshot)
+            return snapshot
+
+        snapshot = await database.run_db(load_snapshot)
+        if snapshot is None:
+            raise credentials_exception
+
+        auth_cache.set(token, (payload, snapshot), ttl=payload["exp"] - time.time())
+    else:
+        payload, snapshot = entry
+
+    # a copy attached to this session without touching the database,
+    # requests_made loads lazily if a handler reads it
+    user: models.User = session.merge(snapshot, load=False)
     
     return user
\ No newline at end of file
@@ -0,0 +1,138 @@
+import time
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    A thread safe LRU cache whose entries also expire `ttl` seconds after they're set.
+    Once it holds `maxsize` entries, setting a new one evicts the least recently used.
+    With `weigh`, the least recently used are also evicted while the summed weights are over `maxweight`.
+    With `tag`, entries can be dropped together by what it returns for their values, see `discard_tagged`.
+    """
+
+    def __init__(self,
+                 maxsize: int,
+                 ttl: float,
+                 maxweight: Optional[int] = None,
+                 weigh: Optional[Callable[[Any], int]] = None,
+                 tag: Optional[Callable[[Any], str]] = None,
+                 ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.tag = tag
+        self.weight = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Any]:
+        """The values found for `keys`, by key, missing and expired keys are left out"""
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None or entry[0] <= now:
+                    if entry is not None:
+                        self._remove(key)
+                    self.misses += 1
+                    continue
+
+                self._data.move_to_end(key)
+                self.hits += 1
+                found[key] = entry[1]
+
+        return found
+
+    def set_many(self, items: Iterable[Tuple[Hashable, Any]], ttl: Optional[float] = None):
+        for key, value in items:
+            self.set(key, value, ttl)
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        weight = self.weigh(value) if self.weigh else 0
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+            self._data[key] = (time.monotonic() + ttl, value, weight)
+            self.weight += weight
+
+            while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        entry = self._data.pop(key)
+        self.weight -= entry[2]
+        return entry
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._remove(key) if key in self._data else None
+
+        return default if entry is None else entry[1]
+
+    def discard_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        with self._lock:
+            keys = [key for key, (_, value, _) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                self._remove(key)
+
+        return len(keys)
+
+    def discard_tagged(self, tag: str) -> int:
+        return self.discard_where(lambda key, value: self.tag(value) == tag)
+
+    def values(self) -> list:
+        """Values that haven't expired, least recently used first, without counting as lookups"""
+        now = time.monotonic()
+        with self._lock:
+            return [value for expires, value, _ in self._data.values() if expires > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self._data),
+                "maxsize": self.maxsize,
+                "weight": self.weight,
+                "maxweight": self.maxweight,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                }
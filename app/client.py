@@ -0,0 +1,185 @@
+import asyncio
+import time
+
+from typing import Dict, List, Optional, Sequence
+from urllib.parse import urlsplit
+
+import httpx
+
+from fastapi import HTTPException
+from oauthlib.oauth1 import Client as OAuth1Client
+
+from .config import Settings, get_settings
+from .metrics import family, twitter_request_duration, twitter_requests_in_flight
+from .ratelimits import RateLimiter
+from .singleflight import SingleFlight
+
+# most ids or screen names statuses/lookup and users/lookup take per call
+LOOKUP_LIMIT = 100
+
+
+def chunked(items: Sequence, size: int = LOOKUP_LIMIT) -> List[Sequence]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class OAuth1Auth(httpx.Auth):
+    """
+    OAuth1 request signing for httpx.
+    Takes the same keys as requests_oauthlib.OAuth1 so it can be swapped in where that was used.
+    """
+
+    def __init__(self,
+                 client_key: str,
+                 client_secret: str,
+                 resource_owner_key: Optional[str] = None,
+                 resource_owner_secret: Optional[str] = None,
+                 callback_uri: Optional[str] = None,
+                 verifier: Optional[str] = None,
+                 ):
+        self.client = OAuth1Client(client_key,
+                                   client_secret=client_secret,
+                                   resource_owner_key=resource_owner_key,
+                                   resource_owner_secret=resource_owner_secret,
+                                   callback_uri=callback_uri,
+                                   verifier=verifier,
+                                   )
+
+    def auth_flow(self, request: httpx.Request):
+        body = None
+        headers = {}
+        content_type = request.headers.get("Content-Type", "")
+
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            body = request.read().decode()
+            headers["Content-Type"] = content_type
+
+        _, signed_headers, _ = self.client.sign(str(request.url), request.method, body=body, headers=headers)
+        request.headers["Authorization"] = signed_headers["Authorization"]
+
+        yield request
+
+    @property
+    def identity(self) -> tuple:
+        return (self.client.client_key, self.client.resource_owner_key)
+
+
+class TwitterClient:
+    """
+    One pooled, keep-alive HTTP client shared by every request to Twitter.
+    Connections to a single host are also capped at HTTP_PER_HOST_LIMIT.
+
+    Identical GETs in flight at the same time share one upstream call.
+    GETs are identical when they have the same url, the same params (ignoring None and order) and,
+    unless `shared=True`, are signed for the same Twitter user.
+    Only pass `shared=True` when the caller strips everything in the response that depends on who asked,
+    the shared call is signed by whichever user asked first.
+    Only its successful responses are shared: when Twitter answers it with an error, or the rate limit of the
+    user who signed it refuses it, everyone else waiting on it makes the call again with their own token.
+
+    Signed calls to the rate limited endpoints are checked against the user's remaining budget first,
+    see RateLimiter.
+    """
+
+    def __init__(self, config: Settings):
+        limits = httpx.Limits(max_connections=config.HTTP_POOL_SIZE,
+                              max_keepalive_connections=config.HTTP_KEEPALIVE_SIZE,
+                              )
+        self.http = httpx.AsyncClient(base_url=config.TWITTER_API_URL,
+                                      limits=limits,
+                                      timeout=config.HTTP_TIMEOUT,
+                                      )
+        self.host = urlsplit(config.TWITTER_API_URL).netloc
+        self.per_host_limit = config.HTTP_PER_HOST_LIMIT
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self.flights = SingleFlight()
+        self.limits = RateLimiter(config.RATE_LIMIT_MAX_WAIT)
+
+    def _slot(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc or self.host
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.per_host_limit)
+
+        return self._host_slots[host]
+
+    async def request(self, method: str, url: str, *, params: Optional[dict] = None,
+                      auth: Optional[OAuth1Auth] = None, **kwargs) -> httpx.Response:
+        # requests drops None params, httpx would send them as empty strings
+        if params:
+            params = {key: value for key, value in params.items() if value is not None}
+
+        family = self.limits.family(url)
+        identity = auth.identity if family and isinstance(auth, OAuth1Auth) else None
+        if identity:
+            await self.limits.acquire(identity, family)
+
+        async with self._slot(url):
+            r = await self._timed(method, url, params=params, auth=auth, **kwargs)
+
+        if identity:
+            self.limits.update(identity, family, r.status_code, r.headers)
+
+        return r
+
+    async def _timed(self, method: str, url: str, **kwargs) -> httpx.Response:
+        name = family(url)
+        status = "error"
+        twitter_requests_in_flight.inc(name)
+        start = time.perf_counter()
+        try:
+            r = await self.http.request(method, url, **kwargs)
+            status = str(r.status_code)
+            return r
+        finally:
+            twitter_requests_in_flight.dec(name)
+            twitter_request_duration.observe(time.perf_counter() - start, name, method, status)
+
+    async def get(self, url: str, *, params: Optional[dict] = None, auth: Optional[OAuth1Auth] = None,
+                  shared: bool = False, **kwargs) -> httpx.Response:
+        query = tuple(sorted((key, str(value)) for key, value in (params or {}).items() if value is not None))
+        if not shared or auth is None:
+            key = (url, query, None if auth is None else auth.identity)
+            return await self.flights.do(key, lambda: self.request("GET", url, params=params, auth=auth, **kwargs))
+
+        led = []
+
+        def lead():
+            led.append(True)
+            return self.request("GET", url, params=params, auth=auth, **kwargs)
+
+        try:
+            r = await self.flights.do((url, query, None), lead)
+        except HTTPException:
+            # another user's rate limit refused the shared call
+            if led:
+                raise
+        else:
+            if led or not r.is_error:
+                return r
+
+        # errors are about whoever signed the call, like a revoked token, so try again as ourselves
+        return await self.get(url, params=params, auth=auth, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+twitter_client: Optional[TwitterClient] = None
+
+
+async def open_twitter_client():
+    global twitter_client
+    twitter_client = TwitterClient(get_settings())
+
+
+async def close_twitter_client():
+    global twitter_client
+    if twitter_client is not None:
+        await twitter_client.aclose()
+        twitter_client = None
+
+
+def get_twitter_client() -> TwitterClient:
+    return twitter_client
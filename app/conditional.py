@@ -0,0 +1,98 @@
+"""
+ETags, 304s and gzip for the JSON that clients poll (get-tweets, get-users, home-timeline).
+
+The ETag is a hash of the encoded body, so it's strong: the same tag always means the same bytes.
+A gzipped body is another representation of it and gets its own tag, ending in -gzip, so the tag a client
+sends back says which one it has. A matching If-None-Match gets a 304 with an empty body.
+Bodies of at least GZIP_MIN_SIZE bytes are gzipped for clients that accept it, compressed bodies are kept
+by tag so polling data that hasn't changed doesn't compress it again.
+"""
+import gzip
+import hashlib
+
+from fastapi import Request, Response
+from typing import Optional
+
+from .cache import TTLCache
+from .config import get_settings
+
+# clients are logged in, so only their own cache may keep a copy and it has to check back every time
+CACHE_CONTROL = "private, no-cache"
+
+
+def etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """Whether Accept-Encoding allows gzip, `gzip;q=0` refuses it"""
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        q = params.strip().lower()
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+
+    return False
+
+
+def none_match(if_none_match: Optional[str], tag: str) -> bool:
+    """Whether If-None-Match has `tag`, compared weakly like RFC 7232 says to"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+
+    return False
+
+
+_compressed: Optional[TTLCache] = None
+
+
+def get_compressed() -> TTLCache:
+    """Gzipped bodies by their tag, the least recently used go once they add up to GZIP_CACHE_BYTES"""
+    global _compressed
+    if _compressed is None:
+        config = get_settings()
+        _compressed = TTLCache(config.GZIP_CACHE_SIZE, config.GZIP_CACHE_TTL,
+                               maxweight=config.GZIP_CACHE_BYTES, weigh=len)
+
+    return _compressed
+
+
+def conditional_response(request: Request, body: bytes, media_type: str = "application/json") -> Response:
+    """`body` as a 200, or a 304 when the client already has it, gzipped when it's big enough and the client can take it"""
+    config = get_settings()
+    tag = etag(body)
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": CACHE_CONTROL}
+
+    compress = len(body) >= config.GZIP_MIN_SIZE and accepts_gzip(request.headers.get("accept-encoding"))
+    if compress:
+        tag = tag[:-1] + '-gzip"'
+    headers["ETag"] = tag
+
+    if none_match(request.headers.get("if-none-match"), tag):
+        return Response(status_code=304, headers=headers)
+
+    if compress:
+        compressed = get_compressed()
+        gzipped = compressed.get(tag)
+        if gzipped is None:
+            gzipped = gzip.compress(body, config.GZIP_LEVEL)
+            compressed.set(tag, gzipped)
+        headers["Content-Encoding"] = "gzip"
+        body = gzipped
+
+    return Response(body, media_type=media_type, headers=headers)
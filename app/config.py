@@ -1,3 +1,6 @@
+import asyncio
+import signal
+
 from pydantic import BaseSettings
 from functools import lru_cache
 
@@ -8,11 +11,97 @@ class Settings(BaseSettings):
     API_SECRET: str
     BEARER_TOKEN: str
 
+    # processes `python -m app.serve` starts, with more than one the caches are shared through SHARED_CACHE_PATH
+    WORKERS: int = 1
+    # blank keeps every cache in its own process, app.serve sets it when there are several workers
+    SHARED_CACHE_PATH: str = ""
+
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+
+    TWITTER_API_URL: str = "https://api.twitter.com"
+    HTTP_POOL_SIZE: int = 100
+    HTTP_KEEPALIVE_SIZE: int = 20
+    HTTP_PER_HOST_LIMIT: int = 50
+    HTTP_TIMEOUT: float = 10.0
+    RATE_LIMIT_MAX_WAIT: float = 2.0
+
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_WORKERS: int = 2
+    PASSWORD_QUEUE_LIMIT: int = 32
+
+    AUTH_CACHE_SIZE: int = 10000
+    AUTH_CACHE_TTL: float = 300.0
+
+    TIMELINE_WINDOW: int = 200
+    TIMELINE_REFRESH_SECONDS: float = 60.0
+    TIMELINE_CACHE_USERS: int = 1000
+    TIMELINE_CACHE_MAX_TWEETS: int = 50000
+    TIMELINE_CACHE_TTL: float = 3600.0
+
+    STATUS_CACHE_SIZE: int = 100000
+    STATUS_CACHE_TTL: float = 60.0
+
+    PROFILE_CACHE_SIZE: int = 50000
+    PROFILE_CACHE_TTL: float = 300.0
+    PROFILE_CACHE_STALE_TTL: float = 3600.0
+
+    # get-tweets, get-users and home-timeline bodies at least this big are gzipped for clients that accept it
+    GZIP_MIN_SIZE: int = 1024
+    GZIP_LEVEL: int = 6
+    GZIP_CACHE_SIZE: int = 1000
+    GZIP_CACHE_BYTES: int = 32_000_000
+    GZIP_CACHE_TTL: float = 300.0
+
+    # deeper queries are refused, every level that follows tweets or users can be another Twitter call
+    GRAPHQL_MAX_DEPTH: int = 8
+
+    REQUEST_COUNT_FLUSH_SECONDS: float = 10.0
+
+    BULK_TWEET_MAX_ITEMS: int = 500
+    BULK_TWEET_MAX_CONCURRENCY: int = 8
+
+    JOB_WORKERS: int = 4
+    JOB_MAX_ATTEMPTS: int = 5
+    # doubled after every failed attempt
+    JOB_RETRY_SECONDS: float = 2.0
+    JOB_POLL_SECONDS: float = 1.0
+    JOB_LEASE_SECONDS: float = 120.0
+    # finished jobs are deleted this long after they finish
+    JOB_RETENTION_SECONDS: float = 7 * 24 * 3600.0
+
+    METRICS_ENABLED: bool = True
+    METRICS_LOOP_LAG_INTERVAL: float = 0.5
+
+    # 0 only profiles requests from admins that ask for it
+    PROFILE_SAMPLE_EVERY: int = 0
+    PROFILE_MAX_REPORTS: int = 20
+    PROFILE_MAX_BYTES: int = 20_000_000
+    PROFILE_REPORT_TTL: float = 86400.0
+
     class Config:
         env_file = ".env"
+        allow_mutation = False
 
-def get_settings():
+@lru_cache()
+def get_settings()-> Settings:
+    """The process wide settings, read from the environment and .env once"""
     return Settings()
 
+def reload_settings()-> Settings:
+    """
+    Re-reads the environment and .env, sending the process a SIGHUP does the same.
+    Anything built from the old settings at startup (database engine, pools, caches) keeps them.
+    """
+    get_settings.cache_clear()
+    return get_settings()
+
+def install_reload_signal():
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, reload_settings)
+
 
 
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+
+from collections import Counter
+from sqlalchemy import case
+from sqlalchemy.orm import Session
+from typing import Optional
+
+from .config import Settings, get_settings
+from .database import SessionLocal, run_db
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCounter:
+    """
+    Counts User.requests_made in memory and adds them to the database every `interval` seconds,
+    in one UPDATE ... SET requests_made = requests_made + CASE id ... END statement.
+
+    Shutting down cleanly flushes whatever is left. If the process dies without that,
+    at most the last `interval` seconds of counts are lost. A failed flush keeps its counts for the next one.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pending = Counter()
+        self._task: Optional[asyncio.Task] = None
+
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> "RequestCounter":
+        return cls(config.REQUEST_COUNT_FLUSH_SECONDS)
+
+    def add(self, user_id: int, count: int = 1):
+        self.pending[user_id] += count
+
+    def _write(self, counts: Counter):
+        from .models import User
+
+        session: Session = SessionLocal()
+        try:
+            (session.query(User)
+                    .filter(User.id.in_(list(counts)))
+                    .update({User.requests_made: User.requests_made + case(dict(counts), value=User.id, else_=0)},
+                            synchronize_session=False)
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    async def flush(self):
+        if not self.pending:
+            return
+
+        counts, self.pending = self.pending, Counter()
+        try:
+            await run_db(self._write, counts)
+        except Exception:
+            self.failures += 1
+            self.pending.update(counts)
+            logger.exception("Flushing requests_made for %d users failed", len(counts))
+        else:
+            self.flushes += 1
+            self.flushed += sum(counts.values())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"interval": self.interval,
+                "pending_users": len(self.pending),
+                "pending_requests": sum(self.pending.values()),
+                "flushes": self.flushes,
+                "flushed_requests": self.flushed,
+                "failures": self.failures,
+                }
+
+
+_counter: Optional[RequestCounter] = None
+
+
+def get_request_counter() -> RequestCounter:
+    global _counter
+    if _counter is None:
+        _counter = RequestCounter.from_settings(get_settings())
+
+    return _counter
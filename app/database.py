@@ -1,17 +1,127 @@
-from sqlalchemy import create_engine
+import asyncio
+import contextvars
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from sqlalchemy import create_engine, exc
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool, StaticPool
 
 from .config import get_settings, Settings
+from .metrics import track_queries
 
 config: Settings = get_settings()
 
+
+class MeteredQueuePool(QueuePool):
+    """A QueuePool that also records how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
 SQLALCHEMY_DATABASE_URI = config.DATABASE_URI
-if config.DATABASE_URI.startswith("sqlite"):
-    engine = create_engine(SQLALCHEMY_DATABASE_URI, connect_args={"check_same_thread": False})
+if config.DATABASE_URI in ("sqlite://", "sqlite:///:memory:"):
+    # every thread has to see the same in-memory database
+    engine = create_engine(SQLALCHEMY_DATABASE_URI,
+                           connect_args={"check_same_thread": False},
+                           poolclass=StaticPool,
+                           )
+elif config.DATABASE_URI.startswith("sqlite"):
+    engine = create_engine(SQLALCHEMY_DATABASE_URI,
+                           connect_args={"check_same_thread": False},
+                           pool_pre_ping=config.DB_POOL_PRE_PING,
+                           )
 else:
-    engine = create_engine(SQLALCHEMY_DATABASE_URI)
+    engine = create_engine(SQLALCHEMY_DATABASE_URI,
+                           poolclass=MeteredQueuePool,
+                           pool_size=config.DB_POOL_SIZE,
+                           max_overflow=config.DB_MAX_OVERFLOW,
+                           pool_timeout=config.DB_POOL_TIMEOUT,
+                           pool_recycle=config.DB_POOL_RECYCLE,
+                           pool_pre_ping=config.DB_POOL_PRE_PING,
+                           )
+
+if config.METRICS_ENABLED:
+    track_queries(engine)
 
 SessionLocal = sessionmaker(bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+# one thread per connection the pool can hand out, so a thread never waits on the pool for long
+executor = ThreadPoolExecutor(max_workers=config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW, thread_name_prefix="db")
+
+
+async def run_db(fn, *args, **kwargs):
+    """Runs blocking database work on the database threads instead of the event loop, in the caller's context"""
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(executor, partial(context.run, fn, *args, **kwargs))
+
+
+class AsyncSession:
+    """
+    Awaitable access to a Session for async handlers.
+    SQLAlchemy 1.3 has no asyncio support, so every call runs on the database threads, one at a time.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs `fn(session, *args, **kwargs)` on the database threads"""
+        return await run_db(fn, self.session, *args, **kwargs)
+
+    async def commit(self):
+        await run_db(self.session.commit)
+
+    async def refresh(self, instance):
+        await run_db(self.session.refresh, instance)
+
+    async def load(self, instance, *attributes):
+        """Loads any of `attributes` that are still lazy, so reading them later won't block"""
+        await run_db(lambda: [getattr(instance, name) for name in attributes])
+
+    def add(self, instance):
+        self.session.add(instance)
+
+    def delete(self, instance):
+        self.session.delete(instance)
+
+
+def pool_stats()-> dict:
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__, "status": pool.status()}
+
+    if isinstance(pool, MeteredQueuePool):
+        stats.update(size=pool.size(),
+                     checked_out=pool.checkedout(),
+                     checked_in=pool.checkedin(),
+                     overflow=pool.overflow(),
+                     max_overflow=pool._max_overflow,
+                     checkouts=pool.checkouts,
+                     timeouts=pool.timeouts,
+                     avg_wait_ms=1000 * pool.wait_seconds / pool.checkouts if pool.checkouts else 0.0,
+                     max_wait_ms=1000 * pool.max_wait_seconds,
+                     )
+
+    return stats
\ No newline at end of file
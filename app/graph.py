@@ -0,0 +1,204 @@
+"""
+The GraphQL schema served at /graphql, over Twitter's tweets and users and your own archived tweets.
+
+Every field that refers to a tweet or a Twitter user by id goes through the request's Loaders (app.loaders),
+so a query asking for the replies, mentions and authors of a hundred tweets makes one lookup per level of
+the query instead of one per field. `author` and `quoted` come with the tweet itself and cost nothing.
+Twitter ids are 64 bit, so they're IDs (strings) rather than Ints.
+Resolvers raise HTTPException like the rest of the app, /graphql turns them into GraphQL errors.
+"""
+import graphene
+
+from fastapi import HTTPException
+from graphql.language import ast
+from typing import Dict, Optional
+
+from .loaders import Loaders
+from .models import Tweet as TweetModel, User
+
+ARCHIVE_LIMIT = 200
+
+
+def twitter_id(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HTTPException(400, detail=f"{value!r} isn't a Twitter id")
+
+
+def loaders(info) -> Loaders:
+    return info.context["loaders"]
+
+
+def key(name: str):
+    """Resolves a field from `name` in Twitter's dict, graphene's source= only reads attributes"""
+    return lambda root, info: root.get(name)
+
+
+class TwitterUser(graphene.ObjectType):
+    id = graphene.ID(required=True)
+    name = graphene.String()
+    username = graphene.String(resolver=key("screen_name"))
+    location = graphene.String()
+    description = graphene.String()
+    protected = graphene.Boolean()
+    verified = graphene.Boolean()
+    followers = graphene.Int(resolver=key("followers_count"))
+    following = graphene.Int(resolver=key("friends_count"), description="Users they follow")
+    favourites = graphene.Int(resolver=key("favourites_count"))
+    tweet_count = graphene.Int(resolver=key("statuses_count"))
+    created_at = graphene.String()
+
+
+class Tweet(graphene.ObjectType):
+    id = graphene.ID(required=True)
+    text = graphene.String()
+    created_at = graphene.String()
+    source = graphene.String()
+    language = graphene.String(resolver=key("lang"))
+    place = graphene.String(description="The place's full name")
+    retweets = graphene.Int(resolver=key("retweet_count"))
+    favorites = graphene.Int(resolver=key("favorite_count"))
+    possibly_sensitive = graphene.Boolean()
+    is_quote = graphene.Boolean(resolver=key("is_quote_status"))
+
+    author = graphene.Field(TwitterUser)
+    quoted = graphene.Field(lambda: Tweet)
+    in_reply_to = graphene.Field(lambda: Tweet)
+    in_reply_to_user = graphene.Field(TwitterUser)
+    mentions = graphene.List(TwitterUser)
+
+    def resolve_place(tweet: dict, info):
+        place = tweet.get("place")
+        return place.get("full_name") if isinstance(place, dict) else place
+
+    def resolve_author(tweet: dict, info):
+        return tweet.get("user")
+
+    def resolve_quoted(tweet: dict, info):
+        if isinstance(tweet.get("quoted_status"), dict):
+            return tweet["quoted_status"]
+        id = tweet.get("quoted_status_id")
+        return loaders(info).status(id) if id is not None else None
+
+    def resolve_in_reply_to(tweet: dict, info):
+        id = tweet.get("in_reply_to_status_id")
+        return loaders(info).status(id) if id is not None else None
+
+    def resolve_in_reply_to_user(tweet: dict, info):
+        id = tweet.get("in_reply_to_user_id")
+        return loaders(info).profile(id) if id is not None else None
+
+    def resolve_mentions(tweet: dict, info):
+        mentions = (tweet.get("entities") or {}).get("user_mentions") or []
+        return loaders(info).profiles.load_many([("id", mention["id"]) for mention in mentions])
+
+
+class ArchivedTweet(graphene.ObjectType):
+    """A Tweet made from here, as it was when it was made. `status` is how it is on Twitter now"""
+    id = graphene.ID(required=True)
+    text = graphene.String()
+    created_at = graphene.DateTime()
+    status = graphene.Field(Tweet)
+
+    def resolve_status(tweet: TweetModel, info):
+        return loaders(info).status(twitter_id(tweet.id))
+
+
+class ArchivePage(graphene.ObjectType):
+    tweets = graphene.List(ArchivedTweet)
+    next_cursor = graphene.String()
+
+
+class Account(graphene.ObjectType):
+    """Your account here"""
+    username = graphene.String()
+    full_name = graphene.String()
+    active = graphene.Boolean()
+    is_admin = graphene.Boolean()
+    twitter_id = graphene.ID()
+    requests_made = graphene.Int()
+    twitter_profile = graphene.Field(TwitterUser)
+    archive = graphene.Field(ArchivePage,
+                             limit=graphene.Int(default_value=20),
+                             cursor=graphene.String(),
+                             description="The Tweets you've made from here, newest first, like /users/tweets")
+
+    async def resolve_requests_made(user: User, info):
+        await info.context["db"].load(user, "requests_made")
+        return user.requests_made
+
+    def resolve_twitter_profile(user: User, info):
+        return loaders(info).profile(twitter_id(user.twitter_id)) if user.twitter_id else None
+
+    async def resolve_archive(user: User, info, limit: int, cursor: Optional[str] = None):
+        from .routers.users import decode_cursor, encode_cursor
+
+        if not 1 <= limit <= ARCHIVE_LIMIT:
+            raise HTTPException(400, detail=f"limit should be from 1 to {ARCHIVE_LIMIT}")
+
+        after = decode_cursor(cursor) if cursor else None
+        tweets = await info.context["db"].run(TweetModel.history, user.id, limit, after)
+        return ArchivePage(tweets=tweets, next_cursor=encode_cursor(tweets[-1]) if len(tweets) == limit else None)
+
+
+class Query(graphene.ObjectType):
+    me = graphene.Field(Account)
+    tweet = graphene.Field(Tweet, id=graphene.ID(required=True))
+    tweets = graphene.List(Tweet, ids=graphene.List(graphene.NonNull(graphene.ID), required=True),
+                           description="In the order asked for, null for tweets Twitter doesn't return")
+    user = graphene.Field(TwitterUser, id=graphene.ID(), username=graphene.String())
+    users = graphene.List(TwitterUser,
+                          ids=graphene.List(graphene.NonNull(graphene.ID)),
+                          usernames=graphene.List(graphene.NonNull(graphene.String)),
+                          description="Ids then usernames in the order asked for, null for users Twitter doesn't return")
+
+    def resolve_me(root, info):
+        return info.context["user"]
+
+    def resolve_tweet(root, info, id: str):
+        return loaders(info).status(twitter_id(id))
+
+    def resolve_tweets(root, info, ids):
+        return loaders(info).statuses.load_many([twitter_id(id) for id in ids])
+
+    def resolve_user(root, info, id: Optional[str] = None, username: Optional[str] = None):
+        if id is not None:
+            return loaders(info).profile(twitter_id(id))
+        if username is not None:
+            return loaders(info).profile_named(username)
+        raise HTTPException(400, detail="Please enter an id or username")
+
+    def resolve_users(root, info, ids=None, usernames=None):
+        if not (ids or usernames):
+            raise HTTPException(400, detail="Please enter an id or username")
+        keys = [("id", twitter_id(id)) for id in ids or []] + [("name", name.casefold()) for name in usernames or []]
+        return loaders(info).profiles.load_many(keys)
+
+
+schema = graphene.Schema(query=Query)
+
+
+def depth(document: ast.Document) -> int:
+    """How deeply the operations in `document` nest their selections, fragments included"""
+    fragments: Dict[str, ast.FragmentDefinition] = {definition.name.value: definition
+                                                    for definition in document.definitions
+                                                    if isinstance(definition, ast.FragmentDefinition)}
+
+    def selections(selection_set: Optional[ast.SelectionSet], seen: frozenset) -> int:
+        if selection_set is None:
+            return 0
+        deepest = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                deepest = max(deepest, 1 + selections(selection.selection_set, seen))
+            elif isinstance(selection, ast.InlineFragment):
+                deepest = max(deepest, selections(selection.selection_set, seen))
+            elif isinstance(selection, ast.FragmentSpread):
+                name = selection.name.value
+                if name in fragments and name not in seen:
+                    deepest = max(deepest, selections(fragments[name].selection_set, seen | {name}))
+        return deepest
+
+    return max([selections(definition.selection_set, frozenset())
+                for definition in document.definitions if isinstance(definition, ast.OperationDefinition)] or [0])
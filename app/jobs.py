@@ -0,0 +1,417 @@
+"""
+Posts Tweets in the background, for the make, reply and quote endpoints' `background` mode.
+Jobs are rows in tweet_job, so they outlive the process, and a pool of workers in the app posts them.
+"""
+import asyncio
+import httpx
+import json
+import logging
+
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from sqlalchemy import and_, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from typing import Dict, List, Optional, Set, Tuple
+
+from .client import OAuth1Auth, get_twitter_client
+from .config import Settings, get_settings
+from .database import SessionLocal, run_db
+from .models import Tweet, TweetJob, User
+
+logger = logging.getLogger(__name__)
+
+# Twitter's error code for "Status is a duplicate"
+DUPLICATE_STATUS = 187
+# how often each process deletes the finished jobs past JOB_RETENTION_SECONDS
+PRUNE_EVERY = timedelta(minutes=10)
+
+
+class Retry(Exception):
+    def __init__(self, reason: str, delay: Optional[float] = None, uncertain: bool = False, counts: bool = True):
+        super().__init__(reason)
+        self.delay = delay
+        self.uncertain = uncertain
+        self.counts = counts
+
+
+class Failed(Exception):
+    pass
+
+
+def claimable(now: datetime):
+    """Jobs that are due, or that a worker took and didn't finish in time, like when the process died"""
+    return or_(due_now(now), lease_expired(now))
+
+
+def due_now(now: datetime):
+    return and_(TweetJob.state == "queued", TweetJob.run_after <= now)
+
+
+def lease_expired(now: datetime):
+    return and_(TweetJob.state == "running", TweetJob.lease_until < now)
+
+
+def twitter_time(created_at: str)-> datetime:
+    return datetime.strptime(created_at, "%a %b %d %H:%M:%S %z %Y").astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class JobQueue:
+    """
+    Workers take jobs by moving them to running with a lease, so two workers, or two processes, never post the same one.
+    A job whose lease runs out goes back to the queue.
+
+    Twitter has no idempotency keys, so when an attempt might have posted the Tweet without us hearing back
+    (a timeout, a 5xx, a lost lease) the job is marked uncertain. The next attempt first looks for the Tweet
+    in the user's timeline and only posts it again if it isn't there.
+    Finished jobs are kept for `retention_seconds`, then deleted.
+    """
+
+    def __init__(self, workers: int, max_attempts: int, retry_seconds: float, poll_seconds: float, lease_seconds: float,
+                 retention_seconds: float):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.poll_seconds = poll_seconds
+        self.lease = timedelta(seconds=lease_seconds)
+        self.retention = timedelta(seconds=retention_seconds)
+        self._pruned_at: Optional[datetime] = None
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[str] = set()
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+        self.enqueued = 0
+        self.done = 0
+        self.failed = 0
+        self.retries = 0
+        self.reconciled = 0
+        self.pruned = 0
+        self.busy = 0
+        self.states: Dict[str, int] = {}
+        self.latencies = deque(maxlen=1000)
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> "JobQueue":
+        return cls(config.JOB_WORKERS, config.JOB_MAX_ATTEMPTS, config.JOB_RETRY_SECONDS,
+                   config.JOB_POLL_SECONDS, config.JOB_LEASE_SECONDS, config.JOB_RETENTION_SECONDS)
+
+    def _create(self, user_id: int, params: dict, idempotency_key: Optional[str])-> Tuple[TweetJob, bool]:
+        session: Session = SessionLocal()
+        try:
+            if idempotency_key is not None:
+                job = session.query(TweetJob).filter_by(user_id=user_id, idempotency_key=idempotency_key).one_or_none()
+                if job is not None:
+                    return job, False
+
+            job = TweetJob(user_id=user_id, idempotency_key=idempotency_key, params=json.dumps(params))
+            session.add(job)
+            try:
+                session.commit()
+            except IntegrityError:
+                # the same key came in twice at once
+                session.rollback()
+                return session.query(TweetJob).filter_by(user_id=user_id, idempotency_key=idempotency_key).one(), False
+
+            session.refresh(job)
+            return job, True
+        finally:
+            session.close()
+
+    async def enqueue(self, user_id: int, params: dict, idempotency_key: Optional[str] = None)-> TweetJob:
+        """Saves a job to post a Tweet with `params`, or returns the user's job with the same `idempotency_key`"""
+        job, created = await run_db(self._create, user_id, params, idempotency_key)
+        if created:
+            self.enqueued += 1
+            self._schedule(job.id)
+
+        return job
+
+    def _get(self, user_id: int, job_id: str)-> Optional[TweetJob]:
+        session: Session = SessionLocal()
+        try:
+            return session.query(TweetJob).filter_by(id=job_id, user_id=user_id).one_or_none()
+        finally:
+            session.close()
+
+    async def get(self, user_id: int, job_id: str)-> Optional[TweetJob]:
+        return await run_db(self._get, user_id, job_id)
+
+    def _schedule(self, job_id: str):
+        if self._queue is not None and job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    def _claim(self, job_id: str)-> Optional[Tuple[TweetJob, User]]:
+        session: Session = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            claimed = (session.query(TweetJob)
+                              .filter(TweetJob.id == job_id, claimable(now))
+                              .update({TweetJob.state: "running",
+                                       TweetJob.attempts: TweetJob.attempts + 1,
+                                       # a lease that ran out might have posted the Tweet
+                                       TweetJob.uncertain: or_(TweetJob.uncertain, TweetJob.state == "running"),
+                                       TweetJob.lease_until: now + self.lease},
+                                      synchronize_session=False)
+                      )
+            session.commit()
+            if not claimed:
+                return None
+
+            job = session.query(TweetJob).get(job_id)
+            return job, session.query(User).get(job.user_id)
+        finally:
+            session.close()
+
+    def _finish(self, job_id: str, user_id: int, tweet: dict):
+        session: Session = SessionLocal()
+        try:
+            row = Tweet(**tweet)
+            row.user_id = user_id
+            session.merge(row)
+            (session.query(TweetJob)
+                    .filter(TweetJob.id == job_id)
+                    .update({TweetJob.state: "done", TweetJob.tweet_id: str(tweet["id"]), TweetJob.error: None,
+                             TweetJob.finished_at: datetime.utcnow(), TweetJob.lease_until: None},
+                            synchronize_session=False))
+            session.commit()
+        finally:
+            session.close()
+
+    def _fail(self, job_id: str, reason: str):
+        session: Session = SessionLocal()
+        try:
+            (session.query(TweetJob)
+                    .filter(TweetJob.id == job_id)
+                    .update({TweetJob.state: "failed", TweetJob.error: reason,
+                             TweetJob.finished_at: datetime.utcnow(), TweetJob.lease_until: None},
+                            synchronize_session=False))
+            session.commit()
+        finally:
+            session.close()
+
+    def _retry(self, job_id: str, reason: str, delay: float, uncertain: bool, counts: bool):
+        session: Session = SessionLocal()
+        try:
+            values = {TweetJob.state: "queued", TweetJob.error: reason, TweetJob.lease_until: None,
+                      TweetJob.run_after: datetime.utcnow() + timedelta(seconds=delay)}
+            if uncertain:
+                values[TweetJob.uncertain] = True
+            if not counts:
+                values[TweetJob.attempts] = TweetJob.attempts - 1
+            session.query(TweetJob).filter(TweetJob.id == job_id).update(values, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    async def _post(self, auth: OAuth1Auth, params: dict)-> Optional[dict]:
+        """The posted Tweet, or None when Twitter says it's a duplicate"""
+        try:
+            r = await get_twitter_client().post("/1.1/statuses/update.json", params=params, auth=auth)
+        except HTTPException as e:
+            if e.status_code == 429:
+                retry_after = float((e.headers or {}).get("Retry-After", self.retry_seconds))
+                raise Retry("Rate limited by Twitter", delay=retry_after, counts=False)
+            raise Failed(str(e.detail))
+        except httpx.RequestError as e:
+            raise Retry(f"{type(e).__name__}: {e}", uncertain=True)
+
+        if r.status_code >= 500:
+            raise Retry(r.text, uncertain=True)
+        if r.is_error:
+            try:
+                codes = [error.get("code") for error in r.json().get("errors", [])]
+            except ValueError:
+                codes = []
+            if DUPLICATE_STATUS in codes:
+                return None
+            raise Failed(r.text)
+
+        return r.json()
+
+    async def _find_posted(self, auth: OAuth1Auth, job: TweetJob, params: dict)-> Optional[dict]:
+        """The job's Tweet if an earlier attempt posted it, going by the text and reply of the user's latest Tweets"""
+        try:
+            r = await get_twitter_client().get("/1.1/statuses/user_timeline.json",
+                                               params=dict(count=50, include_rts=False, exclude_replies=False),
+                                               auth=auth)
+        except (HTTPException, httpx.RequestError) as e:
+            raise Retry(f"Couldn't check whether the Tweet was already posted: {e}", uncertain=True)
+        if r.is_error:
+            raise Retry(f"Couldn't check whether the Tweet was already posted: {r.text}", uncertain=True)
+
+        status = params["status"].strip()
+        in_reply_to = params.get("in_reply_to_status_id")
+        for tweet in r.json():
+            text = (tweet.get("full_text") or tweet.get("text") or "").strip()
+            # replies can get @mentions added to the front
+            if not text.endswith(status):
+                continue
+            if in_reply_to and str(tweet.get("in_reply_to_status_id")) != str(in_reply_to):
+                continue
+            if twitter_time(tweet["created_at"]) >= job.created_at - timedelta(minutes=1):
+                return tweet
+
+        return None
+
+    async def run(self, job_id: str):
+        claimed = await run_db(self._claim, job_id)
+        if claimed is None:
+            return
+
+        job, user = claimed
+        if user is None:
+            # failed for good, or it would be reclaimed every time its lease ran out
+            self.failed += 1
+            await run_db(self._fail, job.id, "The account this Tweet was for has been deleted")
+            return
+
+        params = json.loads(job.params)
+        auth = user.get_oauth1_token()
+        try:
+            tweet = await self._find_posted(auth, job, params) if job.uncertain else None
+            if tweet is not None:
+                self.reconciled += 1
+            else:
+                tweet = await self._post(auth, params)
+            if tweet is None:
+                # a duplicate we didn't know we'd posted, it has to be there
+                tweet = await self._find_posted(auth, job, params)
+                if tweet is None:
+                    raise Failed("Twitter says this Tweet is a duplicate of one you already posted")
+        except Retry as e:
+            if e.counts and job.attempts >= self.max_attempts:
+                self.failed += 1
+                await run_db(self._fail, job.id, f"Gave up after {job.attempts} attempts: {e}")
+                return
+
+            self.retries += 1
+            delay = e.delay if e.delay is not None else self.retry_seconds * 2 ** (job.attempts - 1)
+            await run_db(self._retry, job.id, str(e), delay, e.uncertain, e.counts)
+            return
+        except Failed as e:
+            self.failed += 1
+            await run_db(self._fail, job.id, str(e))
+            return
+
+        await run_db(self._finish, job.id, user.id, tweet)
+        self.done += 1
+        self.latencies.append((datetime.utcnow() - job.created_at).total_seconds())
+
+    def _due(self, limit: int)-> Tuple[List[str], Dict[str, int]]:
+        """
+        Jobs to claim and how many are queued and running. Each query only reads its state's part of
+        ix_tweet_job_state_run_after, never the finished jobs.
+        """
+        session: Session = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            due = session.query(TweetJob.id).filter(due_now(now)).order_by(TweetJob.run_after).limit(limit).all()
+            due += session.query(TweetJob.id).filter(lease_expired(now)).limit(limit).all()
+            states = (session.query(TweetJob.state, func.count(TweetJob.id))
+                             .filter(TweetJob.state.in_(("queued", "running")))
+                             .group_by(TweetJob.state)
+                             .all())
+            return [id for id, in due[:limit]], dict(states)
+        finally:
+            session.close()
+
+    def _prune(self, before: datetime)-> int:
+        session: Session = SessionLocal()
+        try:
+            pruned = (session.query(TweetJob)
+                             .filter(TweetJob.state.in_(("done", "failed")), TweetJob.finished_at < before)
+                             .delete(synchronize_session=False))
+            session.commit()
+            return pruned
+        finally:
+            session.close()
+
+    async def _poll(self):
+        """Picks up jobs from before a restart, retries that are due, and jobs other processes left behind"""
+        while True:
+            try:
+                due, self.states = await run_db(self._due, self.workers * 4)
+                for job_id in due:
+                    self._schedule(job_id)
+
+                now = datetime.utcnow()
+                if self._pruned_at is None or now - self._pruned_at >= PRUNE_EVERY:
+                    self._pruned_at = now
+                    self.pruned += await run_db(self._prune, now - self.retention)
+            except Exception:
+                logger.exception("Polling for tweet jobs failed")
+            await asyncio.sleep(self.poll_seconds)
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            if job_id is None or self._stopping:
+                return
+
+            self._queued.discard(job_id)
+            self.busy += 1
+            try:
+                await self.run(job_id)
+            except Exception:
+                logger.exception("Tweet job %s failed unexpectedly, it will be retried when its lease runs out", job_id)
+            finally:
+                self.busy -= 1
+
+    def start(self):
+        if self._tasks:
+            return
+
+        self._stopping = False
+        self._queue = asyncio.Queue()
+        self._queued.clear()
+        self._tasks = [asyncio.ensure_future(self._poll())]
+        self._tasks += [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, grace: float = 5.0):
+        """Lets jobs that are being posted finish for up to `grace` seconds, the rest are picked up after a restart"""
+        if not self._tasks:
+            return
+
+        self._stopping = True
+        poller, workers = self._tasks[0], self._tasks[1:]
+        poller.cancel()
+        for _ in workers:
+            self._queue.put_nowait(None)
+
+        _, pending = await asyncio.wait(workers, timeout=grace)
+        for task in pending:
+            task.cancel()
+        self._tasks = []
+        self._queue = None
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {"workers": self.workers,
+                "busy": self.busy,
+                "waiting": self._queue.qsize() if self._queue is not None else 0,
+                "jobs": self.states,
+                "enqueued": self.enqueued,
+                "done": self.done,
+                "failed": self.failed,
+                "retries": self.retries,
+                "reconciled": self.reconciled,
+                "pruned": self.pruned,
+                "latency_p50_seconds": latencies[len(latencies) // 2] if latencies else None,
+                "latency_p95_seconds": latencies[int(len(latencies) * 0.95)] if latencies else None,
+                "latency_max_seconds": latencies[-1] if latencies else None,
+                }
+
+
+_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        _queue = JobQueue.from_settings(get_settings())
+
+    return _queue
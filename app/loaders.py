@@ -0,0 +1,131 @@
+"""
+Per-request batching for the GraphQL resolvers, in the style of DataLoader.
+
+A resolver asks a loader for one key and gets a future back. Keys asked for while the query resolves one
+level are collected, and looked up together once the event loop comes back around, so a level of the query costs
+one StatusCache / ProfileCache lookup however many fields refer to tweets or users. The caches then only send
+the ids they don't have to Twitter, in as few calls of LOOKUP_LIMIT as there can be.
+Each key is looked up at most once per request.
+"""
+import asyncio
+
+from fastapi import HTTPException
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Sequence
+
+from .client import TwitterClient
+from .models import User
+from .profiles import ProfileCache
+from .statuses import StatusCache
+
+TWITTER_ERROR = "Something went wrong with Twitter, please try again or contact me @redDevv"
+
+
+class BatchLoader:
+    """`batch` gets the keys to look up and returns what it found by key, keys it leaves out resolve to None"""
+
+    def __init__(self, batch: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]]):
+        self.batch = batch
+        self._futures: Dict[Hashable, asyncio.Future] = {}
+        self._queue: List[Hashable] = []
+
+        # what resolvers asked for, and the lookups that took
+        self.loads = 0
+        self.batches = 0
+
+    def load(self, key: Hashable) -> asyncio.Future:
+        self.loads += 1
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = self._futures[key] = loop.create_future()
+            if not self._queue:
+                loop.call_soon(self._dispatch)
+            self._queue.append(key)
+
+        return future
+
+    def load_many(self, keys: Sequence[Hashable]) -> asyncio.Future:
+        return asyncio.gather(*(self.load(key) for key in keys))
+
+    def _dispatch(self):
+        keys, self._queue = self._queue, []
+        asyncio.ensure_future(self._run(keys))
+
+    async def _run(self, keys: List[Hashable]):
+        self.batches += 1
+        try:
+            found = await self.batch(keys)
+        except Exception as e:
+            for key in keys:
+                if not self._futures[key].done():
+                    self._futures[key].set_exception(e)
+            return
+
+        for key in keys:
+            if not self._futures[key].done():
+                self._futures[key].set_result(found.get(key))
+
+
+class Loaders:
+    """The loaders of one request, tweets by id and Twitter users by ("id", id) or ("name", casefolded screen name)"""
+
+    def __init__(self, user: User, twitter: TwitterClient, statuses: StatusCache, profiles: ProfileCache):
+        self.user = user
+        self.twitter = twitter
+        self.auth = user.get_oauth1_token()
+        self.status_cache = statuses
+        self.profile_cache = profiles
+
+        self.statuses = BatchLoader(self._statuses)
+        self.profiles = BatchLoader(self._profiles)
+
+    def _check_active(self, what: str):
+        if not self.user.active:
+            raise HTTPException(401, detail=f"Your account seems to be inactive, please login with twitter to view {what}")
+
+    async def _get(self, url: str, params: dict, shared: bool = True) -> list:
+        # the caches strip what depends on the user, so other users can share these calls
+        r = await self.twitter.get(url, params=params, auth=self.auth, shared=shared)
+        if r.is_error:
+            raise HTTPException(400, detail={"message": TWITTER_ERROR, "error from twitter": r.text})
+        return r.json()
+
+    async def _statuses(self, ids: List[int]) -> Dict[int, dict]:
+        self._check_active("tweets")
+
+        async def lookup(batch: List[int], shared: bool) -> List[dict]:
+            return await self._get("/1.1/statuses/lookup.json",
+                                   dict(id=",".join([str(x) for x in batch]), include_entities=True), shared)
+
+        return {tweet["id"]: tweet for tweet in await self.status_cache.lookup(ids, lookup)}
+
+    async def _profiles(self, keys: List[tuple]) -> Dict[tuple, dict]:
+        self._check_active("users")
+
+        async def lookup(ids: Sequence[int], names: Sequence[str]) -> List[dict]:
+            return await self._get("/1.1/users/lookup.json",
+                                   dict(screen_name=",".join(names) if names else None,
+                                        user_id=",".join([str(x) for x in ids]) if ids else None))
+
+        ids = [key for kind, key in keys if kind == "id"]
+        names = [key for kind, key in keys if kind == "name"]
+        found = {}
+        for profile in await self.profile_cache.lookup(ids, names, lookup):
+            found[("id", profile["id"])] = profile
+            found[("name", profile["screen_name"].casefold())] = profile
+
+        return found
+
+    def status(self, id: int) -> asyncio.Future:
+        return self.statuses.load(id)
+
+    def profile(self, id: int) -> asyncio.Future:
+        return self.profiles.load(("id", id))
+
+    def profile_named(self, screen_name: str) -> asyncio.Future:
+        return self.profiles.load(("name", screen_name.casefold()))
+
+    def stats(self) -> dict:
+        return {"statuses": {"loads": self.statuses.loads, "batches": self.statuses.batches},
+                "profiles": {"loads": self.profiles.loads, "batches": self.profiles.batches},
+                }
@@ -1,7 +1,16 @@
 from fastapi import FastAPI, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
 
 from . import login, schemas
+from .client import open_twitter_client, close_twitter_client
+from .config import get_settings, install_reload_signal
+from .counters import get_request_counter
+from .database import engine
+from .jobs import get_job_queue
+from .metrics import LoopLagMonitor, MetricsMiddleware, registry
+from .passwords import close_password_pool, get_password_pool
+from .profiling import ProfilingMiddleware, get_profiles
 
 tags_metadata = [
     {
@@ -11,36 +20,95 @@ tags_metadata = [
     {
         "name": "twitter",
         "description": "Manage your Twitter account. Login, make and view Tweets and more"
+    },
+    {
+        "name": "graphql",
+        "description": "View Tweets, Twitter users and your archived Tweets in one query"
     }
 ]
 
-app = FastAPI(
-              title="Red's Twitter Client",
-              description="""A simple web API to use Twitter from.  
-                            Endpoints with lock icons require login.  
-                            Check out the documentation <a href="/redoc">here</a>""",
-              version="1.0",
-              openapi_tags=tags_metadata,
-              docs_url="/"
-            )
-
-@app.post("/token", response_model=schemas.Token, include_in_schema=False)
+loop_lag = LoopLagMonitor(get_settings().METRICS_LOOP_LAG_INTERVAL)
+
+registry.gauge_from("db_connections_checked_out", "Database connections in use", (),
+                    lambda: {(): engine.pool.checkedout()} if hasattr(engine.pool, "checkedout") else {})
+registry.gauge_from("password_queue_depth", "Password hashes waiting or running", (),
+                    lambda: {(): get_password_pool().depth})
+registry.gauge_from("tweet_jobs", "Background tweet jobs by state, as of the last poll", ("state",),
+                    lambda: {(state,): count for state, count in get_job_queue().states.items()})
+
+async def startup():
+    install_reload_signal()
+    await open_twitter_client()
+    get_request_counter().start()
+    get_job_queue().start()
+    if get_settings().METRICS_ENABLED:
+        loop_lag.start()
+
+async def shutdown():
+    loop_lag.stop()
+    await get_job_queue().stop()
+    await get_request_counter().stop()
+    await close_twitter_client()
+    close_password_pool()
+
 async def login_for_access_token(form: OAuth2PasswordRequestForm = Depends()):
-    return login(form)
+    return await login(form)
+
+async def get_metrics()-> PlainTextResponse:
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
     
 
-from .routers import users, twitter
+def create_app()-> FastAPI:
+    """
+    Builds the app without touching the database, tables are created by `python -m app.migrate`.
+    Connections and pools open in the startup handlers.
+    """
+    from .routers import admin, graphql, users, twitter
+
+    app = FastAPI(
+                  title="Red's Twitter Client",
+                  description="""A simple web API to use Twitter from.  
+                                Endpoints with lock icons require login.  
+                                Check out the documentation <a href="/redoc">here</a>""",
+                  version="1.0",
+                  openapi_tags=tags_metadata,
+                  docs_url="/"
+                )
+
+    app.add_event_handler("startup", startup)
+    app.add_event_handler("shutdown", shutdown)
+
+    app.post("/token", response_model=schemas.Token, include_in_schema=False)(login_for_access_token)
+
+    # inside the metrics middleware, so reports can include the request's database queries
+    app.add_middleware(ProfilingMiddleware, sample_every=get_settings().PROFILE_SAMPLE_EVERY, reports=get_profiles())
+
+    if get_settings().METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware)
+        app.get("/metrics", include_in_schema=False)(get_metrics)
+
+    # app.include_router(auth.router,
+    #     prefix="/auth",
+    #     tags=["auth"])
+
+
+    app.include_router(users.router,
+        prefix="/users",
+        tags=['users'],
+        )
+
+    app.include_router(twitter.router,
+        prefix="/twitter",
+        tags=['twitter'])
 
-# app.include_router(auth.router,
-#     prefix="/auth",
-#     tags=["auth"])
+    app.include_router(graphql.router,
+        prefix="/graphql",
+        tags=['graphql'])
 
+    app.include_router(admin.router,
+        prefix="/admin",
+        tags=['admin'])
 
-app.include_router(users.router,
-    prefix="/users",
-    tags=['users'],
-    )
+    return app
 
-app.include_router(twitter.router,
-    prefix="/twitter",
-    tags=['twitter'])
\ No newline at end of file
+app = create_app()
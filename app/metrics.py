@@ -0,0 +1,259 @@
+"""
+Counters, gauges and histograms for /metrics, in the Prometheus text format.
+Everything is kept in this process, label values are tuples of strings in `labelnames` order.
+
+MetricsMiddleware times every request by route, counts the database queries it makes (see `track_queries`),
+and keeps the in-flight gauge. TwitterClient times upstream calls and PasswordPool times bcrypt.
+"""
+import asyncio
+import bisect
+import threading
+import time
+
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+# upper bounds in seconds, +Inf is added when rendering
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket, with one more for +Inf], sum
+        self.values: Dict[Tuple[str, ...], list] = {}
+        # observed from the database threads as well as the event loop
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                bucket = _labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        # (name, help, labelnames, fn returning {labels: value}), called when rendering
+        self.collectors: List[Tuple[str, str, Sequence[str], Callable[[], Dict[Tuple[str, ...], float]]]] = []
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def gauge_from(self, name: str, help: str, labelnames: Sequence[str], fn: Callable[[], Dict[Tuple[str, ...], float]]):
+        """A gauge that's worked out when /metrics is read, for things other modules already count"""
+        self.collectors.append((name, help, tuple(labelnames), fn))
+
+    def render(self) -> str:
+        parts = [metric.render() for metric in self.metrics]
+        for name, help, labelnames, fn in self.collectors:
+            gauge = Gauge(name, help, labelnames)
+            gauge.values = fn()
+            parts.append(gauge.render())
+        return "\n".join(parts) + "\n"
+
+
+registry = Registry()
+
+http_requests_in_flight = registry.add(Gauge("http_requests_in_flight", "Requests being handled"))
+http_request_duration = registry.add(Histogram("http_request_duration_seconds", "Time to handle a request",
+                                               ("method", "route", "status")))
+http_request_db_queries = registry.add(Histogram("http_request_db_queries", "Database queries made by a request",
+                                                 ("route",), COUNT_BUCKETS))
+http_request_db_duration = registry.add(Histogram("http_request_db_seconds", "Time a request spent in database queries",
+                                                  ("route",)))
+
+db_query_duration = registry.add(Histogram("db_query_duration_seconds", "Time to run a database query"))
+
+twitter_requests_in_flight = registry.add(Gauge("twitter_requests_in_flight", "Calls to Twitter waiting on a response",
+                                                ("family",)))
+twitter_request_duration = registry.add(Histogram("twitter_request_duration_seconds", "Time for Twitter to respond",
+                                                  ("family", "method", "status")))
+
+password_duration = registry.add(Histogram("password_duration_seconds", "Time spent hashing and verifying passwords",
+                                           ("operation", "phase")))
+serialization_duration = registry.add(Histogram("serialization_duration_seconds", "Time to encode Twitter payloads",
+                                                 ("kind",)))
+
+event_loop_lag = registry.add(Histogram("event_loop_lag_seconds", "How late the event loop woke up a sleeping task"))
+
+
+# [queries, seconds] of the request being handled, shared with the database threads through run_db
+request_queries: ContextVar[Optional[list]] = ContextVar("request_queries", default=None)
+
+
+def track_queries(engine: Engine):
+    """Times every query on `engine`, adding it to the current request's count too"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        db_query_duration.observe(elapsed)
+        queries = request_queries.get()
+        if queries is not None:
+            queries[0] += 1
+            queries[1] += elapsed
+
+
+def family(url: str) -> str:
+    """statuses/lookup for /1.1/statuses/lookup.json, oauth/request_token for /oauth/request_token"""
+    path = urlsplit(url).path.strip("/")
+    if path.startswith("1.1/"):
+        path = path[4:]
+    if path.endswith(".json"):
+        path = path[:-5]
+    return path
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware, so streaming responses pass through untouched.
+    The route label is the path template of the matched route, like /twitter/jobs/{job_id}, or `unmatched`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Dict[Callable, str] = {}
+
+    def route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+
+        route = self._routes.get(endpoint)
+        if route is None:
+            paths = {r.endpoint: r.path for r in scope["app"].routes if hasattr(r, "endpoint")}
+            route = self._routes[endpoint] = paths.get(endpoint, "unmatched")
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = "500"
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        queries = [0, 0.0]
+        token = request_queries.set(queries)
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_requests_in_flight.dec()
+            request_queries.reset(token)
+
+            route = self.route(scope)
+            http_request_duration.observe(elapsed, scope["method"], route, status)
+            http_request_db_queries.observe(queries[0], route)
+            http_request_db_duration.observe(queries[1], route)
+
+
+class LoopLagMonitor:
+    """Sleeps `interval` at a time and records how much longer than that it took to wake up"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            event_loop_lag.observe(max(loop.time() - start - self.interval, 0.0))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
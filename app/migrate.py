@@ -0,0 +1,30 @@
+"""
+Creates any missing tables and indexes.
+Run it once per deploy with `python -m app.migrate`, the Procfile's release phase does this on Heroku.
+"""
+from sqlalchemy import exc
+
+from . import database, models, search
+
+
+def create_missing_indexes():
+    """create_all only indexes the tables it creates, this adds indexes defined after a table was made"""
+    for table in database.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=database.engine)
+            except (exc.OperationalError, exc.ProgrammingError) as e:
+                if "already exists" not in str(e.orig):
+                    raise
+            else:
+                print(f"Created index {index.name} on {table.name}")
+
+
+def migrate():
+    models.Base.metadata.create_all(bind=database.engine)
+    create_missing_indexes()
+    search.create_search_index(database.engine)
+
+
+if __name__ == "__main__":
+    migrate()
@@ -1,19 +1,15 @@
-import requests
-
 from datetime import datetime
 from fastapi import HTTPException
-from passlib.context import CryptContext
-from requests_oauthlib import OAuth1
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Text, DateTime#, BigInteger
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Text, DateTime, Index, and_, func, or_#, BigInteger
 from sqlalchemy.orm import relationship, Session
-from typing import Optional
+from typing import List, Optional, Tuple
 from uuid import uuid4
 
-from .database import Base, SessionLocal
+from .client import OAuth1Auth
+from .database import Base, SessionLocal, run_db
 from .config import Settings, get_settings
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from .passwords import get_password_pool
 
 make_id = (lambda : uuid4().hex.upper())
 
@@ -28,18 +24,24 @@ class User(Base):
     is_admin = Column(Boolean, default=False)
     requests_made = Column(Integer, default=0)
 
-    public_id = Column(String(32), default=make_id)
+    public_id = Column(String(32), default=make_id, unique=True, index=True)
     twitter_id = Column(String(32))
     # twitter_id = Column(BigInteger)
 
     oauth_token = Column(String(50))
     token = Column(String(80))
     token_secret = Column(String(80))
-    tweets:list = relationship("Tweet", back_populates="user", lazy="joined")
+    # loaded only when asked for, page through them with Tweet.history instead
+    tweets:list = relationship("Tweet", back_populates="user", lazy="select")
 
-    def __init__(self, *, username:str, password:str, full_name:Optional[str]=None, **extra):
+    @staticmethod
+    def username_is(username: str):
+        """Case insensitive username match, served by ix_user_username_lower"""
+        return func.lower(User.username) == func.lower(username)
+
+    def __init__(self, *, username:str, full_name:Optional[str]=None, **extra):
         session: Session = SessionLocal()
-        taken = session.query(User).filter(User.username.ilike(username)).first()
+        taken = session.query(User).filter(User.username_is(username)).first()
         session.close()
 
         if taken:
@@ -47,32 +49,45 @@ class User(Base):
 
         self.username = username
         self.full_name = full_name
-        self.set_password(password)
         self.is_admin = False
 
-    def set_password(self, password):
-        self.password = pwd_context.hash(password)
+    async def set_password(self, password):
+        self.password = await get_password_pool().hash(password)
 
-    def verify_password(self, password)->bool:
-        return pwd_context.verify(password, self.password)
+    async def verify_password(self, password)->bool:
+        return await get_password_pool().verify(password, self.password)
 
     @staticmethod
-    def authenticate(username, password):
-        session: Session = SessionLocal()
-        user:User = session.query(User).filter(User.username.ilike(username)).one_or_none()
-        
-        session.close()
+    async def authenticate(username, password):
+        def find()-> Optional[User]:
+            session: Session = SessionLocal()
+            user:User = session.query(User).filter(User.username_is(username)).one_or_none()
+            
+            session.close()
+            return user
+
+        user:User = await run_db(find)
 
         if user:
-            is_verified = user.verify_password(password)
+            is_verified, new_hash = await get_password_pool().verify_and_update(password, user.password)
             if is_verified:
+                if new_hash:
+                    # BCRYPT_ROUNDS changed since this password was hashed
+                    await run_db(User._rehash, user.id, new_hash)
                 return user
 
         return None
 
-    def get_oauth1_token(self):
+    @staticmethod
+    def _rehash(id: int, new_hash: str):
+        session: Session = SessionLocal()
+        session.query(User).filter(User.id == id).update({User.password: new_hash})
+        session.commit()
+        session.close()
+
+    def get_oauth1_token(self)-> OAuth1Auth:
         config: Settings = get_settings()
-        auth = OAuth1(config.API_KEY, 
+        auth = OAuth1Auth(config.API_KEY, 
                     config.API_SECRET,
                     self.token,
                     self.token_secret
@@ -80,6 +95,10 @@ class User(Base):
         return auth
 
 
+# usernames are looked up case insensitively on every login
+Index("ix_user_username_lower", func.lower(User.username), unique=True)
+
+
 class Tweet(Base):
     __tablename__ = "tweet"
 
@@ -89,6 +108,8 @@ class Tweet(Base):
     user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
     user = relationship("User", back_populates="tweets")
 
+    __table_args__ = (Index("ix_tweet_user_id_created_at", "user_id", "created_at", "id"),)
+
     def __init__(self, id: int, text: str, created_at:str, user=None, **extra):
         self.id = id
         self.text = text
@@ -108,5 +129,44 @@ class Tweet(Base):
         else:
             self.created_at = datetime.utcnow()
 
+    @staticmethod
+    def history(session: Session, user_id: int, limit: int, after: Optional[Tuple[datetime, str]] = None)-> List["Tweet"]:
+        """
+        A user's tweets, newest first, continuing after the (created_at, id) of the last tweet of the previous page.
+        Served by ix_tweet_user_id_created_at.
+        """
+        query = session.query(Tweet).filter(Tweet.user_id == user_id)
+        if after is not None:
+            created_at, id = after
+            query = query.filter(or_(Tweet.created_at < created_at,
+                                     and_(Tweet.created_at == created_at, Tweet.id < id)))
+
+        return query.order_by(Tweet.created_at.desc(), Tweet.id.desc()).limit(limit).all()
 
 
+class TweetJob(Base):
+    """A Tweet waiting to be posted by the job queue, see app.jobs"""
+    __tablename__ = "tweet_job"
+
+    id = Column(String(32), primary_key=True, default=make_id)
+    user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    # the same key from the same user gets the same job back instead of a second Tweet
+    idempotency_key = Column(String(64))
+    params = Column(Text, nullable=False)
+
+    state = Column(String(16), nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    # set when an attempt might have posted the Tweet without us hearing back
+    uncertain = Column(Boolean, nullable=False, default=False)
+    run_after = Column(DateTime, nullable=False, default=datetime.utcnow)
+    lease_until = Column(DateTime)
+
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+    tweet_id = Column(String(32))
+    error = Column(Text)
+
+    __table_args__ = (Index("ix_tweet_job_user_id_idempotency_key", "user_id", "idempotency_key", unique=True),
+                      Index("ix_tweet_job_state_run_after", "state", "run_after"),
+                      Index("ix_tweet_job_state_finished_at", "state", "finished_at"),
+                      )
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from typing import Optional, Tuple
+
+from .config import Settings, get_settings
+from .metrics import password_duration
+
+
+class PasswordPool:
+    """
+    Runs bcrypt hashing and verification on a small thread pool so it never blocks the event loop.
+    bcrypt releases the GIL, so PASSWORD_WORKERS threads use that many cores.
+    At most PASSWORD_QUEUE_LIMIT jobs wait or run at once, anything over that gets a 503.
+    """
+
+    def __init__(self, rounds: int, workers: int, queue_limit: int):
+        # hashes made with any other cost get flagged by verify_and_update and rehashed
+        self.context = CryptContext(schemes=["bcrypt"],
+                                    deprecated="auto",
+                                    bcrypt__default_rounds=rounds,
+                                    bcrypt__min_desired_rounds=rounds,
+                                    bcrypt__max_desired_rounds=rounds,
+                                    )
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_limit = queue_limit
+
+        self.depth = 0
+        self.max_depth = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.wait_seconds = 0.0
+        self.work_seconds = 0.0
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> "PasswordPool":
+        return cls(config.BCRYPT_ROUNDS, config.PASSWORD_WORKERS, config.PASSWORD_QUEUE_LIMIT)
+
+    async def _run(self, fn, *args):
+        if self.depth >= self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(503, detail="The server is busy, please try again shortly", headers={"Retry-After": "1"})
+
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        queued_at = time.perf_counter()
+
+        def timed():
+            started_at = time.perf_counter()
+            result = fn(*args)
+            return result, started_at, time.perf_counter()
+
+        try:
+            loop = asyncio.get_event_loop()
+            result, started_at, finished_at = await loop.run_in_executor(self.executor, timed)
+        finally:
+            self.depth -= 1
+
+        self.completed += 1
+        self.wait_seconds += started_at - queued_at
+        self.work_seconds += finished_at - started_at
+        password_duration.observe(started_at - queued_at, fn.__name__, "queued")
+        password_duration.observe(finished_at - started_at, fn.__name__, "hashing")
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hash: str) -> bool:
+        return await self._run(self.context.verify, password, hash)
+
+    async def verify_and_update(self, password: str, hash: str) -> Tuple[bool, Optional[str]]:
+        is_verified, new_hash = await self._run(self.context.verify_and_update, password, hash)
+        if new_hash:
+            self.rehashed += 1
+
+        return is_verified, new_hash
+
+    def stats(self) -> dict:
+        return {"rounds": self.rounds,
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "rehashed": self.rehashed,
+                "avg_wait_ms": 1000 * self.wait_seconds / self.completed if self.completed else 0.0,
+                "avg_work_ms": 1000 * self.work_seconds / self.completed if self.completed else 0.0,
+                }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+_pool: Optional[PasswordPool] = None
+
+
+def get_password_pool() -> PasswordPool:
+    global _pool
+    if _pool is None:
+        _pool = PasswordPool.from_settings(get_settings())
+
+    return _pool
+
+
+def close_password_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+from .client import chunked
+from .config import Settings, get_settings
+from .sharedcache import shared_or_local
+
+logger = logging.getLogger(__name__)
+
+# fields Twitter fills in from the point of view of whoever is asking
+VIEWER_USER_FIELDS = ("following", "follow_request_sent", "notifications")
+
+Fetch = Callable[[Sequence[int], Sequence[str]], Awaitable[List[dict]]]
+
+
+def shared_profile(profile: dict) -> dict:
+    """
+    A copy of `profile` that's the same whoever looked it up, safe to share between users.
+    The latest tweet of a protected account is only there for its followers, so it's dropped.
+    """
+    private = ("status",) if profile.get("protected") else ()
+    return {key: value for key, value in profile.items() if key not in VIEWER_USER_FIELDS and key not in private}
+
+
+class ProfileCache:
+    """
+    Twitter users, shared between every user and found by either id or casefolded screen name.
+    Profiles older than `ttl` are still served for up to `stale_ttl`, while a fresh copy is fetched in the background.
+    Misses go to Twitter in concurrent chunks of at most LOOKUP_LIMIT ids and screen names together.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        # id -> (fetched_at, profile) and screen name -> id
+        self.profiles = shared_or_local("profiles", maxsize, stale_ttl)
+        self.names = shared_or_local("profile_names", maxsize, stale_ttl)
+
+        self._refreshing = set()
+        self._tasks = set()
+
+        self.upstream_calls = 0
+        self.stale_served = 0
+        self.refreshes = 0
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> "ProfileCache":
+        return cls(config.PROFILE_CACHE_SIZE, config.PROFILE_CACHE_TTL, config.PROFILE_CACHE_STALE_TTL)
+
+    def _store(self, profiles: List[dict]):
+        now = time.time()
+        profiles = [shared_profile(profile) for profile in profiles]
+        self.profiles.set_many([(profile["id"], (now, profile)) for profile in profiles])
+        self.names.set_many([(profile["screen_name"].casefold(), profile["id"]) for profile in profiles])
+
+    async def _fetch(self, ids: Sequence[int], names: Sequence[str], fetch: Fetch) -> List[dict]:
+        # users/lookup takes ids and screen names together, LOOKUP_LIMIT of them in all
+        entries = [(id, None) for id in ids] + [(None, name) for name in names]
+        batches = [([id for id, _ in chunk if id is not None], [name for _, name in chunk if name is not None])
+                   for chunk in chunked(entries)]
+        self.upstream_calls += len(batches)
+
+        results = await asyncio.gather(*(fetch(*batch) for batch in batches))
+        profiles = [profile for result in results for profile in result]
+        self._store(profiles)
+        return profiles
+
+    async def _refresh(self, ids: List[int], fetch: Fetch):
+        try:
+            await self._fetch(ids, [], fetch)
+            self.refreshes += 1
+        except Exception:
+            logger.exception("Refreshing %d Twitter profiles failed", len(ids))
+        finally:
+            self._refreshing.difference_update(ids)
+
+    async def lookup(self, ids: Sequence[int], names: Sequence[str], fetch: Fetch) -> List[dict]:
+        """
+        The profiles for `ids` then `names`, in the order asked for without duplicates.
+        `fetch` looks up one chunk of ids and screen names on Twitter.
+        """
+        keys = [("id", id) for id in ids] + [("name", name.casefold()) for name in names]
+        found = {}
+        stale = []
+
+        named = self.names.get_many(dict.fromkeys(key for kind, key in keys if kind == "name"))
+        entries = self.profiles.get_many(dict.fromkeys([key for kind, key in keys if kind == "id"] +
+                                                       list(named.values())))
+        for kind, key in dict.fromkeys(keys):
+            id = key if kind == "id" else named.get(key)
+            entry = entries.get(id)
+            if entry is None:
+                continue
+
+            fetched_at, profile = entry
+            found[(kind, key)] = profile
+            if time.time() - fetched_at > self.ttl and id not in self._refreshing:
+                stale.append(id)
+
+        missing_ids = [key for kind, key in dict.fromkeys(keys) if kind == "id" and (kind, key) not in found]
+        missing_names = [key for kind, key in dict.fromkeys(keys) if kind == "name" and (kind, key) not in found]
+
+        if missing_ids or missing_names:
+            for profile in await self._fetch(missing_ids, missing_names, fetch):
+                found.setdefault(("id", profile["id"]), profile)
+                found.setdefault(("name", profile["screen_name"].casefold()), profile)
+
+        if stale:
+            self.stale_served += len(stale)
+            self._refreshing.update(stale)
+            task = asyncio.ensure_future(self._refresh(stale, fetch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        profiles = {}
+        for key in keys:
+            profile = found.get(key)
+            if profile is not None:
+                profiles.setdefault(profile["id"], profile)
+
+        return list(profiles.values())
+
+    def stats(self) -> dict:
+        stats = self.profiles.stats()
+        stats.update(names=len(self.names),
+                     upstream_calls=self.upstream_calls,
+                     stale_served=self.stale_served,
+                     background_refreshes=self.refreshes,
+                     )
+        return stats
+
+
+_profiles: Optional[ProfileCache] = None
+
+
+def get_profile_cache() -> ProfileCache:
+    global _profiles
+    if _profiles is None:
+        _profiles = ProfileCache.from_settings(get_settings())
+
+    return _profiles
@@ -0,0 +1,215 @@
+"""
+Profiles single requests in place with cProfile.
+
+An admin sends `X-Profile: store` to have their request profiled and the report kept, the response gets
+an `X-Profile-Id` header and the report is at /admin/profiles/{id}. `X-Profile: download` answers with the
+report itself instead of the response, the original status goes in `X-Profile-Status`.
+With PROFILE_SAMPLE_EVERY set, 1 in that many requests to each route is profiled and kept too.
+
+cProfile follows the event loop's thread, so requests that run at the same time show up in a report as well,
+and database work on the database threads only shows up as time spent waiting for it.
+Only one request is profiled at a time, others asking meanwhile get `X-Profile: busy`.
+Requests that don't ask, and aren't sampled, only pay for looking at their headers.
+"""
+import cProfile
+import io
+import marshal
+import pstats
+import time
+
+from datetime import datetime
+from jose import JWTError, jwt
+from starlette.routing import Match
+from typing import Dict, Optional, Union
+from uuid import uuid4
+
+from . import ALGORITHM, auth_cache, database, models
+from .cache import TTLCache
+from .sharedcache import SharedCache, shared_or_local
+from .config import get_settings
+from .metrics import request_queries
+
+# lines of the report, sorted by cumulative time
+REPORT_FUNCTIONS = 60
+
+
+class Profile:
+    def __init__(self, id: str, method: str, path: str, route: str, status: int, seconds: float,
+                 queries: Optional[list], sampled: bool, stats: pstats.Stats):
+        self.id = id
+        self.method = method
+        self.path = path
+        self.route = route
+        self.status = status
+        self.seconds = seconds
+        self.queries = queries
+        self.sampled = sampled
+        self.created_at = datetime.utcnow()
+
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(REPORT_FUNCTIONS)
+        self.report = self.summary() + "\n" + out.getvalue()
+        # what pstats.dump_stats writes, for snakeviz and friends
+        self.dump = marshal.dumps(stats.stats)
+
+    def summary(self) -> str:
+        lines = [f"{self.method} {self.path} -> {self.status} in {self.seconds * 1000:.1f}ms",
+                 f"route {self.route}, {'sampled' if self.sampled else 'asked for by an admin'}, {self.created_at.isoformat()}Z"]
+        if self.queries is not None:
+            lines.append(f"database queries: {self.queries[0]}, taking {self.queries[1] * 1000:.1f}ms")
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self) -> dict:
+        return {"id": self.id,
+                "method": self.method,
+                "path": self.path,
+                "route": self.route,
+                "status": self.status,
+                "ms": self.seconds * 1000,
+                "db_queries": self.queries[0] if self.queries is not None else None,
+                "db_ms": self.queries[1] * 1000 if self.queries is not None else None,
+                "sampled": self.sampled,
+                "created_at": self.created_at,
+                }
+
+
+def header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def load_is_admin(public_id: str) -> bool:
+    session = database.SessionLocal()
+    try:
+        return bool(session.query(models.User.is_admin).filter(models.User.public_id == public_id).scalar())
+    finally:
+        session.close()
+
+
+async def is_admin(scope) -> bool:
+    """Whether the request's bearer token belongs to an admin, the same way get_current_user would see it"""
+    authorization = header(scope, b"authorization") or ""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+
+    entry = auth_cache.get(token)
+    if entry is not None:
+        return bool(entry[1].is_admin)
+
+    try:
+        public_id = jwt.decode(token, get_settings().SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return False
+    return public_id is not None and await database.run_db(load_is_admin, public_id)
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, sample_every: int, reports: Union[TTLCache, SharedCache]):
+        self.app = app
+        self.sample_every = sample_every
+        self.reports = reports
+        self._seen: Dict[str, int] = {}
+        self._active = False
+
+    def route(self, scope) -> str:
+        for route in scope["app"].routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", "unmatched")
+        return "unmatched"
+
+    def sampled(self, route: str) -> bool:
+        seen = self._seen.get(route, 0) + 1
+        self._seen[route] = seen
+        return seen % self.sample_every == 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        mode = header(scope, b"x-profile")
+        if mode is None and not self.sample_every:
+            return await self.app(scope, receive, send)
+
+        route = self.route(scope)
+        sampled = mode is None and self.sampled(route)
+        if not sampled and (mode is None or not await is_admin(scope)):
+            return await self.app(scope, receive, send)
+
+        if self._active:
+            async def send_busy(message):
+                if message["type"] == "http.response.start" and not sampled:
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile", b"busy")]
+                await send(message)
+
+            return await self.app(scope, receive, send_busy)
+
+        await self.profile(scope, receive, send, route, "download" if mode == "download" else "store", sampled)
+
+    async def profile(self, scope, receive, send, route: str, mode: str, sampled: bool):
+        id = uuid4().hex
+        status = 500
+
+        async def send_profiled(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if mode == "store" and not sampled:
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", id.encode())]
+            # the report is sent instead
+            if mode != "download":
+                await send(message)
+
+        queries = request_queries.get()
+        before = list(queries) if queries is not None else None
+
+        self._active = True
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            profiler.disable()
+            seconds = time.perf_counter() - start
+            self._active = False
+
+            if before is not None:
+                queries = [queries[0] - before[0], queries[1] - before[1]]
+            profile = Profile(id, scope["method"], scope["path"], route, status, seconds, queries, sampled,
+                              pstats.Stats(profiler))
+            self.reports.set(id, profile)
+
+        if mode == "download":
+            body = profile.report.encode()
+            await send({"type": "http.response.start",
+                        "status": 200,
+                        "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                                    (b"content-length", str(len(body)).encode()),
+                                    (b"content-disposition", f'attachment; filename="profile-{id}.txt"'.encode()),
+                                    (b"x-profile-id", id.encode()),
+                                    (b"x-profile-status", str(status).encode())],
+                        })
+            await send({"type": "http.response.body", "body": body})
+
+
+_profiles: Optional[Union[TTLCache, SharedCache]] = None
+
+
+def get_profiles() -> Union[TTLCache, SharedCache]:
+    """
+    Kept profiles by id, the oldest go once there are PROFILE_MAX_REPORTS or they pass PROFILE_MAX_BYTES.
+    Shared between workers so any of them can serve /admin/profiles, without the PROFILE_MAX_BYTES limit then.
+    """
+    global _profiles
+    if _profiles is None:
+        config = get_settings()
+        _profiles = shared_or_local("request_profiles", config.PROFILE_MAX_REPORTS, config.PROFILE_REPORT_TTL,
+                                    maxweight=config.PROFILE_MAX_BYTES,
+                                    weigh=lambda profile: len(profile.report) + len(profile.dump))
+
+    return _profiles
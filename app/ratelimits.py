@@ -0,0 +1,121 @@
+import asyncio
+import math
+import time
+
+from fastapi import HTTPException
+from httpx import Headers
+from typing import Dict, Hashable, Optional
+
+from .cache import TTLCache
+
+# url -> the rate limit family Twitter counts it against
+FAMILIES = {
+    "/1.1/statuses/update.json": "statuses/update",
+    "/1.1/statuses/lookup.json": "statuses/lookup",
+    "/1.1/users/lookup.json": "users/lookup",
+    "/1.1/statuses/home_timeline.json": "statuses/home_timeline",
+    "/1.1/statuses/user_timeline.json": "statuses/user_timeline",
+}
+
+
+class RateLimit:
+    __slots__ = ("limit", "remaining", "reset")
+
+    def __init__(self, limit: int, remaining: int, reset: float):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+
+    def as_dict(self) -> dict:
+        return {"limit": self.limit, "remaining": max(self.remaining, 0), "reset": int(self.reset)}
+
+
+class RateLimiter:
+    """
+    Tracks Twitter's rate limit budget per user token and endpoint family from the x-rate-limit-* headers.
+    A call that would find the budget spent waits for the reset if that's within `max_wait` seconds,
+    otherwise it's refused with a 429 and a Retry-After without going to Twitter.
+    """
+
+    def __init__(self, max_wait: float, maxsize: int = 100000, window: float = 3 * 60 * 60):
+        self.max_wait = max_wait
+        # identity -> {family: RateLimit}
+        self.budgets = TTLCache(maxsize, window)
+
+        self.waited = 0
+        self.rejected = 0
+        self.upstream_429s = 0
+
+    def family(self, url: str) -> Optional[str]:
+        return FAMILIES.get(url)
+
+    def _limits(self, identity: Hashable) -> Dict[str, RateLimit]:
+        limits = self.budgets.get(identity)
+        if limits is None:
+            limits = {}
+            self.budgets.set(identity, limits)
+
+        return limits
+
+    def _refuse(self, retry_after: float):
+        raise HTTPException(429,
+                            detail="You've hit Twitter's rate limit for this, please try again later",
+                            headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+                            )
+
+    async def acquire(self, identity: Hashable, family: str):
+        """Reserves one call from the budget, waiting or raising a 429 if it's spent"""
+        limit = self._limits(identity).get(family)
+
+        while limit is not None and limit.remaining <= 0:
+            wait = limit.reset - time.time()
+            if wait <= 0:
+                break
+            if wait > self.max_wait:
+                self.rejected += 1
+                self._refuse(wait)
+
+            self.waited += 1
+            await asyncio.sleep(wait)
+
+        if limit is not None and limit.reset > time.time():
+            limit.remaining -= 1
+
+    def update(self, identity: Hashable, family: str, status_code: int, headers: Headers):
+        """Records the budget Twitter reported, raising a 429 if Twitter refused the call"""
+        try:
+            limit = int(headers["x-rate-limit-limit"])
+            remaining = int(headers["x-rate-limit-remaining"])
+            reset = float(headers["x-rate-limit-reset"])
+        except (KeyError, ValueError):
+            limit = None
+
+        limits = self._limits(identity)
+        if limit is not None:
+            current = limits.get(family)
+            if current is not None and current.reset == reset:
+                # responses can land out of order, the lowest count in a window is the latest
+                current.remaining = min(current.remaining, remaining)
+            else:
+                limits[family] = RateLimit(limit, remaining, reset)
+
+        if status_code == 429:
+            self.upstream_429s += 1
+            current = limits.get(family)
+            if current is not None:
+                current.remaining = 0
+            self._refuse(current.reset - time.time() if current is not None else 60)
+
+    def budget(self, identity: Hashable) -> Dict[str, dict]:
+        now = time.time()
+        return {family: limit.as_dict()
+                for family, limit in (self.budgets.get(identity) or {}).items()
+                if limit.reset > now
+               }
+
+    def stats(self) -> dict:
+        return {"tracked_tokens": len(self.budgets),
+                "waited": self.waited,
+                "rejected": self.rejected,
+                "upstream_429s": self.upstream_429s,
+                }
@@ -0,0 +1,65 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import PlainTextResponse, Response
+from typing import List
+
+from app import auth_cache, get_current_user
+from app.client import TwitterClient, get_twitter_client
+from app.counters import get_request_counter
+from app.database import pool_stats
+from app.jobs import get_job_queue
+from app.models import User
+from app.passwords import get_password_pool
+from app.profiling import Profile, get_profiles
+from app.profiles import get_profile_cache
+from app.statuses import get_status_cache
+from app.timelines import get_timeline_cache
+
+router = APIRouter()
+
+
+async def get_admin_user(user: User = Depends(get_current_user))-> User:
+    if not user.is_admin:
+        raise HTTPException(403, detail="You do not have permission for this endpoint")
+
+    return user
+
+@router.get("/stats", include_in_schema=False)
+async def get_stats(user: User = Depends(get_admin_user),
+                    twitter: TwitterClient = Depends(get_twitter_client)
+                   )-> dict:
+    return {"upstream_coalescing": twitter.flights.stats(),
+            "rate_limits": twitter.limits.stats(),
+            "database": pool_stats(),
+            "passwords": get_password_pool().stats(),
+            "request_counter": get_request_counter().stats(),
+            "tweet_jobs": get_job_queue().stats(),
+            "auth_cache": auth_cache.stats(),
+            "timelines": get_timeline_cache().stats(),
+            "statuses": get_status_cache().stats(),
+            "profiles": get_profile_cache().stats(),
+            "request_profiles": get_profiles().stats(),
+            }
+
+def get_profile(id: str)-> Profile:
+    profile = get_profiles().get(id)
+    if profile is None:
+        raise HTTPException(404, detail="There's no profile with that id, it may have been dropped to make room")
+
+    return profile
+
+@router.get("/profiles", include_in_schema=False)
+async def list_profiles(user: User = Depends(get_admin_user))-> List[dict]:
+    """Kept request profiles, newest first. Profile a request by sending it with an `X-Profile: store` header"""
+    profiles = sorted(get_profiles().values(), key=lambda profile: profile.created_at, reverse=True)
+    return [profile.as_dict() for profile in profiles]
+
+@router.get("/profiles/{id}", include_in_schema=False)
+async def get_profile_report(id: str, user: User = Depends(get_admin_user))-> PlainTextResponse:
+    return PlainTextResponse(get_profile(id).report)
+
+@router.get("/profiles/{id}/pstats", include_in_schema=False)
+async def download_profile(id: str, user: User = Depends(get_admin_user))-> Response:
+    """The raw profile, for `python -m pstats` or snakeviz"""
+    return Response(get_profile(id).dump,
+                    media_type="application/octet-stream",
+                    headers={"Content-Disposition": f'attachment; filename="profile-{id}.prof"'})
@@ -0,0 +1,92 @@
+import logging
+
+from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
+from graphql import GraphQLError, format_error, parse
+from graphql.error import GraphQLSyntaxError
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+from app import get_async_db, get_current_user, get_settings
+from app.client import TwitterClient, get_twitter_client
+from app.config import Settings
+from app.counters import RequestCounter, get_request_counter
+from app.database import AsyncSession
+from app.graph import depth, schema
+from app.loaders import Loaders
+from app.models import User
+from app.profiles import ProfileCache, get_profile_cache
+from app.schemas import GraphQLQuery
+from app.statuses import StatusCache, get_status_cache
+
+logger = logging.getLogger(__name__)
+
+# graphql-core logs a traceback for every error a resolver raises, HTTPExceptions included,
+# unexpected ones are logged below instead
+logging.getLogger("graphql.execution.executor").setLevel(logging.CRITICAL)
+logging.getLogger("graphql.execution.utils").setLevel(logging.CRITICAL)
+
+router = APIRouter()
+
+
+def format_graphql_error(error: Exception)-> dict:
+    """HTTPExceptions raised by resolvers keep their detail and status, other errors don't leak their message"""
+    formatted = format_error(error)
+    original = getattr(error, "original_error", None)
+
+    if isinstance(original, HTTPException):
+        detail = original.detail
+        formatted["message"] = detail["message"] if isinstance(detail, dict) else str(detail)
+        formatted["extensions"] = {"status": original.status_code, "detail": detail}
+    elif original is not None and not isinstance(original, GraphQLError):
+        logger.error("GraphQL resolver failed at %s", formatted.get("path"),
+                     exc_info=(type(original), original, getattr(original, "__traceback__", None)))
+        formatted["message"] = "Something went wrong, please try again or contact me @redDevv"
+
+    return formatted
+
+
+@router.post("")
+async def graphql(
+                  body: GraphQLQuery = Body(...),
+                  user: User = Depends(get_current_user),
+                  db: AsyncSession = Depends(get_async_db),
+                  config: Settings = Depends(get_settings),
+                  twitter: TwitterClient = Depends(get_twitter_client),
+                  statuses: StatusCache = Depends(get_status_cache),
+                  profiles: ProfileCache = Depends(get_profile_cache),
+                  counter: RequestCounter = Depends(get_request_counter)
+                 ):
+    """
+    Ask for Tweets, Twitter users and your archived Tweets in one query, like
+    `{ tweets(ids: ["1324131697017933824"]) { text author { username } inReplyTo { text } mentions { username } } }`
+    Every Tweet and user the query refers to is looked up together, a level of the query at a time,
+    so this costs far fewer calls to Twitter than the endpoints it replaces.
+    Queries nest at most GRAPHQL_MAX_DEPTH levels.
+    You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.
+    Click **Try it out** and then **Execute**.
+    """
+    try:
+        document = parse(body.query)
+    except GraphQLSyntaxError as e:
+        return ORJSONResponse({"errors": [format_error(e)]}, status_code=400)
+
+    if depth(document) > config.GRAPHQL_MAX_DEPTH:
+        return ORJSONResponse({"errors": [{"message": f"Queries can nest at most {config.GRAPHQL_MAX_DEPTH} levels"}]},
+                              status_code=400)
+
+    loaders = Loaders(user, twitter, statuses, profiles)
+    result = await schema.execute(document,
+                                  variables=body.variables,
+                                  operation_name=body.operation_name,
+                                  context={"user": user, "db": db, "loaders": loaders},
+                                  executor=AsyncioExecutor(),
+                                  return_promise=True,
+                                  )
+    counter.add(user.id)
+
+    content = {"data": result.data}
+    if result.errors:
+        content["errors"] = [format_graphql_error(error) for error in result.errors]
+    logger.debug("GraphQL lookups %s", loaders.stats())
+
+    return ORJSONResponse(content, status_code=400 if result.invalid else 200)
@@ -1,10 +1,11 @@
 import re
-import requests
 
 from fastapi import APIRouter, HTTPException, Depends, Query
-from requests_oauthlib import OAuth1
 
-from app import get_settings, get_db, get_current_user, Session
+from app import get_settings, get_async_db, get_current_user, invalidate_user
+from app.database import AsyncSession
+from app.client import OAuth1Auth, TwitterClient, get_twitter_client
+from app.timelines import get_timeline_cache
 from app.models import User
 from app.schemas import TwitterLink
 from app.config import Settings
@@ -13,14 +14,16 @@ from . import tweets, users
 
 router = APIRouter()
 
-def request_token(
-                  config: Settings = Depends(get_settings)
-                 )-> str:
-    url = 'https://api.twitter.com/oauth/request_token'
-    auth = OAuth1(client_key=config.API_KEY, client_secret=config.API_SECRET, callback_uri="oob")
+async def request_token(
+                        config: Settings = Depends(get_settings),
+                        twitter: TwitterClient = Depends(get_twitter_client)
+                       )-> str:
+    url = '/oauth/request_token'
+    auth = OAuth1Auth(client_key=config.API_KEY, client_secret=config.API_SECRET, callback_uri="oob")
 
-    r = requests.post(url, auth=auth)
-    if not r.ok:
+    # never coalesced, a request token is only good for the one user who authorizes it
+    r = await twitter.post(url, auth=auth)
+    if r.is_error:
         raise HTTPException(400, detail="r is not ok")
     
     text = r.text
@@ -35,7 +38,7 @@ def request_token(
 async def twitter_login_step_1(
                                token: str = Depends(request_token),
                                user: User = Depends(get_current_user),
-                               session: Session = Depends(get_db)
+                               db: AsyncSession = Depends(get_async_db)
                               )-> dict:
     """
     Step 1 in the Twitter Login.  
@@ -45,7 +48,9 @@ async def twitter_login_step_1(
     You'll get a PIN which you'll use in **Twitter Login Step 2** below.
     """
     user.oauth_token = token
-    session.commit()
+    public_id = user.public_id
+    await db.commit()
+    await invalidate_user(public_id)
     authorize_url = f'https://api.twitter.com/oauth/authorize?oauth_token={token}'
 
 
@@ -54,8 +59,9 @@ async def twitter_login_step_1(
 
 @router.get("/verify")
 async def twitter_login_step_2(verifier:int = Query(...), 
-                    session: Session = Depends(get_db),
-                    user: User = Depends(get_current_user)
+                    db: AsyncSession = Depends(get_async_db),
+                    user: User = Depends(get_current_user),
+                    twitter: TwitterClient = Depends(get_twitter_client)
                     )-> dict:
     """
     Step 2 in the Twitter Login.  
@@ -67,11 +73,11 @@ async def twitter_login_step_2(verifier:int = Query(...),
     oauth_token = user.oauth_token
     if not oauth_token:
         raise HTTPException(400, detail="It seems you've not completed step one. Please go back and complete it.")
-    url = "https://api.twitter.com/oauth/access_token"
+    url = "/oauth/access_token"
     params = {"oauth_token": oauth_token,
             "oauth_verifier": verifier}
-    r = requests.post(url, params=params)
-    if not r.ok:
+    r = await twitter.post(url, params=params)
+    if r.is_error:
         if str(verifier)[0] == 0:
             raise HTTPException(400, detail="The verifier token seems to be bad, please repeat Step 1")
         raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again", "error": r.text})
@@ -86,16 +92,36 @@ async def twitter_login_step_2(verifier:int = Query(...),
     user.oauth_token = None
     user.active = True
 
+    public_id = user.public_id
     try:
-        session.commit()
+        await db.commit()
     except Exception as e:
         raise HTTPException(400, detail="Something seems to have went wrong with updating your account. Please try again")
+    await invalidate_user(public_id)
+    await db.refresh(user)
+    get_timeline_cache().invalidate(user.id)
 
     if user.username.casefold() != old_username:
         return {"success": f"Your Twitter login is complete, your username has been changed from '{old_username}' to '{user.username}'"}
     
     return {"success": f"Your Twitter login is complete, you can now use Twitter from here"}
 
+@router.get("/rate-limits")
+async def get_rate_limits(
+                          user: User = Depends(get_current_user),
+                          twitter: TwitterClient = Depends(get_twitter_client)
+                         )-> dict:
+    """
+    See how many requests Twitter will still take from you for each kind of request, and when that resets.  
+    Kinds of request you haven't made recently aren't listed.  
+    You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.  
+    Click **Try it out** and then **Execute**.
+    """
+    if not user.active:
+        raise HTTPException(401, detail="Your account seems to be inactive, please login with twitter to see your rate limits")
+
+    return twitter.limits.budget(user.get_oauth1_token().identity)
+
 @router.get("/convert-link-to-id", response_model=TwitterLink)
 async def get_tweet_id_from_link(
             link: str = Query(..., regex="https://twitter.com/([\w_]+)/status/([\d]+)")#, regex="https:")
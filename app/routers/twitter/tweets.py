@@ -1,22 +1,46 @@
+import asyncio
+import httpx
+import logging
+import orjson
 import re
-import requests
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from typing import Union, List, Optional
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import AsyncIterator, Awaitable, Callable, Union, List, Optional
 
-from app import Session, get_current_user, get_db, get_settings
+from app import get_current_user, get_async_db, get_settings
+from app.client import TwitterClient, get_twitter_client
+from app.database import AsyncSession
+from app.counters import RequestCounter, get_request_counter
+from app.jobs import JobQueue, get_job_queue
+from app.serializers import encode_tweets, json_response, project_tweets, tweets_response
+from app.statuses import StatusCache, get_status_cache
+from app.timelines import TimelineCache, get_timeline_cache
 from app.models import User, Tweet
-from app.schemas import Tweet as TweetSchema
+from app.schemas import Tweet as TweetSchema, TweetJob as TweetJobSchema, BulkTweets, BulkTweetReport
 from app.config import Settings
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
-@router.get("/make-tweet", response_model=TweetSchema)
+async def post_later(jobs: JobQueue, user: User, params: dict, idempotency_key: Optional[str])-> ORJSONResponse:
+    job = await jobs.enqueue(user.id, params, idempotency_key)
+    return ORJSONResponse(TweetJobSchema.from_orm(job).dict(by_alias=True),
+                          status_code=202,
+                          headers={"Location": f"/twitter/jobs/{job.id}"})
+
+@router.get("/make-tweet", response_model=TweetSchema, responses={202: {"model": TweetJobSchema}})
 async def make_tweet(tweet: str = Query(...),
                     #  attachment_url: Optional[str] = Query(None, alias="link of tweet to quote", regex="https://twitter.com/([\w_]+)/status/([\d]+)"),
                     #  in_reply_to: Optional[int] = Query(None, alias="link of tweet to reply to", regex="https://twitter.com/([\w_]+)/status/([\d]+)"), 
                      user: User = Depends(get_current_user),
-                     session: Session = Depends(get_db)
+                     db: AsyncSession = Depends(get_async_db),
+                     twitter: TwitterClient = Depends(get_twitter_client),
+                     counter: RequestCounter = Depends(get_request_counter),
+                     background: bool = Query(False, description="Answer right away with a job to check on, and post the Tweet in the background"),
+                     idempotency_key: Optional[str] = Header(None, max_length=64),
+                     jobs: JobQueue = Depends(get_job_queue)
                      )-> TweetSchema:
     """
     Make a Tweet, enter a _tweet_.
@@ -29,32 +53,42 @@ async def make_tweet(tweet: str = Query(...),
     # if in_reply_to:
         # regex = re.match("https://twitter.com/(?P<username>[\w]+)/status/(?P<id>[\d]+)", in_reply_to)
         # status_id = regex.group("id")
-    url = "https://api.twitter.com/1.1/statuses/update.json"
+    url = "/1.1/statuses/update.json"
     params = dict(status=tweet,
                 #   attachment_url=attachment_url,
                 #   in_reply_to_status_id=status_id,
                     )
+    if background:
+        counter.add(user.id)
+        return await post_later(jobs, user, params, idempotency_key)
+
     auth = user.get_oauth1_token()
 
-    r = requests.post(url, params=params, auth=auth)
-    if not r.ok:
+    r = await twitter.post(url, params=params, auth=auth)
+    if r.is_error:
         raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
                                         "error from twitter": r.text})
     tweet = r.json()
 
     new_tweet = Tweet(**tweet)
-    user.tweets.append(new_tweet)
-    user.requests_made += 1
+    new_tweet.user = user
+    db.add(new_tweet)
+    counter.add(user.id)
 
-    session.commit()
-    return tweet
+    await db.commit()
+    return tweets_response(tweet)
 
-@router.get("/reply-tweet", response_model=TweetSchema)
+@router.get("/reply-tweet", response_model=TweetSchema, responses={202: {"model": TweetJobSchema}})
 async def reply_tweet(reply: str,
                       in_reply_to: str = Query(None, alias="link of tweet", regex="https://twitter.com/([\w_]+)/status/([\d]+)"),
                       status_id: int = Query(None, alias="id of tweet"),
                       user: User = Depends(get_current_user),
-                      session: Session = Depends(get_db)
+                      db: AsyncSession = Depends(get_async_db),
+                      twitter: TwitterClient = Depends(get_twitter_client),
+                      counter: RequestCounter = Depends(get_request_counter),
+                      background: bool = Query(False, description="Answer right away with a job to check on, and post the Tweet in the background"),
+                      idempotency_key: Optional[str] = Header(None, max_length=64),
+                      jobs: JobQueue = Depends(get_job_queue)
                      )-> TweetSchema:
     """
     Reply to a Tweet using either it's ID or it's link.  
@@ -72,31 +106,41 @@ async def reply_tweet(reply: str,
         regex = re.match("https://twitter.com/(?P<username>[\w]+)/status/(?P<id>[\d]+)", in_reply_to)
         status_id = regex.group("id")
 
-    url = "https://api.twitter.com/1.1/statuses/update.json"
+    url = "/1.1/statuses/update.json"
     params = dict(status=reply,
                   in_reply_to_status_id=status_id,
                   auto_populate_reply_metadata=True
                  )
+    if background:
+        counter.add(user.id)
+        return await post_later(jobs, user, params, idempotency_key)
+
     auth = user.get_oauth1_token()
 
-    r = requests.post(url, params=params, auth=auth)
-    if not r.ok:
+    r = await twitter.post(url, params=params, auth=auth)
+    if r.is_error:
         raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
                                         "error from twitter": r.text})
     tweet = r.json()
 
     new_tweet = Tweet(**tweet)
-    user.tweets.append(new_tweet)
-    user.requests_made += 1
+    new_tweet.user = user
+    db.add(new_tweet)
+    counter.add(user.id)
 
-    session.commit()
-    return tweet
+    await db.commit()
+    return tweets_response(tweet)
 
-@router.get("/quote-tweet", response_model=TweetSchema)
+@router.get("/quote-tweet", response_model=TweetSchema, responses={202: {"model": TweetJobSchema}})
 async def quote_tweet(quoted_reply:str,
                       attachment_url: str = Query(..., alias="link of tweet", regex="https://twitter.com/([\w_]+)/status/([\d]+)"),
                       user: User = Depends(get_current_user),
-                      session: Session = Depends(get_db)
+                      db: AsyncSession = Depends(get_async_db),
+                      twitter: TwitterClient = Depends(get_twitter_client),
+                      counter: RequestCounter = Depends(get_request_counter),
+                      background: bool = Query(False, description="Answer right away with a job to check on, and post the Tweet in the background"),
+                      idempotency_key: Optional[str] = Header(None, max_length=64),
+                      jobs: JobQueue = Depends(get_job_queue)
                      )-> TweetSchema:
     """
     Quote a Tweet using it's link.  
@@ -110,33 +154,157 @@ async def quote_tweet(quoted_reply:str,
     # regex = re.match("https://twitter.com/(?P<username>[\w]+)/status/(?P<id>[\d]+)", in_reply_to)
     # status_id = regex.group("id")
 
-    url = "https://api.twitter.com/1.1/statuses/update.json"
+    url = "/1.1/statuses/update.json"
     params = dict(status=quoted_reply,
                   attachment_url=attachment_url,
                 #   auto_populate_reply_metadata=True
                  )
+    if background:
+        counter.add(user.id)
+        return await post_later(jobs, user, params, idempotency_key)
+
     auth = user.get_oauth1_token()
 
-    r = requests.post(url, params=params, auth=auth)
-    if not r.ok:
+    r = await twitter.post(url, params=params, auth=auth)
+    if r.is_error:
         raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
                                         "error from twitter": r.text})
     tweet = r.json()
 
     new_tweet = Tweet(**tweet)
-    user.tweets.append(new_tweet)
-    user.requests_made += 1
+    new_tweet.user = user
+    db.add(new_tweet)
+    counter.add(user.id)
+
+    await db.commit()
+    return tweets_response(tweet)
+
+
+@router.get("/jobs/{job_id}", response_model=TweetJobSchema)
+async def get_job(
+                  job_id: str,
+                  user: User = Depends(get_current_user),
+                  jobs: JobQueue = Depends(get_job_queue)
+                 )-> TweetJobSchema:
+    """
+    Check on a Tweet you made with _background_ on, using the _job id_ you got back.  
+    _state_ is **queued** or **running** until it's **done**, then _id of tweet_ is the Tweet, or **failed** with an _error_.  
+    You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.  
+    Click **Try it out** and then **Execute**.
+    """
+    job = await jobs.get(user.id, job_id)
+    if job is None:
+        raise HTTPException(404, detail="There's no job with that id")
+
+    return job
+
+def status_params(text: str, in_reply_to: Optional[int])-> dict:
+    if in_reply_to is None:
+        return dict(status=text)
+    return dict(status=text, in_reply_to_status_id=in_reply_to, auto_populate_reply_metadata="true")
+
+async def post_status(twitter: TwitterClient, auth, params: dict)-> dict:
+    r = await twitter.post("/1.1/statuses/update.json", params=params, auth=auth)
+    if r.is_error:
+        raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
+                                        "error from twitter": r.text})
+    return r.json()
+
+@router.post("/bulk-tweet", response_model=BulkTweetReport)
+async def bulk_tweet(
+                     bulk: BulkTweets = Body(...),
+                     user: User = Depends(get_current_user),
+                     db: AsyncSession = Depends(get_async_db),
+                     twitter: TwitterClient = Depends(get_twitter_client),
+                     counter: RequestCounter = Depends(get_request_counter),
+                     config: Settings = Depends(get_settings)
+                    )-> BulkTweetReport:
+    """
+    Post many Tweets at once, or a thread where each Tweet replies to the one before.  
+    Independent Tweets are posted _concurrency_ at a time. In a thread, once a Tweet fails the rest aren't posted.  
+    Every Tweet gets its own result, and Tweets that were posted stay posted even if others fail.  
+    You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.  
+    Click **Try it out** and then **Execute**.
+    """
+    if not user.active:
+        raise HTTPException(401, detail="Your account seems to be inactive, please login with twitter to make tweets")
+    if len(bulk.tweets) > config.BULK_TWEET_MAX_ITEMS:
+        raise HTTPException(400, detail=f"You can post at most {config.BULK_TWEET_MAX_ITEMS} Tweets at once")
+
+    auth = user.get_oauth1_token()
+    results = [None] * len(bulk.tweets)
+
+    async def post(index: int, params: dict)-> Optional[dict]:
+        try:
+            tweet = await post_status(twitter, auth, params)
+        except HTTPException as e:
+            results[index] = dict(index=index, ok=False, tweet=None, error=e.detail)
+            return None
+        except httpx.HTTPError as e:
+            # the Tweet may have gone out before the connection failed
+            results[index] = dict(index=index, ok=False, tweet=None,
+                                  error=f"Couldn't reach Twitter, check your Tweets before trying again ({type(e).__name__})")
+            return None
+        except Exception:
+            logger.exception("Posting Tweet %d of a bulk tweet failed", index)
+            results[index] = dict(index=index, ok=False, tweet=None, error="Something went wrong, please try again or contact me @redDevv")
+            return None
+        results[index] = dict(index=index, ok=True, tweet=tweet, error=None)
+        return tweet
 
-    session.commit()
-    return tweet
+    if bulk.thread:
+        in_reply_to = bulk.in_reply_to
+        for index, text in enumerate(bulk.tweets):
+            if in_reply_to is None and index > 0:
+                results[index] = dict(index=index, ok=False, tweet=None, error="An earlier Tweet in the thread failed")
+                continue
+            tweet = await post(index, status_params(text, in_reply_to))
+            in_reply_to = tweet["id"] if tweet else None
+    else:
+        slots = asyncio.Semaphore(min(bulk.concurrency, config.BULK_TWEET_MAX_CONCURRENCY))
 
+        async def post_when_free(index: int, text: str):
+            async with slots:
+                await post(index, status_params(text, bulk.in_reply_to))
+
+        # whatever happens to one Tweet, the others that were posted still get archived and reported
+        await asyncio.gather(*(post_when_free(index, text) for index, text in enumerate(bulk.tweets)),
+                             return_exceptions=True)
+        for index, result in enumerate(results):
+            if result is None:
+                results[index] = dict(index=index, ok=False, tweet=None, error="Something went wrong, please try again or contact me @redDevv")
+
+    posted = [result["tweet"] for result in results if result["ok"]]
+
+    # one insert for everything that made it to Twitter, a failure here can't unpost them
+    archived = True
+    if posted:
+        counter.add(user.id, len(posted))
+        rows = [Tweet(**tweet) for tweet in posted]
+        for row in rows:
+            row.user_id = user.id
+        try:
+            await db.run(lambda session: session.bulk_save_objects(rows))
+            await db.commit()
+        except Exception:
+            await db.run(lambda session: session.rollback())
+            archived = False
+
+    for result in results:
+        if result["ok"]:
+            result["tweet"] = project_tweets([result["tweet"]])[0]
+
+    return ORJSONResponse(dict(posted=len(posted), failed=len(results) - len(posted), archived=archived, results=results))
 
 @router.get("/get-tweets", response_model=Union[TweetSchema, List[TweetSchema]])
-def get_tweets(
+async def get_tweets(
+              request: Request,
               ids: List[int] = Query(...), 
               user: User = Depends(get_current_user),
               config: Settings = Depends(get_settings),
-              session: Session = Depends(get_db)
+              twitter: TwitterClient = Depends(get_twitter_client),
+              statuses: StatusCache = Depends(get_status_cache),
+              counter: RequestCounter = Depends(get_request_counter)
              )-> TweetSchema:
     """
     View Tweets using their _ids_.  
@@ -144,6 +312,8 @@ def get_tweets(
     - Copy the link to the Tweet, the ID is the long number there.  
     - **OR** Copy the link to the Tweet and paste it in the **Get Tweet ID From Link** endpoint
 
+    Tweets are shared between users for a short while, so _favorited_ and _retweeted_ aren't included.  
+    Send the _ETag_ you got back in _If-None-Match_ to get an empty **304** when nothing changed.  
     Look below at the **Example Value** for **Code 200** to see what values to expect.  
     You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.  
     Click **Try it out** and then **Execute**.
@@ -151,45 +321,158 @@ def get_tweets(
     if not user.active:
         raise HTTPException(401, detail="Your account seems to be inactive, please login with twitter to view tweets")
     
-    ids = ",".join([str(x) for x in ids])
-    params = dict(id=ids, include_entities=True)
-
-    url = "https://api.twitter.com/1.1/statuses/lookup.json"
+    url = "/1.1/statuses/lookup.json"
     auth = user.get_oauth1_token()
 
-    r = requests.get(url, params=params, auth=auth)
-    if not r.ok:
-         raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
-                                        "error from twitter": r.text})
-    user.requests_made += 1
-    session.commit()
+    async def lookup(batch: List[int], shared: bool)-> List[dict]:
+        params = dict(id=",".join([str(x) for x in batch]), include_entities=True)
 
-    tweets = r.json()
+        # the status cache strips what depends on the user, so other users can share this call
+        r = await twitter.get(url, params=params, auth=auth, shared=shared)
+        if r.is_error:
+             raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
+                                            "error from twitter": r.text})
+        return r.json()
+
+    tweets = await statuses.lookup(ids, lookup)
+    counter.add(user.id)
 
     if len(tweets) == 1:
-        return tweets[0]
-    return tweets
+        return tweets_response(tweets[0], request)
+    return tweets_response(tweets, request)
 
 @router.get("/home-timeline", response_model=List[TweetSchema])
 async def home_timeline(
+                        request: Request,
                         count: Optional[int] = Query(None, le=200),
                         user: User = Depends(get_current_user),
+                        twitter: TwitterClient = Depends(get_twitter_client),
+                        timelines: TimelineCache = Depends(get_timeline_cache)
                        )-> TweetSchema:
     """
     View your home timeline.  
-    You can optionally use __count__ to choose the amount of tweets to load.  
+    You can optionally use __count__ to choose the amount of tweets to load, it defaults to 20.  
+    Your timeline is kept for a short while, so new Tweets can take up to a minute to show up.  
+    Send the _ETag_ you got back in _If-None-Match_ to get an empty **304** when nothing changed.  
     Look below at the **Example Value** for **Code 200** to see what values to expect.  
     You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.  
     Click **Try it out** and then **Execute**.
     """
-    params = dict(count=count, exclude_replies=False, include_entities=True)
-    url = "https://api.twitter.com/1.1/statuses/home_timeline.json"
+    timeline = timelines.get(user.id)
+
+    if not timelines.is_fresh(timeline):
+        params = dict(count=timelines.window,
+                      since_id=timelines.since_id(timeline),
+                      exclude_replies=False,
+                      include_entities=True
+                      )
+        url = "/1.1/statuses/home_timeline.json"
+        auth = user.get_oauth1_token()
+
+        r = await twitter.get(url, params=params, auth=auth)
+        if r.is_error:
+            raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
+                                            "error from twitter": r.text})
+
+        timeline = timelines.update(user.id, timeline, r.json())
+
+    count = count or 20
+    if timeline.encoded is None or timeline.encoded[0] != count:
+        timeline.encoded = (count, encode_tweets(timeline.tweets[:count]))
+    return json_response(timeline.encoded[1], request)
+
+# most tweets statuses/home_timeline.json returns per call
+TIMELINE_PAGE = 200
+
+async def timeline_pages(
+                         twitter: TwitterClient,
+                         user: User,
+                         limit: int,
+                         since_id: Optional[int] = None
+                        )-> AsyncIterator[List[dict]]:
+    """
+    Up to `limit` tweets of the user's home timeline newer than `since_id`, a page at a time, following max_id.
+    The next page is fetched while the caller handles the current one, so at most two pages are held at once.
+    """
+    url = "/1.1/statuses/home_timeline.json"
     auth = user.get_oauth1_token()
 
-    r = requests.get(url, params=params, auth=auth)
-    if not r.ok:
-        raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
-                                        "error from twitter": r.text})
+    async def fetch(max_id: Optional[int], count: int)-> List[dict]:
+        params = dict(count=count, max_id=max_id, since_id=since_id, exclude_replies=False, include_entities=True)
+
+        r = await twitter.get(url, params=params, auth=auth)
+        if r.is_error:
+            raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
+                                            "error from twitter": r.text})
+        return r.json()
+
+    sent = 0
+    next_page = asyncio.ensure_future(fetch(None, min(limit, TIMELINE_PAGE)))
+    try:
+        while next_page is not None:
+            page = (await next_page)[:limit - sent]
+            next_page = None
+            if not page:
+                return
+
+            sent += len(page)
+            if sent < limit:
+                next_page = asyncio.ensure_future(fetch(page[-1]["id"] - 1, min(limit - sent, TIMELINE_PAGE)))
+            yield page
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+def encode_page(tweets: List[dict], format: str)-> bytes:
+    if format == "sse":
+        return b"".join(b"data: " + orjson.dumps(tweet) + b"\n\n" for tweet in tweets)
+    return b"".join(orjson.dumps(tweet) + b"\n" for tweet in tweets)
+
+async def stream_pages(
+                       first: List[dict],
+                       pages: AsyncIterator[List[dict]],
+                       format: str,
+                       is_disconnected: Callable[[], Awaitable[bool]]
+                      )-> AsyncIterator[bytes]:
+    try:
+        yield encode_page(project_tweets(first), format)
+
+        async for page in pages:
+            if await is_disconnected():
+                return
+            yield encode_page(project_tweets(page), format)
+    except HTTPException as e:
+        # the status is already sent, so the error goes in the stream
+        error = orjson.dumps({"error": e.detail})
+        yield b"event: error\ndata: " + error + b"\n\n" if format == "sse" else error + b"\n"
+    finally:
+        await pages.aclose()
+
+    if format == "sse":
+        yield b"event: end\ndata: {}\n\n"
+
+@router.get("/home-timeline/stream")
+async def stream_home_timeline(
+                               request: Request,
+                               limit: int = Query(1000, ge=1, le=3200),
+                               since_id: Optional[int] = Query(None),
+                               format: str = Query("ndjson", regex="^(ndjson|sse)$"),
+                               user: User = Depends(get_current_user),
+                               twitter: TwitterClient = Depends(get_twitter_client)
+                              )-> StreamingResponse:
+    """
+    Load up to _limit_ Tweets of your home timeline, going back as far as Twitter allows, streamed as they arrive.  
+    Use _since_id_ to stop at a Tweet you already have.  
+    _format_ is **ndjson** for one Tweet per line, or **sse** for Server-Sent Events.  
+    Each Tweet looks like the ones from **Home Timeline**.  
+    You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.
+    """
+    pages = timeline_pages(twitter, user, limit, since_id)
+    try:
+        # errors on the first page still get a proper status code
+        first = await pages.__anext__()
+    except StopAsyncIteration:
+        first = []
 
-    timeline = r.json()
-    return timeline
\ No newline at end of file
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_pages(first, pages, format, request.is_disconnected), media_type=media_type)
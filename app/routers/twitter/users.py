@@ -1,9 +1,11 @@
-import requests
-
-from fastapi import APIRouter, Query, HTTPException, Depends
-from typing import Union, List, Optional
-
-from app import get_current_user, get_db, get_settings, Session
+from fastapi import APIRouter, Query, HTTPException, Depends, Request
+from typing import Union, List, Optional, Sequence
+
+from app import get_current_user, get_settings
+from app.client import TwitterClient, get_twitter_client
+from app.counters import RequestCounter, get_request_counter
+from app.profiles import ProfileCache, get_profile_cache
+from app.serializers import users_response
 from app.schemas import TwitterUser
 from app.models import User
 from app.config import Settings
@@ -12,13 +14,18 @@ router = APIRouter()
 
 @router.get("/get-users", response_model=Union[TwitterUser, List[TwitterUser]])
 async def get_users(
+                    request: Request,
                     ids: Optional[List[int]] = Query(None),
                     usernames: Optional[List[str]] = Query(None),
                     user: User = Depends(get_current_user),
-                    session: Session = Depends(get_db)
+                    twitter: TwitterClient = Depends(get_twitter_client),
+                    profiles: ProfileCache = Depends(get_profile_cache),
+                    counter: RequestCounter = Depends(get_request_counter)
                    ):
     """
     Get single or multiple Twitter Users using their _usernames_ or _ids_.  
+    Users are shared between accounts for a while, so _you follow_ isn't included.  
+    Send the _ETag_ you got back in _If-None-Match_ to get an empty **304** when nothing changed.  
     Look below at the **Example Value** for **Code 200** to see what values to expect.  
     You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.  
     Click **Try it out** and then **Execute**.
@@ -27,26 +34,29 @@ async def get_users(
     if not user.active:
         raise HTTPException(401, detail="Your account seems to be inactive, please login with twitter to view users")
 
-    usernames = ",".join(usernames) if usernames else usernames
-    ids = ",".join([str(x) for x in ids]) if ids else ids
-
     if not (usernames or ids):
         raise HTTPException(400, detail="Please enter an id or username")
 
-    url = "https://api.twitter.com/1.1/users/lookup.json"
-    params = dict(screen_name=usernames,user_id=ids)
+    url = "/1.1/users/lookup.json"
     auth = user.get_oauth1_token()
+
+    async def lookup(ids: Sequence[int], usernames: Sequence[str])-> List[dict]:
+        usernames = ",".join(usernames) if usernames else None
+        ids = ",".join([str(x) for x in ids]) if ids else None
+        params = dict(screen_name=usernames,user_id=ids)
     
-    r = requests.get(url, params=params, auth=auth)
+        # the profile cache strips what depends on the user, so other users can share this call
+        r = await twitter.get(url, params=params, auth=auth, shared=True)
         
-    if not r.ok:
-        raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
-                                    "error from twitter": r.text})
-    user.requests_made += 1
-    session.commit()
+        if r.is_error:
+            raise HTTPException(400, detail={"message":"Something went wrong with Twitter, please try again or contact me @redDevv",
+                                        "error from twitter": r.text})
+        return r.json()
+
+    data = await profiles.lookup(ids or [], usernames or [], lookup)
+    counter.add(user.id)
 
-    data = r.json()
     if len(data) == 1:
-        return data[0]
+        return users_response(data[0], request)
     else:
-        return data
\ No newline at end of file
+        return users_response(data, request)
\ No newline at end of file
@@ -1,18 +1,22 @@
+import base64
 import requests
 
-from fastapi import APIRouter, Depends, HTTPException, Form, Response
-from typing import Optional, List
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Form, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Awaitable, Callable, Optional, List, Tuple
 from sqlalchemy.orm import Session
 
-from app import get_db, get_current_user, get_settings
-from app.models import User
-from app.schemas import User as UserSchema, UserForm
+from app import get_async_db, get_current_user, get_settings, invalidate_user, search
+from app.database import AsyncSession, SessionLocal, run_db
+from app.models import User, Tweet, TweetJob
+from app.schemas import User as UserSchema, UserForm, TweetPage
 
 router = APIRouter()
 
 
 @router.get("/", response_model=UserSchema)
-async def get_user(session: Session= Depends(get_db),
+async def get_user(db: AsyncSession = Depends(get_async_db),
                    user: User = Depends(get_current_user)
                   ):
     """
@@ -22,23 +26,127 @@ async def get_user(session: Session= Depends(get_db),
     Click **Try it out** and then **Execute**.
     """
     # print(UserSchema.schema_json(indent=2))
+    await db.load(user, "requests_made")
     return user
 
+def encode_cursor(tweet: Tweet)-> str:
+    return base64.urlsafe_b64encode(f"{tweet.created_at.isoformat()}|{tweet.id}".encode()).decode()
+
+def decode_cursor(cursor: str)-> Tuple[datetime, str]:
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), id
+    except ValueError:
+        raise HTTPException(400, detail="That cursor isn't valid, use the 'next cursor' from the previous page")
+
+@router.get("/tweets", response_model=TweetPage)
+async def get_tweet_history(
+                            limit: int = Query(20, ge=1, le=200),
+                            cursor: Optional[str] = Query(None),
+                            db: AsyncSession = Depends(get_async_db),
+                            user: User = Depends(get_current_user)
+                           ):
+    """
+    View the Tweets you've made from here, newest first, _limit_ at a time.  
+    To see the next page, pass the _next cursor_ from this one as the _cursor_.  
+    You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint below  
+    Click **Try it out** and then **Execute**.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    tweets = await db.run(Tweet.history, user.id, limit, after)
+    next_cursor = encode_cursor(tweets[-1]) if len(tweets) == limit else None
+
+    return TweetPage(tweets=tweets, next_cursor=next_cursor)
+
+def encode_search_cursor(score: float, tweet: Tweet)-> str:
+    return base64.urlsafe_b64encode(f"{score!r}|{tweet.id}".encode()).decode()
+
+def decode_search_cursor(cursor: str)-> Tuple[float, str]:
+    try:
+        score, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return float(score), id
+    except ValueError:
+        raise HTTPException(400, detail="That cursor isn't valid, use the 'next cursor' from the previous page")
+
+@router.get("/tweets/search", response_model=TweetPage)
+async def search_tweet_history(
+                               q: str = Query(..., min_length=1, max_length=200, description="Words the Tweets should contain"),
+                               since: Optional[datetime] = Query(None, description="Only Tweets made at or after this time"),
+                               until: Optional[datetime] = Query(None, description="Only Tweets made before this time"),
+                               limit: int = Query(20, ge=1, le=200),
+                               cursor: Optional[str] = Query(None),
+                               db: AsyncSession = Depends(get_async_db),
+                               user: User = Depends(get_current_user)
+                              ):
+    """
+    Search the Tweets you've made from here for every word in _q_, best matches first, _limit_ at a time.  
+    Use _since_ and _until_ to only search some dates.  
+    To see the next page, pass the _next cursor_ from this one as the _cursor_.  
+    You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint below  
+    Click **Try it out** and then **Execute**.
+    """
+    if not search.is_supported(db.session):
+        raise HTTPException(501, detail="Search isn't available on this database")
+
+    after = decode_search_cursor(cursor) if cursor else None
+    results = await db.run(search.search, user.id, q, limit, since, until, after)
+    next_cursor = None
+    if len(results) == limit:
+        last_tweet, last_score = results[-1]
+        next_cursor = encode_search_cursor(last_score, last_tweet)
+
+    return TweetPage(tweets=[tweet for tweet, _ in results], next_cursor=next_cursor)
+
 @router.get("/all", response_model=List[UserSchema], include_in_schema=False)
 async def get_users(
-                    session:Session = Depends(get_db),
+                    db: AsyncSession = Depends(get_async_db),
                     user: User = Depends(get_current_user)
                    )-> UserSchema:
     if not user.is_admin:
         raise HTTPException(403, detail="You do not have permission for this endpoint")
 
-    users:User = session.query(User).all()
+    users:User = await db.run(lambda session: session.query(User).all())
 
     return users
 
+def users_after(last_id: int, limit: int)-> Tuple[int, bytes]:
+    """The next `limit` users after `last_id` as NDJSON, with the id of the last one"""
+    session: Session = SessionLocal()
+    try:
+        users = session.query(User).filter(User.id > last_id).order_by(User.id).limit(limit).all()
+        lines = [UserSchema.from_orm(user).json(by_alias=True) + "\n" for user in users]
+        return (users[-1].id if users else last_id), "".join(lines).encode()
+    finally:
+        session.close()
+
+async def export_users(chunk_size: int,
+                       is_disconnected: Callable[[], Awaitable[bool]]
+                      )-> AsyncIterator[bytes]:
+    """
+    Every user as NDJSON, `chunk_size` users at a time, each chunk read in its own short session.
+    Only one chunk is ever held in memory, and it stops early once the client goes away.
+    """
+    last_id = 0
+    while True:
+        last_id, chunk = await run_db(users_after, last_id, chunk_size)
+        if not chunk or await is_disconnected():
+            return
+        yield chunk
+
+@router.get("/all.ndjson", include_in_schema=False)
+async def export_all_users(
+                           request: Request,
+                           chunk_size: int = Query(1000, ge=1, le=10000),
+                           user: User = Depends(get_current_user)
+                          )-> StreamingResponse:
+    if not user.is_admin:
+        raise HTTPException(403, detail="You do not have permission for this endpoint")
+
+    return StreamingResponse(export_users(chunk_size, request.is_disconnected), media_type="application/x-ndjson")
+
 @router.post("/", response_model=UserSchema)
 async def create_user(form:UserForm = Depends(UserForm), 
-                      session:Session =Depends(get_db)
+                      db: AsyncSession = Depends(get_async_db)
                      ):
     """
     Create an account using your Twitter _username_, _password_ and _full name_.  
@@ -46,9 +154,11 @@ async def create_user(form:UserForm = Depends(UserForm),
     To use Twitter, go to **Twitter Login Step 1** to connect your Twitter, and **Step 2** to verify.  
     Click **Try it out** and then **Execute**.
     """
-    user = User(**form.__dict__)
-    session.add(user)
-    session.commit()
+    user = await run_db(User, **form.__dict__)
+    await user.set_password(form.password)
+    db.add(user)
+    await db.commit()
+    await db.refresh(user)
 
     # url = "http://127.0.0.1:5000"
     # r = requests.post("http://127.0.0.1:8000", data=form.__dict__)
@@ -58,7 +168,7 @@ async def create_user(form:UserForm = Depends(UserForm),
 
 @router.put("/", response_model=UserSchema, response_model_exclude=["tweets"], response_model_exclude_unset=True)
 async def update_user(form: UserForm = Depends(UserForm),
-                    session: Session = Depends(get_db),
+                    db: AsyncSession = Depends(get_async_db),
                     user: User = Depends(get_current_user)
                     ):
     """
@@ -68,37 +178,50 @@ async def update_user(form: UserForm = Depends(UserForm),
     Click **Try it out** and then **Execute**.
     """
     if form.username:
-        user.username = username
+        user.username = form.username
 
-    if full_name:
-        user.full_name = full_name
+    if form.full_name:
+        user.full_name = form.full_name
 
-    if password:
-        same_password = user.verify_password(password)
+    if form.password:
+        same_password = await user.verify_password(form.password)
 
         if same_password:
             raise HTTPException(404, detail="Cannot set current password as new password")
 
-        user.set_password(password)
+        await user.set_password(form.password)
     
-    if not (username or full_name or password):
+    if not (form.username or form.full_name or form.password):
         raise HTTPException(400, detail="Please enter at least one parameter")
     
-    session.commit()
+    public_id = user.public_id
+    await db.commit()
+    await invalidate_user(public_id)
+    await db.refresh(user)
 
     return user
 
 
 @router.delete("/", status_code=204)
 async def delete_user(user: User = Depends(get_current_user),
-                      session:Session = Depends(get_db)
+                      db: AsyncSession = Depends(get_async_db)
                      ):
     """
-    Delete your account.  
+    Delete your account, with your archived Tweets and background jobs.  
     You have to be logged in to use this, click the padlock icon to login, or sign up with the **Create User** endpoint above.  
     Click **Try it out** and then **Execute**.
     """
-    session.delete(user)
-    session.commit()
+    public_id = user.public_id
+    user_id = user.id
+
+    def delete_owned(session: Session):
+        # their foreign keys can't be null, so they go first, in the same transaction
+        session.query(TweetJob).filter(TweetJob.user_id == user_id).delete(synchronize_session=False)
+        session.query(Tweet).filter(Tweet.user_id == user_id).delete(synchronize_session=False)
+
+    await db.run(delete_owned)
+    db.delete(user)
+    await db.commit()
+    await invalidate_user(public_id)
 
     return
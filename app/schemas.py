@@ -1,7 +1,7 @@
 from datetime import datetime
 from fastapi import Form
-from pydantic import BaseModel, Field, root_validator
-from typing import List, Optional
+from pydantic import BaseModel, Field, root_validator, validator
+from typing import Any, Dict, List, Optional
 
 
 class TweetModel(BaseModel):
@@ -19,12 +19,18 @@ class User(BaseModel):
     full_name: Optional[str] = Field(None, example="Color Red", alias="full name", title="full name")
     active: Optional[bool] 
     requests_made: Optional[int] = Field(None, alias="requests made")
-    tweets: Optional[List[TweetModel]]
 
     class Config:
         orm_mode = True
         allow_population_by_field_name = True
 
+class TweetPage(BaseModel):
+    tweets: List[TweetModel]
+    next_cursor: Optional[str] = Field(None, alias="next cursor", description="Pass this as _cursor_ to get the next page")
+
+    class Config:
+        allow_population_by_field_name = True
+
 class UserForm:
 
     def __init__(self,
@@ -73,6 +79,11 @@ class Tweet(BaseModel):
     retweeted: Optional[bool]
     possibly_sensitive: Optional[bool] = Field(None, alias="possibly sensitive")
     lang: str = Field(..., alias="language")
+
+    @validator("place", pre=True)
+    def place_name(cls, place):
+        # Twitter sends the place as an object, only its name is kept
+        return place.get("full_name") if isinstance(place, dict) else place
     # user_mentions: Optional[List[TwitterUser]] = Field(None, alias="users mentioned")
 
     # @root_validator(pre=True)
@@ -93,4 +104,46 @@ class Tweet(BaseModel):
 
 class TwitterLink(BaseModel):
     id: str = Field(..., example=1325888640115937283, format="int64")
-    username: str = Field(..., example="redDevv")
\ No newline at end of file
+    username: str = Field(..., example="redDevv")
+
+class BulkTweets(BaseModel):
+    tweets: List[str] = Field(..., min_items=1, example=["First Tweet", "Second Tweet"])
+    thread: bool = Field(False, description="Post the Tweets as a thread, each one replying to the one before")
+    in_reply_to: Optional[int] = Field(None, alias="id of tweet", description="Start by replying to this Tweet")
+    concurrency: int = Field(4, ge=1, description="How many Tweets to post at once, ignored for threads")
+
+    class Config:
+        allow_population_by_field_name = True
+
+class BulkTweetResult(BaseModel):
+    index: int
+    ok: bool
+    tweet: Optional[Tweet]
+    error: Optional[Any]
+
+class BulkTweetReport(BaseModel):
+    posted: int
+    failed: int
+    archived: bool = Field(..., description="Whether the posted Tweets were saved to your account here")
+    results: List[BulkTweetResult]
+
+class TweetJob(BaseModel):
+    id: str = Field(..., alias="job id")
+    state: str = Field(..., example="queued", description="queued, running, done or failed")
+    attempts: int
+    created_at: datetime = Field(..., alias="created at")
+    finished_at: Optional[datetime] = Field(None, alias="finished at")
+    tweet_id: Optional[str] = Field(None, alias="id of tweet", example=1324131697017933824)
+    error: Optional[str] = None
+
+    class Config:
+        allow_population_by_field_name = True
+        orm_mode = True
+
+class GraphQLQuery(BaseModel):
+    query: str = Field(..., example="{ tweets(ids: [\"1324131697017933824\"]) { text author { username } } }")
+    variables: Optional[Dict[str, Any]] = None
+    operation_name: Optional[str] = Field(None, alias="operationName")
+
+    class Config:
+        allow_population_by_field_name = True
@@ -0,0 +1,130 @@
+"""
+Full-text search over the archived tweets.
+Both indexes are scoped by user, so a search only reads the matches in that user's tweets rather than ranking
+every user's and throwing most of them away.
+SQLite keeps a contentless FTS5 index of text and user_id in tweet_fts, kept in step with the tweet table by
+triggers. Its rowid is the tweet's id as a number, tweet has no rowid of its own that VACUUM can't renumber.
+Postgres uses a GIN index on (user_id, to_tsvector(text)), which needs the btree_gin extension.
+Both are created by `python -m app.migrate`, which also replaces the older indexes over text alone.
+"""
+import re
+
+from datetime import datetime
+from sqlalchemy import Text, and_, cast, func, literal_column, or_, text
+from sqlalchemy.sql import column, table
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from typing import List, Optional, Tuple
+
+from .models import Tweet
+
+# text search configuration on Postgres, has to match the index for it to be used
+TS_CONFIG = literal_column("'english'::regconfig")
+
+tweet_fts = table("tweet_fts", column("rowid"))
+
+# user_id is indexed as a token, searches match it alongside the words.
+# Twitter's ids are numbers, so they can be the rowid, deletes have to repeat what was indexed
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS tweet_fts USING fts5(text, user_id, content='')""",
+    """CREATE TRIGGER IF NOT EXISTS tweet_fts_insert AFTER INSERT ON tweet BEGIN
+        INSERT INTO tweet_fts(rowid, text, user_id) VALUES (CAST(new.id AS INTEGER), new.text, new.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tweet_fts_delete AFTER DELETE ON tweet BEGIN
+        INSERT INTO tweet_fts(tweet_fts, rowid, text, user_id)
+        VALUES ('delete', CAST(old.id AS INTEGER), old.text, old.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tweet_fts_update AFTER UPDATE OF id, text, user_id ON tweet BEGIN
+        INSERT INTO tweet_fts(tweet_fts, rowid, text, user_id)
+        VALUES ('delete', CAST(old.id AS INTEGER), old.text, old.user_id);
+        INSERT INTO tweet_fts(rowid, text, user_id) VALUES (CAST(new.id AS INTEGER), new.text, new.user_id);
+    END""",
+]
+
+SQLITE_FILL = "INSERT INTO tweet_fts(rowid, text, user_id) SELECT CAST(id AS INTEGER), text, user_id FROM tweet"
+
+# older indexes: over text alone, or reading tweet's implicit rowid
+SQLITE_DROP_OLD = [
+    "DROP TRIGGER IF EXISTS tweet_fts_insert",
+    "DROP TRIGGER IF EXISTS tweet_fts_delete",
+    "DROP TRIGGER IF EXISTS tweet_fts_update",
+    "DROP TABLE IF EXISTS tweet_fts",
+]
+
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS btree_gin",
+    """CREATE INDEX IF NOT EXISTS ix_tweet_user_text_fts ON tweet
+        USING gin (user_id, to_tsvector('english'::regconfig, text))""",
+    "DROP INDEX IF EXISTS ix_tweet_text_fts",
+]
+
+
+def create_search_index(engine: Engine):
+    """Creates the full-text index if it's missing, indexing the tweets already archived"""
+    with engine.begin() as connection:
+        if engine.dialect.name == "sqlite":
+            existing = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'tweet_fts'")).scalar()
+            if existing is not None and "content=''" not in existing:
+                for statement in SQLITE_DROP_OLD:
+                    connection.execute(text(statement))
+                existing = None
+            for statement in SQLITE_DDL:
+                connection.execute(text(statement))
+            if existing is None:
+                connection.execute(text(SQLITE_FILL))
+                print("Created full-text index tweet_fts on tweet")
+        elif engine.dialect.name == "postgresql":
+            for statement in POSTGRES_DDL:
+                connection.execute(text(statement))
+
+
+def is_supported(session: Session)-> bool:
+    return session.bind.dialect.name in ("sqlite", "postgresql")
+
+
+def terms(query: str)-> List[str]:
+    return re.findall(r"\w+", query)
+
+
+def search(
+           session: Session,
+           user_id: int,
+           query: str,
+           limit: int,
+           since: Optional[datetime] = None,
+           until: Optional[datetime] = None,
+           after: Optional[Tuple[float, str]] = None
+          )-> List[Tuple[Tweet, float]]:
+    """
+    A user's tweets containing every word of `query`, best match first, with their scores (higher is better).
+    `after` is the (score, id) of the last tweet of the previous page.
+    """
+    words = terms(query)
+    if not words:
+        return []
+
+    if session.bind.dialect.name == "sqlite":
+        # quoted, so anything the user types is matched as plain words and never as FTS5 syntax
+        match = " AND ".join([f'user_id : "{int(user_id)}"'] + ['text : "' + word + '"' for word in words])
+        # bm25 is lower for better matches, user_id is weighted 0 so it doesn't count towards the score
+        score = func.bm25(literal_column("tweet_fts"), 1.0, 0.0) * -1
+        q = (session.query(Tweet, score)
+             .select_from(tweet_fts)
+             .join(Tweet, Tweet.id == cast(tweet_fts.c.rowid, Text))
+             .filter(literal_column("tweet_fts").match(match)))
+    else:
+        vector = func.to_tsvector(TS_CONFIG, Tweet.text)
+        tsquery = func.plainto_tsquery(TS_CONFIG, " ".join(words))
+        score = func.ts_rank(vector, tsquery)
+        q = session.query(Tweet, score).filter(vector.op("@@")(tsquery))
+
+    q = q.filter(Tweet.user_id == user_id)
+    if since is not None:
+        q = q.filter(Tweet.created_at >= since)
+    if until is not None:
+        q = q.filter(Tweet.created_at < until)
+    if after is not None:
+        last_score, last_id = after
+        q = q.filter(or_(score < last_score, and_(score == last_score, Tweet.id < last_id)))
+
+    return q.order_by(score.desc(), Tweet.id.desc()).limit(limit).all()
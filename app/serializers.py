@@ -0,0 +1,154 @@
+"""
+Fast path for sending Twitter's payloads back out.
+Projects a raw tweet or user straight onto the aliased fields of schemas.Tweet / schemas.TwitterUser
+and encodes with orjson, skipping pydantic validation and jsonable_encoder.
+The output is the same as going through the response_model. Anything the projection isn't sure about
+(a missing required field, a value pydantic would have to coerce) falls back to the schema, errors included.
+Given the request, responses get an ETag and gzip, see app.conditional.
+"""
+import orjson
+import time
+
+from fastapi import Request, Response
+from typing import Any, List, Optional, Union
+
+from .conditional import conditional_response
+
+from .metrics import serialization_duration
+from .schemas import Tweet as TweetSchema, TwitterUser
+
+
+class SlowPath(Exception):
+    """The payload needs the schema's validation"""
+
+
+def _str(value: Any) -> str:
+    if type(value) is str:
+        return value
+    if type(value) is int:
+        return str(value)
+    raise SlowPath
+
+
+def _optional_str(value: Any) -> Any:
+    return None if value is None else _str(value)
+
+
+def _int(value: Any) -> int:
+    if type(value) is int:
+        return value
+    raise SlowPath
+
+
+def _optional_int(value: Any) -> Any:
+    return None if value is None else _int(value)
+
+
+def _bool(value: Any) -> bool:
+    if type(value) is bool:
+        return value
+    raise SlowPath
+
+
+def _optional_bool(value: Any) -> Any:
+    return None if value is None else _bool(value)
+
+
+def _place(place: Any) -> Any:
+    # Twitter sends the place as an object, only its name is kept, like schemas.Tweet
+    if isinstance(place, dict):
+        return _optional_str(place.get("full_name"))
+    return _optional_str(place)
+
+
+def project_user(user: dict) -> dict:
+    """`user` as schemas.TwitterUser(**user).dict(by_alias=True) would have it"""
+    if not isinstance(user, dict) or "id" not in user:
+        raise SlowPath
+    get = user.get
+
+    return {"id": _str(user["id"]),
+            "name": _optional_str(get("name")),
+            "username": _optional_str(get("screen_name")),
+            "location": _optional_str(get("location")),
+            "description": _optional_str(get("description")),
+            "protected": _optional_bool(get("protected")),
+            "you follow": _optional_bool(get("following")),
+            "followers": _optional_int(get("followers_count")),
+            "users they follow": _optional_int(get("friends_count")),
+            "favourites": _optional_int(get("favourites_count")),
+            "verified": _optional_bool(get("verified")),
+            "tweets": _optional_int(get("statuses_count")),
+            "created at": _optional_str(get("created_at")),
+            }
+
+
+def project_tweet(tweet: dict) -> dict:
+    """`tweet` as schemas.Tweet(**tweet).dict(by_alias=True) would have it"""
+    if not isinstance(tweet, dict):
+        raise SlowPath
+    get = tweet.get
+
+    try:
+        return {"created at": _str(tweet["created_at"]),
+                "id": _str(tweet["id"]),
+                "text": _str(tweet["text"]),
+                "source": _optional_str(get("source")),
+                "user": project_user(tweet["user"]),
+                "place": _place(get("place")),
+                "tweet is a quote": _bool(tweet["is_quote_status"]),
+                "retweets": _int(tweet["retweet_count"]),
+                "favorites": _int(tweet["favorite_count"]),
+                "favorited": _optional_bool(get("favorited")),
+                "retweeted": _optional_bool(get("retweeted")),
+                "possibly sensitive": _optional_bool(get("possibly_sensitive")),
+                "language": _str(tweet["lang"]),
+                }
+    except KeyError:
+        raise SlowPath
+
+
+def _project_one(item: dict, project, schema) -> dict:
+    try:
+        return project(item)
+    except SlowPath:
+        return schema(**item).dict(by_alias=True)
+
+
+def _project(items: Union[dict, List[dict]], project, schema) -> Any:
+    # only the items the projection isn't sure about go through the schema
+    if isinstance(items, dict):
+        return _project_one(items, project, schema)
+    return [_project_one(item, project, schema) for item in items]
+
+
+def project_tweets(tweets: List[dict]) -> List[dict]:
+    return _project(tweets, project_tweet, TweetSchema)
+
+
+def encode_tweets(tweets: Union[dict, List[dict]]) -> bytes:
+    start = time.perf_counter()
+    body = orjson.dumps(_project(tweets, project_tweet, TweetSchema))
+    serialization_duration.observe(time.perf_counter() - start, "tweets")
+    return body
+
+
+def encode_users(users: Union[dict, List[dict]]) -> bytes:
+    start = time.perf_counter()
+    body = orjson.dumps(_project(users, project_user, TwitterUser))
+    serialization_duration.observe(time.perf_counter() - start, "users")
+    return body
+
+
+def json_response(body: bytes, request: Optional[Request] = None) -> Response:
+    if request is None:
+        return Response(body, media_type="application/json")
+    return conditional_response(request, body)
+
+
+def tweets_response(tweets: Union[dict, List[dict]], request: Optional[Request] = None) -> Response:
+    return json_response(encode_tweets(tweets), request)
+
+
+def users_response(users: Union[dict, List[dict]], request: Optional[Request] = None) -> Response:
+    return json_response(encode_users(users), request)
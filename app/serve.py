@@ -0,0 +1,40 @@
+"""
+Starts uvicorn with WORKERS processes, the Procfile's web process runs `python -m app.serve`.
+
+With more than one worker the auth, status, profile and request profile caches are shared through a file in
+shared memory (see app.sharedcache), made here for this run and removed when the server stops.
+Everything else stays in each worker: request counts are added to the database by whichever worker saw them,
+background tweet jobs are claimed through the database so each is posted once, and /metrics and the
+timeline cache only describe the worker that answers.
+"""
+import argparse
+import os
+
+import uvicorn
+
+from .config import get_settings
+from .sharedcache import default_path, remove
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5000)))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    config = get_settings()
+    path = None
+    if config.WORKERS > 1 and not config.SHARED_CACHE_PATH:
+        # the workers read it from the environment they inherit
+        path = os.environ["SHARED_CACHE_PATH"] = default_path()
+
+    try:
+        uvicorn.run("app.main:app", host=args.host, port=args.port, workers=config.WORKERS, log_level=args.log_level)
+    finally:
+        if path is not None:
+            remove(path)
+
+
+if __name__ == "__main__":
+    main()
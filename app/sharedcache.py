@@ -0,0 +1,301 @@
+"""
+Caches every worker process on the machine shares, for running with WORKERS > 1.
+
+Entries live in a SQLite file in shared memory (/dev/shm where there is one), opened in WAL mode with the
+whole file memory mapped, so a lookup is a read of mapped pages and never waits on a writer.
+There's no copy in each process, so dropping an entry in one worker is seen by every other straight away.
+Values are pickled, the file is only readable and writable by the user running the app.
+Lookups run on the event loop, so they're batched with get_many / set_many where there are many keys, and
+a write waits at most BUSY_TIMEOUT for another worker's. Sets that time out are skipped, it's only a cache,
+but dropping entries can't be, so drops wait up to DROP_TIMEOUT and callers on the event loop run them with
+`run_db` (see `app.invalidate_user`).
+
+`app.serve` picks the file and sets SHARED_CACHE_PATH for its workers, with it unset every cache
+stays a TTLCache in its own process.
+"""
+import hashlib
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, Union
+
+from .cache import TTLCache
+from .config import get_settings
+
+# sets between pruning expired entries and trimming to maxsize
+PRUNE_EVERY = 256
+MMAP_SIZE = 256 * 1024 * 1024
+# seconds a write waits for another worker's, and the wait for the writes that can't be skipped
+BUSY_TIMEOUT = 0.1
+DROP_TIMEOUT = 5.0
+# keys per statement, under SQLite's limit on parameters
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    name TEXT NOT NULL,
+    key BLOB NOT NULL,
+    value BLOB NOT NULL,
+    expires REAL NOT NULL,
+    tag TEXT,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (name, expires);
+CREATE INDEX IF NOT EXISTS ix_cache_tag ON cache (name, tag) WHERE tag IS NOT NULL;
+"""
+
+
+def default_path() -> str:
+    """A new file name in shared memory, or the temp directory without it"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"twitter-client-{os.getpid()}.sqlite")
+
+
+def remove(path: str):
+    for name in (path, path + "-wal", path + "-shm"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def is_busy(error: sqlite3.OperationalError) -> bool:
+    return "locked" in str(error) or "busy" in str(error)
+
+
+class SharedStore:
+    """One connection per process to the file at `path`, opened again in a forked child"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        os.close(fd)
+
+        connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # it's a cache, losing it with the machine is fine
+        connection.execute("PRAGMA synchronous=OFF")
+        connection.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        connection.executescript(SCHEMA)
+        return connection
+
+    def _connected(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            self._connection = self._connect()
+            self._pid = os.getpid()
+        return self._connection
+
+    def execute(self, sql: str, parameters: tuple = (), timeout: float = BUSY_TIMEOUT) -> list:
+        with self._lock:
+            connection = self._connected()
+            if timeout == BUSY_TIMEOUT:
+                return connection.execute(sql, parameters).fetchall()
+
+            connection.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+            try:
+                return connection.execute(sql, parameters).fetchall()
+            finally:
+                connection.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+
+    def executemany(self, sql: str, rows: List[tuple]):
+        """Runs `sql` for every row in one transaction"""
+        with self._lock:
+            connection = self._connected()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(sql, rows)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+
+class SharedCache:
+    """
+    The TTLCache interface over a SharedStore, entries are kept apart by `name`.
+    Once more than `maxsize` are stored, the ones closest to expiring go first rather than the least recently
+    used, so lookups never write. Each worker trims every PRUNE_EVERY sets, so the size can overshoot a little.
+    Hit and miss counts are for this process only.
+    """
+
+    def __init__(self,
+                 store: SharedStore,
+                 name: str,
+                 maxsize: int,
+                 ttl: float,
+                 tag: Optional[Callable[[Any], str]] = None,
+                 ):
+        self.store = store
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tag = tag
+
+        self._sets = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.busy = 0
+
+    @staticmethod
+    def _key(key: Hashable) -> bytes:
+        # hashed so tokens used as keys aren't written down
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        rows = self.store.execute("SELECT value FROM cache WHERE name = ? AND key = ? AND expires > ?",
+                                  (self.name, self._key(key), time.time()))
+        if not rows:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return pickle.loads(rows[0][0])
+
+    def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Any]:
+        """The values found for `keys`, by key, in a statement per BATCH_SIZE keys"""
+        hashed = {self._key(key): key for key in keys}
+        hashes = list(hashed)
+        found = {}
+        now = time.time()
+        for i in range(0, len(hashes), BATCH_SIZE):
+            batch = hashes[i:i + BATCH_SIZE]
+            rows = self.store.execute("SELECT key, value FROM cache WHERE name = ? AND expires > ? "
+                                      f"AND key IN ({','.join('?' * len(batch))})",
+                                      (self.name, now, *batch))
+            found.update((hashed[key], pickle.loads(value)) for key, value in rows)
+
+        self.hits += len(found)
+        self.misses += len(hashed) - len(found)
+        return found
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self.set_many([(key, value)], ttl)
+
+    def set_many(self, items: Iterable[Tuple[Hashable, Any]], ttl: Optional[float] = None):
+        """Sets every item in one transaction, or none of them when another worker's write holds it up"""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        expires = time.time() + ttl
+        rows = [(self.name, self._key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                 expires, self.tag(value) if self.tag else None)
+                for key, value in items]
+        if not rows:
+            return
+
+        try:
+            self.store.executemany("INSERT OR REPLACE INTO cache (name, key, value, expires, tag) "
+                                   "VALUES (?, ?, ?, ?, ?)", rows)
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+            self.busy += 1
+            return
+
+        sets, self._sets = self._sets, self._sets + len(rows)
+        if sets // PRUNE_EVERY != self._sets // PRUNE_EVERY:
+            try:
+                self.prune()
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                self.busy += 1
+
+    def prune(self):
+        """Drops expired entries, then the ones closest to expiring while there are more than maxsize"""
+        self.store.execute("DELETE FROM cache WHERE name = ? AND expires <= ?", (self.name, time.time()))
+        over = len(self) - self.maxsize
+        if over > 0:
+            self.store.execute("DELETE FROM cache WHERE name = ? AND key IN "
+                               "(SELECT key FROM cache WHERE name = ? ORDER BY expires LIMIT ?)",
+                               (self.name, self.name, over))
+            self.evictions += over
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        rows = self.store.execute("SELECT value FROM cache WHERE name = ? AND key = ? AND expires > ?",
+                                  (self.name, self._key(key), time.time()))
+        self.store.execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, self._key(key)),
+                           timeout=DROP_TIMEOUT)
+        return pickle.loads(rows[0][0]) if rows else default
+
+    def discard_tagged(self, tag: str) -> int:
+        rows = self.store.execute("SELECT count(*) FROM cache WHERE name = ? AND tag = ?", (self.name, tag))
+        self.store.execute("DELETE FROM cache WHERE name = ? AND tag = ?", (self.name, tag), timeout=DROP_TIMEOUT)
+        return rows[0][0]
+
+    def discard_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Reads every entry, only the hashed keys are stored so `predicate` gets those"""
+        rows = self.store.execute("SELECT key, value FROM cache WHERE name = ?", (self.name,))
+        keys = [key for key, value in rows if predicate(key, pickle.loads(value))]
+        for key in keys:
+            self.store.execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, key), timeout=DROP_TIMEOUT)
+
+        return len(keys)
+
+    def values(self) -> list:
+        """Values that haven't expired, closest to expiring first, without counting as lookups"""
+        rows = self.store.execute("SELECT value FROM cache WHERE name = ? AND expires > ? ORDER BY expires",
+                                  (self.name, time.time()))
+        return [pickle.loads(value) for value, in rows]
+
+    def clear(self):
+        self.store.execute("DELETE FROM cache WHERE name = ?", (self.name,), timeout=DROP_TIMEOUT)
+
+    def __len__(self) -> int:
+        return self.store.execute("SELECT count(*) FROM cache WHERE name = ?", (self.name,))[0][0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "busy": self.busy,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "shared": self.store.path,
+                }
+
+
+_store: Optional[SharedStore] = None
+
+
+def get_shared_store() -> Optional[SharedStore]:
+    """The store at SHARED_CACHE_PATH, None when it isn't set"""
+    global _store
+    path = get_settings().SHARED_CACHE_PATH
+    if not path:
+        return None
+    if _store is None or _store.path != path:
+        _store = SharedStore(path)
+
+    return _store
+
+
+def shared_or_local(name: str,
+                    maxsize: int,
+                    ttl: float,
+                    tag: Optional[Callable[[Any], str]] = None,
+                    **local,
+                    ) -> Union[SharedCache, TTLCache]:
+    """
+    A SharedCache called `name` when there's a shared store, otherwise a TTLCache.
+    `local` only applies to the TTLCache, like the weight limits.
+    """
+    store = get_shared_store()
+    if store is None:
+        return TTLCache(maxsize, ttl, tag=tag, **local)
+
+    return SharedCache(store, name, maxsize, ttl, tag=tag)
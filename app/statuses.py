@@ -0,0 +1,104 @@
+import asyncio
+
+from typing import Awaitable, Callable, List, Optional
+
+from .client import chunked
+from .config import Settings, get_settings
+from .profiles import shared_profile
+from .sharedcache import shared_or_local
+
+# fields Twitter fills in from the point of view of whoever is asking
+VIEWER_FIELDS = ("favorited", "retweeted", "current_user_retweet")
+
+
+def is_private(tweet: dict) -> bool:
+    """Whether `tweet`, or a tweet it quotes or retweets, is from a protected account only its followers can see"""
+    if isinstance(tweet.get("user"), dict) and tweet["user"].get("protected"):
+        return True
+
+    return any(isinstance(tweet.get(field), dict) and is_private(tweet[field])
+               for field in ("quoted_status", "retweeted_status"))
+
+
+def shared_status(tweet: dict) -> dict:
+    """A copy of `tweet` that's the same whoever looked it up, safe to share between users"""
+    tweet = {key: value for key, value in tweet.items() if key not in VIEWER_FIELDS}
+    if isinstance(tweet.get("user"), dict):
+        tweet["user"] = shared_profile(tweet["user"])
+
+    return tweet
+
+
+class StatusCache:
+    """
+    Tweets looked up by id, shared between every user.
+    Only ids missing from the cache go to Twitter, in concurrent batches of at most LOOKUP_LIMIT.
+    Tweets from protected accounts are never cached, only the followers who looked them up get them.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.statuses = shared_or_local("statuses", maxsize, ttl)
+
+        self.upstream_calls = 0
+        self.naive_calls = 0
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> "StatusCache":
+        return cls(config.STATUS_CACHE_SIZE, config.STATUS_CACHE_TTL)
+
+    async def lookup(self, ids: List[int], fetch: Callable[[List[int], bool], Awaitable[List[dict]]]) -> List[dict]:
+        """
+        The tweets for `ids` in the order asked for, ids Twitter doesn't return are left out.
+        `fetch(batch, shared)` looks up one batch of ids on Twitter, in a call other users can share when `shared`.
+        A shared call may be signed by someone else, so protected tweets in it, and ids missing from it, are
+        looked up again unshared with the caller's own token. Missing ids may be tweets only the caller can see,
+        like those of protected accounts they follow, so that costs a call per batch with deleted tweets in it.
+        """
+        ids = list(dict.fromkeys(ids))
+        cached = self.statuses.get_many(ids)
+        found = {id: cached.get(id) for id in ids}
+        misses = [id for id, tweet in found.items() if tweet is None]
+
+        self.naive_calls += len(chunked(ids))
+        if misses:
+            batches = chunked(misses)
+            self.upstream_calls += len(batches)
+
+            private = set()
+            fetched = {}
+            for tweets in await asyncio.gather(*(fetch(batch, True) for batch in batches)):
+                for tweet in tweets:
+                    if is_private(tweet):
+                        private.add(tweet["id"])
+                        continue
+                    fetched[tweet["id"]] = shared_status(tweet)
+            self.statuses.set_many(fetched.items())
+            found.update(fetched)
+
+            unshared = [id for id in misses if id in private or id not in fetched]
+            if unshared:
+                batches = chunked(unshared)
+                self.upstream_calls += len(batches)
+                for tweets in await asyncio.gather(*(fetch(batch, False) for batch in batches)):
+                    for tweet in tweets:
+                        found[tweet["id"]] = shared_status(tweet)
+
+        return [found[id] for id in ids if found[id] is not None]
+
+    def stats(self) -> dict:
+        stats = self.statuses.stats()
+        stats.update(upstream_calls=self.upstream_calls,
+                     upstream_calls_saved=self.naive_calls - self.upstream_calls,
+                     )
+        return stats
+
+
+_statuses: Optional[StatusCache] = None
+
+
+def get_status_cache() -> StatusCache:
+    global _statuses
+    if _statuses is None:
+        _statuses = StatusCache.from_settings(get_settings())
+
+    return _statuses
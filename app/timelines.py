@@ -0,0 +1,96 @@
+import time
+
+from typing import List, Optional, Tuple
+
+from .cache import TTLCache
+from .config import Settings, get_settings
+
+
+class Timeline:
+    """A user's cached home timeline, newest tweet first"""
+    __slots__ = ("tweets", "fetched_at", "encoded")
+
+    def __init__(self, tweets: List[dict]):
+        self.tweets = tweets
+        self.fetched_at = time.monotonic()
+        # (count, response body for the first `count` tweets) of the last response, a timeline never changes once made
+        self.encoded: Optional[Tuple[int, bytes]] = None
+
+    @property
+    def head_id(self) -> Optional[int]:
+        return self.tweets[0]["id"] if self.tweets else None
+
+
+class TimelineCache:
+    """
+    Per user home timelines.
+    The first load asks Twitter for `window` tweets, after that only for tweets newer than the cached head (since_id).
+    Within `refresh` seconds of the last fetch the cached timeline is served without asking Twitter at all.
+    Whole timelines are evicted least recently used first, once there are `maxsize` of them
+    or `max_tweets` tweets cached across every user.
+    """
+
+    def __init__(self, window: int, refresh: float, maxsize: int, max_tweets: int, ttl: float):
+        self.window = window
+        self.refresh = refresh
+        self.timelines = TTLCache(maxsize, ttl, maxweight=max_tweets, weigh=lambda timeline: len(timeline.tweets))
+
+        self.full_loads = 0
+        self.delta_loads = 0
+        self.delta_tweets = 0
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> "TimelineCache":
+        return cls(config.TIMELINE_WINDOW,
+                   config.TIMELINE_REFRESH_SECONDS,
+                   config.TIMELINE_CACHE_USERS,
+                   config.TIMELINE_CACHE_MAX_TWEETS,
+                   config.TIMELINE_CACHE_TTL,
+                   )
+
+    def get(self, user_id: int) -> Optional[Timeline]:
+        return self.timelines.get(user_id)
+
+    def is_fresh(self, timeline: Optional[Timeline]) -> bool:
+        return timeline is not None and time.monotonic() - timeline.fetched_at < self.refresh
+
+    def since_id(self, timeline: Optional[Timeline]) -> Optional[int]:
+        return timeline.head_id if timeline is not None else None
+
+    def update(self, user_id: int, timeline: Optional[Timeline], new_tweets: List[dict]) -> Timeline:
+        # a full page of new tweets may have skipped some, so it can't be joined to the old ones
+        if timeline is None or len(new_tweets) >= self.window:
+            self.full_loads += 1
+            tweets = new_tweets[:self.window]
+        else:
+            self.delta_loads += 1
+            self.delta_tweets += len(new_tweets)
+            new_ids = {tweet["id"] for tweet in new_tweets}
+            tweets = new_tweets + [tweet for tweet in timeline.tweets if tweet["id"] not in new_ids]
+            tweets = tweets[:self.window]
+
+        timeline = Timeline(tweets)
+        self.timelines.set(user_id, timeline)
+        return timeline
+
+    def invalidate(self, user_id: int):
+        self.timelines.pop(user_id)
+
+    def stats(self) -> dict:
+        stats = self.timelines.stats()
+        stats.update(full_loads=self.full_loads,
+                     delta_loads=self.delta_loads,
+                     delta_tweets=self.delta_tweets,
+                     )
+        return stats
+
+
+_timelines: Optional[TimelineCache] = None
+
+
+def get_timeline_cache() -> TimelineCache:
+    global _timelines
+    if _timelines is None:
+        _timelines = TimelineCache.from_settings(get_settings())
+
+    return _timelines
@@ -0,0 +1,59 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from contextlib import contextmanager
+from typing import List, Optional
+
+# enough settings for the app to import, without a .env
+BENCH_ENV = dict(DATABASE_URI="sqlite://",
+                 SECRET_KEY="benchmark",
+                 API_KEY="benchmark",
+                 API_SECRET="benchmark",
+                 BEARER_TOKEN="benchmark",
+                 )
+
+
+@contextmanager
+def serve(app: str, port: int, env: dict, command: Optional[List[str]] = None):
+    """
+    Runs `app` in a uvicorn subprocess with `env` added to the environment, yields the process once it's listening.
+    `command` starts the server some other way, it has to listen on `port`.
+    """
+    environ = dict(os.environ, **{k: str(v) for k, v in env.items()})
+    process = subprocess.Popen(command or [sys.executable, "-m", "uvicorn", app,
+                                           "--port", str(port), "--log-level", "warning"],
+                               env=environ,
+                               )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{app} did not start")
+                time.sleep(0.05)
+
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@contextmanager
+def fake_twitter(port: int = 8900, latency: float = 0.05, **env):
+    """Runs benchmarks.fake_twitter in a uvicorn subprocess and yields its base url"""
+    with serve("benchmarks.fake_twitter:app", port, dict(env, FAKE_TWITTER_LATENCY=latency)):
+        yield f"http://127.0.0.1:{port}"
+
+
+def bench_settings(twitter_url: str, **overrides):
+    from app.config import Settings
+
+    values = dict(BENCH_ENV, TWITTER_API_URL=twitter_url)
+    values.update(overrides)
+    return Settings(**values)
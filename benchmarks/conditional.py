@@ -0,0 +1,103 @@
+"""
+Bytes and time per poll of get-tweets, get-users and home-timeline, sent whole, gzipped, and revalidated
+with the ETag of the last response. Twitter is benchmarks.fake_twitter, the app runs in-process so the
+times are the app's own, and the caches are warm so Twitter isn't in them.
+
+    python -m benchmarks.conditional --polls 500
+
+Exits with status 1 when a revalidated poll isn't an empty 304, or gzip sends more than --max-gzip-ratio
+of the uncompressed bytes, so it can gate CI.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from . import BENCH_ENV, fake_twitter
+
+PATHS = {"home-timeline": ("/twitter/home-timeline", {"count": 200}),
+         "get-tweets": ("/twitter/get-tweets", {"ids": [1400000000000000000 + i for i in range(100)]}),
+         "get-users": ("/twitter/get-users", {"ids": [1000 + i for i in range(100)]}),
+         }
+
+
+async def poll(client, path: str, params: dict, headers: dict, polls: int):
+    """(bytes on the wire, seconds, status) per poll, and the last response's ETag"""
+    sizes, statuses = [], set()
+    r = None
+    start = time.perf_counter()
+    for _ in range(polls):
+        r = await client.get(path, params=params, headers=headers)
+        await r.aread()
+        sizes.append(r.num_bytes_downloaded)
+        statuses.add(r.status_code)
+    seconds = (time.perf_counter() - start) / polls
+
+    return sum(sizes) / polls, seconds, statuses, r.headers.get("etag")
+
+
+async def run(polls: int) -> dict:
+    import httpx
+
+    from app.client import close_twitter_client, open_twitter_client
+    from app.main import create_app
+    from .load import seed_database
+
+    token, = seed_database(1, 1)
+    auth = {"Authorization": f"Bearer {token}"}
+
+    await open_twitter_client()
+    results = {}
+    try:
+        async with httpx.AsyncClient(app=create_app(), base_url="http://bench") as client:
+            for name, (path, params) in PATHS.items():
+                # fills the caches
+                await client.get(path, params=params, headers=auth)
+
+                whole = await poll(client, path, params, dict(auth, **{"Accept-Encoding": "identity"}), polls)
+                gzipped = await poll(client, path, params, dict(auth, **{"Accept-Encoding": "gzip"}), polls)
+                revalidated = await poll(client, path, params,
+                                         dict(auth, **{"Accept-Encoding": "gzip", "If-None-Match": gzipped[3]}), polls)
+                results[name] = {"whole": whole, "gzip": gzipped, "revalidated": revalidated}
+    finally:
+        await close_twitter_client()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--polls", type=int, default=500)
+    parser.add_argument("--max-gzip-ratio", type=float, default=0.5)
+    parser.add_argument("--twitter-port", type=int, default=8920)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'conditional.db')}"
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    with fake_twitter(args.twitter_port, 0.0) as twitter_url:
+        os.environ["TWITTER_API_URL"] = twitter_url
+        results = asyncio.run(run(args.polls))
+
+    failed = False
+    print(f"{'endpoint':>14} {'mode':>12} {'bytes':>9} {'us':>8} {'status':>7}")
+    for name, modes in results.items():
+        whole_bytes = modes["whole"][0]
+        for mode, (size, seconds, statuses, _) in modes.items():
+            ok = True
+            if mode == "gzip":
+                ok = size <= whole_bytes * args.max_gzip_ratio
+            elif mode == "revalidated":
+                ok = statuses == {304} and size == 0
+            failed = failed or not ok
+            print(f"{name:>14} {mode:>12} {size:>9.0f} {seconds * 1e6:>8.0f} "
+                  f"{','.join(map(str, sorted(statuses))):>7} {'' if ok else 'FAILED'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
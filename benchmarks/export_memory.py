@@ -0,0 +1,80 @@
+"""
+Peak memory of the NDJSON user export as the user table grows.
+Exits with status 1 when the peak at the largest size is more than --tolerance times the peak at the smallest,
+so it can gate CI.
+
+    python -m benchmarks.export_memory --sizes 10000 100000 --tolerance 1.5
+
+Uses a fresh SQLite file unless DATABASE_URI is set.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from uuid import uuid4
+
+from . import BENCH_ENV
+
+BATCH = 50000
+
+
+async def connected() -> bool:
+    return False
+
+
+async def drain(chunk_size: int) -> tuple:
+    from app.routers.users import export_users
+
+    lines = 0
+    tracemalloc.start()
+    async for chunk in export_users(chunk_size, connected):
+        lines += chunk.count(b"\n")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return lines, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args()
+
+    if "DATABASE_URI" not in os.environ:
+        os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'export.db')}"
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    from app import database
+    from app.migrate import migrate
+    from app.models import User
+
+    migrate()
+    peaks = []
+    size = 0
+
+    for target in sorted(args.sizes):
+        for start in range(size, target, BATCH):
+            rows = [dict(username=f"User{i}", password="x", public_id=uuid4().hex.upper(),
+                         full_name=f"User Number {i}", active=True, is_admin=False, requests_made=i)
+                    for i in range(start, min(start + BATCH, target))]
+            with database.engine.begin() as connection:
+                connection.execute(User.__table__.insert(), rows)
+        size = target
+
+        lines, peak = asyncio.run(drain(args.chunk_size))
+        peaks.append(peak)
+        print(f"{size:>9} users: {lines:>9} lines, peak {peak / 1024:10.0f} KiB")
+
+    growth = peaks[-1] / peaks[0]
+    print(f"peak memory grew {growth:.2f}x (tolerance {args.tolerance}x)")
+    sys.exit(0 if growth <= args.tolerance else 1)
+
+
+if __name__ == "__main__":
+    main()
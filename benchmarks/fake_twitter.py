@@ -0,0 +1,172 @@
+"""
+A local stand-in for the parts of api.twitter.com the app calls.
+Run it with `uvicorn benchmarks.fake_twitter:app --port 8900` and point TWITTER_API_URL at it.
+FAKE_TWITTER_LATENCY (seconds) is added to every response.
+Every /1.1/ endpoint sends x-rate-limit-* headers, counting FAKE_TWITTER_RATE_LIMIT calls
+per oauth_token per endpoint in windows of FAKE_TWITTER_RATE_WINDOW seconds, and answers 429 past that.
+FAKE_TWITTER_ERROR_RATE (0 to 1) of /1.1/ and /oauth/ calls get a 503 "Over capacity" instead,
+picked by a random generator seeded with FAKE_TWITTER_SEED so runs are repeatable.
+"""
+import asyncio
+import collections
+import os
+import random
+import re
+import time
+
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from typing import Optional
+
+LATENCY = float(os.environ.get("FAKE_TWITTER_LATENCY", "0.05"))
+RATE_LIMIT = int(os.environ.get("FAKE_TWITTER_RATE_LIMIT", "900"))
+RATE_WINDOW = float(os.environ.get("FAKE_TWITTER_RATE_WINDOW", "900"))
+ERROR_RATE = float(os.environ.get("FAKE_TWITTER_ERROR_RATE", "0"))
+CREATED_AT = "Wed Oct 10 20:19:24 +0000 2018"
+
+app = FastAPI()
+
+# (oauth_token, path) -> [window reset, calls made]
+_windows = {}
+_random = random.Random(int(os.environ.get("FAKE_TWITTER_SEED", "0")))
+
+
+@app.middleware("http")
+async def rate_limit(request: Request, call_next):
+    if not request.url.path.startswith("/1.1/"):
+        return await call_next(request)
+
+    match = re.search(r'oauth_token="([^"]*)"', request.headers.get("authorization", ""))
+    key = (match.group(1) if match else None, request.url.path)
+    now = time.time()
+
+    window = _windows.get(key)
+    if window is None or window[0] <= now:
+        window = _windows[key] = [int(now + RATE_WINDOW), 0]
+    window[1] += 1
+
+    headers = {"x-rate-limit-limit": str(RATE_LIMIT),
+               "x-rate-limit-remaining": str(max(RATE_LIMIT - window[1], 0)),
+               "x-rate-limit-reset": str(window[0]),
+               }
+    if window[1] > RATE_LIMIT:
+        return JSONResponse({"errors": [{"code": 88, "message": "Rate limit exceeded"}]}, 429, headers=headers)
+
+    response = await call_next(request)
+    response.headers.update(headers)
+    return response
+
+
+@app.middleware("http")
+async def errors(request: Request, call_next):
+    if ERROR_RATE and request.url.path.startswith(("/1.1/", "/oauth/")) and _random.random() < ERROR_RATE:
+        await asyncio.sleep(LATENCY)
+        return JSONResponse({"errors": [{"code": 130, "message": "Over capacity"}]}, 503)
+
+    return await call_next(request)
+
+
+_next_id = 1400000000000000000
+# newest first, for statuses/user_timeline.json
+_posted = collections.deque(maxlen=200)
+
+
+def make_user(id: int, screen_name: Optional[str] = None) -> dict:
+    return {"id": id,
+            "id_str": str(id),
+            "name": f"User {id}",
+            "screen_name": screen_name or f"user{id}",
+            "location": "Mars",
+            "description": "A fake Twitter user",
+            "protected": False,
+            "following": False,
+            "followers_count": 100,
+            "friends_count": 100,
+            "favourites_count": 10,
+            "verified": False,
+            "statuses_count": 1000,
+            "created_at": CREATED_AT,
+            }
+
+
+def make_tweet(id: int, text: Optional[str] = None) -> dict:
+    """Every third Tweet replies to the one before it, and each mentions one of 200 users from id 2000"""
+    reply = id % 3 == 0
+    mentioned = 2000 + id % 200
+    return {"created_at": CREATED_AT,
+            "id": id,
+            "id_str": str(id),
+            "text": text or f"This is Tweet {id} from Mars",
+            "source": "fake_twitter",
+            "user": make_user(1000 + id % 50),
+            "place": None,
+            "is_quote_status": False,
+            "retweet_count": 1,
+            "favorite_count": 2,
+            "favorited": False,
+            "retweeted": False,
+            "possibly_sensitive": False,
+            "lang": "en",
+            "in_reply_to_status_id": id - 1 if reply else None,
+            "in_reply_to_user_id": 1000 + (id - 1) % 50 if reply else None,
+            "entities": {"hashtags": [],
+                         "user_mentions": [{"id": mentioned, "id_str": str(mentioned), "screen_name": f"user{mentioned}"}],
+                         "urls": []},
+            }
+
+
+def _split(value: Optional[str]) -> list:
+    return [x for x in value.split(",") if x] if value else []
+
+
+@app.post("/1.1/statuses/update.json")
+async def update(status: str, in_reply_to_status_id: Optional[int] = None):
+    global _next_id
+    await asyncio.sleep(LATENCY)
+    _next_id += 1
+    tweet = make_tweet(_next_id, status)
+    tweet.update(created_at=time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime()),
+                 in_reply_to_status_id=in_reply_to_status_id,
+                 in_reply_to_user_id=None if in_reply_to_status_id is None else 1000 + in_reply_to_status_id % 50)
+    _posted.appendleft(tweet)
+    return tweet
+
+
+@app.get("/1.1/statuses/user_timeline.json")
+async def user_timeline(count: int = 20):
+    await asyncio.sleep(LATENCY)
+    return list(_posted)[:count]
+
+
+@app.get("/1.1/statuses/lookup.json")
+async def lookup(id: str):
+    await asyncio.sleep(LATENCY)
+    return [make_tweet(int(x)) for x in _split(id)]
+
+
+@app.get("/1.1/statuses/home_timeline.json")
+async def home_timeline(count: int = 20, since_id: Optional[int] = None, max_id: Optional[int] = None):
+    await asyncio.sleep(LATENCY)
+    head = max_id if max_id is not None else _next_id
+    floor = since_id if since_id is not None else 0
+    return [make_tweet(id) for id in range(head, max(head - count, floor), -1)]
+
+
+@app.get("/1.1/users/lookup.json")
+async def users_lookup(user_id: Optional[str] = None, screen_name: Optional[str] = None):
+    await asyncio.sleep(LATENCY)
+    users = [make_user(int(x)) for x in _split(user_id)]
+    users += [make_user(abs(hash(x.casefold())) % 10 ** 9, x) for x in _split(screen_name)]
+    return users
+
+
+@app.post("/oauth/request_token", response_class=PlainTextResponse)
+async def request_token():
+    await asyncio.sleep(LATENCY)
+    return "oauth_token=faketoken&oauth_token_secret=fakesecret&oauth_callback_confirmed=true"
+
+
+@app.post("/oauth/access_token", response_class=PlainTextResponse)
+async def access_token(oauth_token: str = Query(...), oauth_verifier: str = Query(...)):
+    await asyncio.sleep(LATENCY)
+    return "oauth_token=1-access&oauth_token_secret=accesssecret&user_id=1001&screen_name=user1001"
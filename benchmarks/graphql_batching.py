@@ -0,0 +1,200 @@
+"""
+Counts the Twitter calls each GraphQL query makes against the fewest it could, with benchmarks.fake_twitter.
+
+    python -m benchmarks.graphql_batching
+
+Each query runs with the status and profile caches emptied, then again straight after with them warm.
+The fewest calls is worked out from the response: every level of the query that refers to tweets or users
+needs the ids it hasn't seen yet, LOOKUP_LIMIT at a time, and users/lookup takes ids and screen names
+together in the same calls. Exits with status 1 when any cold query makes more calls than that, a warm one makes
+any, or a field of the response isn't what fake_twitter sent.
+"""
+import argparse
+import asyncio
+import math
+import os
+import sys
+import tempfile
+import time
+
+from typing import Dict, Iterable, List, Sequence
+
+from . import BENCH_ENV, fake_twitter
+
+FIRST_TWEET = 1400000000000000000
+IDS = [FIRST_TWEET + i for i in range(250)]
+NAMES = [f"named{i}" for i in range(30)]
+
+# fields that hold Tweets and Twitter users, and the values fake_twitter gives every one of them
+TWEET_FIELDS = ("tweets", "inReplyTo", "status")
+USER_FIELDS = ("author", "inReplyToUser", "mentions", "users")
+TWEET_VALUES = {"retweets": 1, "favorites": 2, "language": "en", "isQuote": False}
+USER_VALUES = {"followers": 100, "following": 100, "favourites": 10, "tweetCount": 1000}
+
+
+def calls(ids: Iterable) -> int:
+    from app.client import LOOKUP_LIMIT
+
+    return math.ceil(len(set(ids)) / LOOKUP_LIMIT)
+
+
+def ids(items: List[dict], field: str = "id") -> List[int]:
+    return [int(item[field]) for item in items if item is not None and item.get(field) is not None]
+
+
+def wrong_values(data: dict, names: Sequence[str] = ()) -> List[str]:
+    """Tweets and users in the response whose fields aren't what fake_twitter sent for their id"""
+    from .fake_twitter import make_tweet
+
+    wrong = []
+
+    def check(path: str, item: dict, expected: dict):
+        for field, value in expected.items():
+            if field in item and item[field] != value:
+                wrong.append(f"{path}.{field} is {item[field]!r}, not {value!r}")
+
+    def visit(path: str, value, field: str):
+        if isinstance(value, list):
+            for item in value:
+                visit(path, item, field)
+            return
+        if not isinstance(value, dict):
+            return
+
+        # archived tweets are ours, the Tweet on Twitter is their status
+        if field in TWEET_FIELDS and "status" not in value:
+            check(path, value, dict(TWEET_VALUES, text=make_tweet(int(value["id"]))["text"]))
+        elif field in USER_FIELDS:
+            username = value.get("username")
+            if "username" in value and username not in names and username != f"user{value.get('id')}":
+                wrong.append(f"{path}.username is {username!r}")
+            check(path, value, USER_VALUES)
+
+        for key, child in value.items():
+            visit(f"{path}.{key}", child, key)
+
+    visit("data", data, "data")
+    return wrong
+
+
+def replies_and_mentions(data: dict) -> Dict[str, int]:
+    tweets = data["tweets"]
+    first = set(ids(tweets))
+    replies = set(ids([tweet["inReplyTo"] for tweet in tweets if tweet["inReplyTo"]])) - first
+    users = ids([tweet["inReplyToUser"] for tweet in tweets if tweet["inReplyToUser"]])
+    users += ids([mention for tweet in tweets for mention in tweet["mentions"]])
+    return {"statuses/lookup": calls(first) + calls(replies), "users/lookup": calls(users)}
+
+
+def archive(data: dict) -> Dict[str, int]:
+    statuses = [tweet["status"] for tweet in data["me"]["archive"]["tweets"]]
+    users = ids([mention for status in statuses for mention in status["mentions"]])
+    return {"statuses/lookup": calls(ids(statuses)), "users/lookup": calls(users)}
+
+
+# name -> (query, fewest calls by family for its response)
+CASES: Dict[str, tuple] = {
+    "tweets and authors": (
+        "{ tweets(ids: [%s]) { id text retweets favorites language isQuote author { id username tweetCount } } }"
+        % ",".join(f'"{id}"' for id in IDS),
+        lambda data: {"statuses/lookup": calls(IDS), "users/lookup": 0}),
+    "replies and mentions": (
+        "{ tweets(ids: [%s]) { id inReplyTo { id text author { id username } } inReplyToUser { id username } "
+        "mentions { id username followers } } }" % ",".join(f'"{id}"' for id in IDS),
+        replies_and_mentions),
+    "users by id and name": (
+        "{ users(ids: [%s], usernames: [%s]) { id username followers following favourites tweetCount } }"
+        % (",".join(f'"{2000 + i}"' for i in range(150)), ",".join(f'"{name}"' for name in NAMES)),
+        lambda data: {"statuses/lookup": 0, "users/lookup": calls([2000 + i for i in range(150)] + NAMES)}),
+    "archive": (
+        "{ me { username archive(limit: 150) { tweets { id text status { id text retweets favorites language "
+        "mentions { id username } } } } } }",
+        archive),
+}
+
+
+def upstream_calls() -> Dict[str, int]:
+    from app.metrics import twitter_request_duration
+
+    counts: Dict[str, int] = {}
+    for (family, _, _), (buckets, _) in list(twitter_request_duration.values.items()):
+        counts[family] = counts.get(family, 0) + sum(buckets)
+    return counts
+
+
+async def run() -> dict:
+    import httpx
+
+    from app.client import close_twitter_client, open_twitter_client
+    from app.main import create_app
+    from app.profiles import get_profile_cache
+    from app.statuses import get_status_cache
+    from .load import seed_database
+
+    token, = seed_database(1, 300)
+    auth = {"Authorization": f"Bearer {token}"}
+
+    await open_twitter_client()
+    results = {}
+    try:
+        async with httpx.AsyncClient(app=create_app(), base_url="http://bench", timeout=60) as client:
+            for name, (query, fewest) in CASES.items():
+                get_status_cache().statuses.clear()
+                get_profile_cache().profiles.clear()
+                get_profile_cache().names.clear()
+
+                runs = []
+                for _ in ("cold", "warm"):
+                    before = upstream_calls()
+                    start = time.perf_counter()
+                    r = await client.post("/graphql", json={"query": query}, headers=auth)
+                    seconds = time.perf_counter() - start
+                    after = upstream_calls()
+                    body = r.json()
+                    if r.status_code != 200 or body.get("errors"):
+                        raise RuntimeError(f"{name}: {r.status_code} {body.get('errors')}")
+                    made = {family: after.get(family, 0) - before.get(family, 0)
+                            for family in ("statuses/lookup", "users/lookup")}
+                    runs.append((made, seconds))
+
+                results[name] = {"cold": runs[0], "warm": runs[1], "fewest": fewest(body["data"]),
+                                 "wrong": wrong_values(body["data"], NAMES)}
+    finally:
+        await close_twitter_client()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.01, help="fake Twitter latency, seconds")
+    parser.add_argument("--twitter-port", type=int, default=8930)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'graphql.db')}"
+    os.environ["METRICS_ENABLED"] = "true"
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    with fake_twitter(args.twitter_port, args.latency, FAKE_TWITTER_RATE_LIMIT=10 ** 9) as twitter_url:
+        os.environ["TWITTER_API_URL"] = twitter_url
+        results = asyncio.run(run())
+
+    failed = False
+    print(f"{'query':>22} {'family':>16} {'cold':>5} {'fewest':>7} {'warm':>5} {'cold ms':>8} {'warm ms':>8}")
+    for name, result in results.items():
+        (cold, cold_seconds), (warm, warm_seconds) = result["cold"], result["warm"]
+        for family, fewest in result["fewest"].items():
+            ok = cold[family] <= fewest and warm[family] == 0
+            failed = failed or not ok
+            print(f"{name:>22} {family:>16} {cold[family]:>5} {fewest:>7} {warm[family]:>5} "
+                  f"{cold_seconds * 1000:>8.1f} {warm_seconds * 1000:>8.1f} {'' if ok else 'TOO MANY'}")
+        if result["wrong"]:
+            failed = True
+            print(f"{name:>22} {len(result['wrong'])} wrong values, like {'; '.join(result['wrong'][:3])}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
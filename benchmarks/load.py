@@ -0,0 +1,239 @@
+"""
+Load scenarios against the app, reporting p50/p95/p99 latency, throughput, errors and server memory per endpoint.
+The app runs under uvicorn with Twitter replaced by benchmarks.fake_twitter, on a fresh SQLite file
+unless DATABASE_URI is set.
+
+    python -m benchmarks.load --save benchmarks/baselines/load.json
+    python -m benchmarks.load --compare benchmarks/baselines/load.json --tolerance 0.25
+
+--compare prints each scenario's throughput, p95, peak memory and errors next to the baseline's. It exits
+with status 1 when any scenario's p95 or peak memory grew, or its throughput fell, by more than --tolerance,
+or its error rate grew by more than a percentage point.
+Baselines only mean something on the machine and settings they were made with.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Tuple
+
+from . import BENCH_ENV, fake_twitter, serve
+
+FIRST_TWEET = 1400000000000000000
+
+# name -> (method, path, params for the i-th request)
+SCENARIOS: Dict[str, Tuple[str, str, Callable[[int, random.Random], dict]]] = {
+    "get_user": ("GET", "/users/", lambda i, rng: {}),
+    "tweet_history": ("GET", "/users/tweets", lambda i, rng: {"limit": 20}),
+    "make_tweet": ("GET", "/twitter/make-tweet", lambda i, rng: {"tweet": f"Load test Tweet {i}"}),
+    "get_tweets": ("GET", "/twitter/get-tweets",
+                   lambda i, rng: {"ids": [FIRST_TWEET + rng.randrange(2000) for _ in range(3)]}),
+    "get_users": ("GET", "/twitter/get-users",
+                  lambda i, rng: {"ids": [1000 + rng.randrange(500) for _ in range(3)], "usernames": [f"user{rng.randrange(500)}"]}),
+    "home_timeline": ("GET", "/twitter/home-timeline", lambda i, rng: {"count": 50}),
+    "twitter_login": ("GET", "/twitter/login", lambda i, rng: {}),
+}
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def rss_mib(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def seed_database(users: int, tweets: int) -> List[str]:
+    """Creates active users with Twitter tokens and some archived tweets, returns an access token per user"""
+    from datetime import datetime, timedelta
+
+    from app import create_access_token, database
+    from app.migrate import migrate
+    from app.models import Tweet, User
+
+    migrate()
+    public_ids = [f"{i:032X}" for i in range(users)]
+    with database.engine.begin() as connection:
+        connection.execute(User.__table__.insert(),
+                           [dict(username=f"Load{i}", password="x", public_id=public_id, active=True, is_admin=False,
+                                 requests_made=0, token=f"token{i}", token_secret=f"secret{i}")
+                            for i, public_id in enumerate(public_ids)])
+        ids = [id for id, in connection.execute(User.__table__.select().with_only_columns([User.id]))]
+        start = datetime(2020, 1, 1)
+        connection.execute(Tweet.__table__.insert(),
+                           [dict(id=str(FIRST_TWEET - i), text=f"Archived Tweet {i}",
+                                 created_at=start + timedelta(minutes=i), user_id=ids[i % len(ids)])
+                            for i in range(tweets)])
+
+    return [create_access_token({"sub": public_id}, timedelta(days=1)) for public_id in public_ids]
+
+
+async def run_scenario(base_url: str, pid: int, name: str, tokens: List[str], total: int, concurrency: int, warmup: int) -> dict:
+    import httpx
+
+    method, path, make_params = SCENARIOS[name]
+    rng = random.Random(name)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+
+        async def one(i: int) -> Tuple[float, int]:
+            headers = {"Authorization": f"Bearer {tokens[i % len(tokens)]}"}
+            start = time.perf_counter()
+            r = await client.request(method, path, params=make_params(i, rng), headers=headers)
+            await r.aread()
+            return time.perf_counter() - start, r.status_code
+
+        async def run(count: int, offset: int) -> List[Tuple[float, int]]:
+            slots = asyncio.Semaphore(concurrency)
+
+            async def limited(i: int):
+                async with slots:
+                    return await one(i)
+
+            return await asyncio.gather(*(limited(offset + i) for i in range(count)))
+
+        await run(warmup, 0)
+
+        before = rss_mib(pid)
+        peak = before
+        sampling = True
+
+        async def sample():
+            nonlocal peak
+            while sampling:
+                peak = max(peak, rss_mib(pid))
+                await asyncio.sleep(0.05)
+
+        sampler = asyncio.ensure_future(sample())
+        start = time.perf_counter()
+        results = await run(total, warmup)
+        elapsed = time.perf_counter() - start
+        sampling = False
+        await sampler
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status >= 400)
+    return {"requests": total,
+            "concurrency": concurrency,
+            "throughput": total / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "mean_ms": statistics.mean(latencies) * 1000,
+            "error_rate": errors / total,
+            "rss_before_mib": before,
+            "rss_peak_mib": max(peak, rss_mib(pid)),
+            }
+
+
+def change(before: float, after: float) -> str:
+    return f"{(after - before) / before:+.0%}" if before else "n/a"
+
+
+def print_diff(results: Dict[str, dict], baseline: Dict[str, dict]):
+    print(f"{'scenario':>14} {'req/s':>16} {'p95 ms':>18} {'rss MiB':>14} {'errors':>15}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:>14} not in the baseline")
+            continue
+        before = baseline[name]
+        print(f"{name:>14} {before['throughput']:>5.0f} -> {result['throughput']:<5.0f}{change(before['throughput'], result['throughput']):>5}"
+              f" {before['p95_ms']:>6.1f} -> {result['p95_ms']:<6.1f}{change(before['p95_ms'], result['p95_ms']):>5}"
+              f" {before['rss_peak_mib']:>3.0f} -> {result['rss_peak_mib']:<3.0f}{change(before['rss_peak_mib'], result['rss_peak_mib']):>5}"
+              f" {before['error_rate']:>5.1%} -> {result['error_rate']:<5.1%}")
+
+
+def regressions(name: str, result: dict, baseline: dict, tolerance: float) -> List[str]:
+    found = []
+    if result["p95_ms"] > baseline["p95_ms"] * (1 + tolerance):
+        found.append(f"{name}: p95 {baseline['p95_ms']:.1f}ms -> {result['p95_ms']:.1f}ms")
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        found.append(f"{name}: throughput {baseline['throughput']:.0f}/s -> {result['throughput']:.0f}/s")
+    if result["rss_peak_mib"] > baseline["rss_peak_mib"] * (1 + tolerance):
+        found.append(f"{name}: peak memory {baseline['rss_peak_mib']:.0f}MiB -> {result['rss_peak_mib']:.0f}MiB")
+    if result["error_rate"] > baseline["error_rate"] + 0.01:
+        found.append(f"{name}: errors {baseline['error_rate']:.1%} -> {result['error_rate']:.1%}")
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--tweets", type=int, default=10000, help="archived tweets to seed")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Twitter latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake Twitter 503s, 0 to 1")
+    parser.add_argument("--rate-limit", type=int, default=900, help="fake Twitter calls per token per endpoint")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--twitter-port", type=int, default=8900)
+    parser.add_argument("--save", metavar="BASELINE")
+    parser.add_argument("--compare", metavar="BASELINE")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if "DATABASE_URI" not in os.environ:
+        os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load.db')}"
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    tokens = seed_database(args.users, args.tweets)
+    settings = dict(requests=args.requests, concurrency=args.concurrency, warmup=args.warmup, users=args.users,
+                    latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit)
+    results = {}
+
+    with fake_twitter(args.twitter_port, args.latency,
+                      FAKE_TWITTER_ERROR_RATE=args.error_rate, FAKE_TWITTER_RATE_LIMIT=args.rate_limit) as twitter_url:
+        env = {key: os.environ[key] for key in BENCH_ENV}
+        with serve("app.main:app", args.port, dict(env, TWITTER_API_URL=twitter_url)) as server:
+            base_url = f"http://127.0.0.1:{args.port}"
+
+            print(f"{'scenario':>14} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'rss MiB':>8}")
+            for name in args.scenarios:
+                result = asyncio.run(run_scenario(base_url, server.pid, name, tokens,
+                                                  args.requests, args.concurrency, args.warmup))
+                results[name] = result
+                print(f"{name:>14} {result['throughput']:>8.0f} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} "
+                      f"{result['p99_ms']:>8.1f} {result['error_rate']:>7.1%} {result['rss_peak_mib']:>8.0f}")
+
+    report = {"settings": settings, "python": platform.python_version(), "machine": platform.node(), "scenarios": results}
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as baseline:
+            json.dump(report, baseline, indent=2)
+        print(f"saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            baseline = json.load(baseline)
+        if baseline["settings"] != settings:
+            print(f"warning: baseline was made with {baseline['settings']}")
+
+        print_diff(results, baseline["scenarios"])
+        found = []
+        for name, result in results.items():
+            if name in baseline["scenarios"]:
+                found += regressions(name, result, baseline["scenarios"][name], args.tolerance)
+
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        print(f"{len(found)} regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Cost of the /metrics instrumentation per request, checked against a budget.
+Exits with status 1 when instrumented requests are more than --budget percent slower, so it can gate CI.
+
+    python -m benchmarks.metrics_overhead --requests 3000 --budget 5
+
+Each mode runs in a fresh interpreter, with METRICS_ENABLED on or off, calling the app in-process
+so only the app's own time is measured. `convert-link` is the cheapest route there is, `get-user` adds
+authentication and a database query.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from . import BENCH_ENV
+
+SNIPPET = """
+import asyncio, sys, time
+import httpx
+from app import create_access_token, database
+from app.migrate import migrate
+from app.models import User
+
+migrate()
+with database.engine.begin() as connection:
+    connection.execute(User.__table__.insert(), [dict(username="Bench", password="x", public_id="BENCH", active=True)])
+
+from app.main import create_app
+headers = {"Authorization": "Bearer " + create_access_token({"sub": "BENCH"})}
+paths = {"convert-link": "/twitter/convert-link-to-id?link=https://twitter.com/redDevv/status/1324131697017933824",
+         "get-user": "/users/"}
+
+async def run(total):
+    async with httpx.AsyncClient(app=create_app(), base_url="http://bench") as client:
+        for name, path in paths.items():
+            for _ in range(100):
+                await client.get(path, headers=headers)
+            best = float("inf")
+            for _ in range(3):
+                start = time.perf_counter()
+                for _ in range(total):
+                    await client.get(path, headers=headers)
+                best = min(best, (time.perf_counter() - start) / total)
+            print("per request:", name, best)
+
+asyncio.run(run(int(sys.argv[1])))
+"""
+
+
+def per_request(enabled: bool, total: int) -> dict:
+    env = dict(os.environ, **BENCH_ENV)
+    env.update(METRICS_ENABLED=str(enabled).lower(),
+               DATABASE_URI=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'metrics.db')}")
+    output = subprocess.run([sys.executable, "-c", SNIPPET, str(total)], env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    times = {}
+    for line in output.splitlines():
+        if line.startswith("per request:"):
+            _, name, seconds = line.rsplit(" ", 2)
+            times[name] = float(seconds)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--budget", type=float, default=5.0, help="percent")
+    args = parser.parse_args()
+
+    off = per_request(False, args.requests)
+    on = per_request(True, args.requests)
+
+    over_budget = False
+    print(f"{'route':>14} {'off us':>9} {'on us':>9} {'overhead':>9}")
+    for name in off:
+        overhead = (on[name] - off[name]) / off[name] * 100
+        ok = overhead <= args.budget
+        over_budget = over_budget or not ok
+        print(f"{name:>14} {off[name] * 1e6:>9.1f} {on[name] * 1e6:>9.1f} {overhead:>8.1f}% {'ok' if ok else 'OVER BUDGET'}")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Serializing timelines the old way (response_model validation, jsonable_encoder, json) against the
+orjson fast path in app.serializers, checking both give the same JSON.
+
+    python -m benchmarks.serialization --tweets 20 200 --fixture recorded_timeline.json
+
+A fixture is a JSON list of tweets as statuses/home_timeline.json returned them, each is timed at the first
+--tweets of its tweets. The default is fixtures/home_timeline.json, an anonymised timeline of 200 with retweets,
+quotes, media and places. Each fixture is also timed "coerced", with the counts of every tenth tweet sent as
+strings, which the projection leaves to the schema, so the fallback path is measured too.
+--fake adds timelines built by benchmarks.fake_twitter.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+from . import BENCH_ENV
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "home_timeline.json")
+
+
+def coerced(tweets: list) -> list:
+    """`tweets` with the counts of every tenth one as strings, which only the schema accepts"""
+    return [dict(tweet, retweet_count=str(tweet["retweet_count"]), favorite_count=str(tweet["favorite_count"]))
+            if i % 10 == 0 else tweet
+            for i, tweet in enumerate(tweets)]
+
+
+def old_path(tweets: list) -> bytes:
+    from fastapi.encoders import jsonable_encoder
+    from app.schemas import Tweet
+
+    validated = [Tweet(**tweet) for tweet in tweets]
+    content = jsonable_encoder(validated, by_alias=True)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def new_path(tweets: list) -> bytes:
+    from app.serializers import tweets_response
+
+    return tweets_response(tweets).body
+
+
+def fallbacks(tweets: list) -> int:
+    """How many of `tweets` the fast path hands to the schema"""
+    from app.serializers import SlowPath, project_tweet
+
+    count = 0
+    for tweet in tweets:
+        try:
+            project_tweet(tweet)
+        except SlowPath:
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tweets", type=int, nargs="+", default=[20, 200])
+    parser.add_argument("--fixture", action="append", default=None, help=f"default {FIXTURE}")
+    parser.add_argument("--fake", action="store_true", help="also time timelines from benchmarks.fake_twitter")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    timelines = {}
+    for path in args.fixture or [FIXTURE]:
+        with open(path) as fixture:
+            recorded = json.load(fixture)
+        name = os.path.basename(path)
+        for count in args.tweets:
+            timelines[f"{name} x{min(count, len(recorded))}"] = recorded[:count]
+        timelines[f"{name} coerced x{len(recorded)}"] = coerced(recorded)
+
+    if args.fake:
+        from .fake_twitter import make_tweet
+
+        for count in args.tweets:
+            timelines[f"fake x{count}"] = [make_tweet(1400000000000000000 + i) for i in range(count)]
+
+    mismatched = False
+    print(f"{'timeline':>32} {'fallback':>9} {'old ms':>9} {'new ms':>9} {'speedup':>8}")
+    for name, tweets in timelines.items():
+        try:
+            same = json.loads(old_path(tweets)) == json.loads(new_path(tweets))
+        except ValueError as e:
+            same = False
+            print(f"{name:>32} {e!r}")
+        if not same:
+            mismatched = True
+            print(f"{name:>32} OUTPUT MISMATCH")
+            continue
+
+        number = max(1, 2000 // len(tweets))
+        old = min(timeit.repeat(lambda: old_path(tweets), number=number, repeat=args.repeat)) / number
+        new = min(timeit.repeat(lambda: new_path(tweets), number=number, repeat=args.repeat)) / number
+        print(f"{name:>32} {fallbacks(tweets):>9} {old * 1000:>9.3f} {new * 1000:>9.3f} {old / new:>7.1f}x")
+
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()
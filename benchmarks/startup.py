@@ -0,0 +1,67 @@
+"""
+Import and startup time of the app, checked against a budget.
+Exits with status 1 when either is over budget so it can gate CI.
+
+    python -m benchmarks.startup --import-budget 1.5 --startup-budget 0.25
+
+Import time is the best of --runs fresh interpreters running `import app.main`.
+Startup time covers create_app() and its startup and shutdown handlers.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+from . import BENCH_ENV
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import app.main
+print(time.perf_counter() - start)
+"""
+
+STARTUP_SNIPPET = """
+import asyncio, time
+import app.main
+start = time.perf_counter()
+application = app.main.create_app()
+async def cycle():
+    await application.router.startup()
+    await application.router.shutdown()
+asyncio.run(cycle())
+print(time.perf_counter() - start)
+"""
+
+
+def best_of(snippet: str, runs: int) -> float:
+    env = dict(os.environ, **BENCH_ENV)
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", snippet], env=env, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--import-budget", type=float, default=1.5, help="seconds")
+    parser.add_argument("--startup-budget", type=float, default=0.25, help="seconds")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    over_budget = False
+    for name, snippet, budget in (("import", IMPORT_SNIPPET, args.import_budget),
+                                  ("startup", STARTUP_SNIPPET, args.startup_budget)):
+        elapsed = best_of(snippet, args.runs)
+        ok = elapsed <= budget
+        over_budget = over_budget or not ok
+        print(f"{name:>8}: {elapsed * 1000:8.1f}ms (budget {budget * 1000:.0f}ms) {'ok' if ok else 'OVER BUDGET'}")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Latency of full-text search over the tweet archive as it grows.
+Rare words should stay at a few milliseconds, common words cost more since every match in the user's
+tweets is ranked. The indexes are scoped by user, so that grows with one user's tweets rather than everyone's.
+
+    python -m benchmarks.tweet_search --sizes 1000000 2000000 --users 1000
+
+Uses a fresh SQLite file unless DATABASE_URI is set. Tweets are random words from a vocabulary
+where a few words are common and most are rare, like real text.
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+from . import BENCH_ENV
+
+BATCH = 50000
+VOCABULARY = [f"word{i}" for i in range(20000)]
+# zipf-ish, word0 is in most tweets and word19999 in almost none
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+START = datetime(2020, 1, 1)
+
+
+def make_text(rng: random.Random) -> str:
+    return " ".join(rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=12))
+
+
+def timed(session, queries) -> tuple:
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        query(session)
+        times.append(time.perf_counter() - start)
+        session.expunge_all()
+
+    times.sort()
+    return statistics.median(times) * 1000, times[int(len(times) * 0.95)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000000, 2000000])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--searches", type=int, default=200)
+    args = parser.parse_args()
+
+    if "DATABASE_URI" not in os.environ:
+        os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'search.db')}"
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    from app import database, search
+    from app.migrate import migrate
+    from app.models import Tweet, User
+
+    migrate()
+    rng = random.Random(0)
+    with database.engine.begin() as connection:
+        connection.execute(User.__table__.insert(),
+                           [dict(username=f"User{i}", password="x", public_id=f"{i:032X}", active=True, is_admin=False)
+                            for i in range(args.users)])
+    user_ids = [row[0] for row in database.engine.execute(User.__table__.select().with_only_columns([User.id]))]
+    size = 0
+
+    print(f"{'tweets':>9} {'search':>22} {'p50 ms':>9} {'p95 ms':>9}")
+    for target in sorted(args.sizes):
+        for start in range(size, target, BATCH):
+            rows = [dict(id=str(i), text=make_text(rng), created_at=START + timedelta(minutes=i),
+                         user_id=user_ids[i % len(user_ids)])
+                    for i in range(start, min(start + BATCH, target))]
+            with database.engine.begin() as connection:
+                connection.execute(Tweet.__table__.insert(), rows)
+        size = target
+
+        def searches(words, **filters):
+            return [lambda s, user_id=rng.choice(user_ids), word=rng.choice(words):
+                    search.search(s, user_id, word, 20, **filters) for _ in range(args.searches)]
+
+        end = START + timedelta(minutes=size)
+        cases = {
+            "rare word": searches(VOCABULARY[5000:]),
+            "uncommon word": searches(VOCABULARY[100:1000]),
+            "common word": searches(VOCABULARY[:10]),
+            "two words": searches([f"{a} {b}" for a, b in zip(VOCABULARY[10:100], VOCABULARY[100:190])]),
+            "rare word, last 10%": searches(VOCABULARY[5000:], since=end - (end - START) / 10),
+        }
+
+        session = database.SessionLocal()
+        for name, queries in cases.items():
+            p50, p95 = timed(session, queries)
+            print(f"{size:>9} {name:>22} {p50:>9.2f} {p95:>9.2f}")
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Throughput of the old blocking `requests` calls against the pooled TwitterClient.
+Both run inside one event loop, the way they do inside a uvicorn worker.
+
+    python -m benchmarks.upstream_client --requests 500 --concurrency 50 --latency 0.05
+"""
+import argparse
+import asyncio
+import time
+
+import requests
+
+from requests_oauthlib import OAuth1
+
+from app.client import OAuth1Auth, TwitterClient
+from . import bench_settings, fake_twitter
+
+PATH = "/1.1/statuses/lookup.json"
+
+
+async def run_blocking(url: str, total: int, concurrency: int) -> float:
+    auth = OAuth1("benchmark", "benchmark", "token", "secret")
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with slots:
+            # what every handler did before: a fresh connection that blocks the loop
+            r = requests.get(url + PATH, params={"id": i}, auth=auth)
+            r.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return time.perf_counter() - start
+
+
+async def run_pooled(url: str, total: int, concurrency: int) -> float:
+    twitter = TwitterClient(bench_settings(url))
+    auth = OAuth1Auth("benchmark", "benchmark", "token", "secret")
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with slots:
+            r = await twitter.get(PATH, params={"id": i}, auth=auth)
+            r.raise_for_status()
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        return time.perf_counter() - start
+    finally:
+        await twitter.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=8900)
+    args = parser.parse_args()
+
+    with fake_twitter(args.port, args.latency) as url:
+        for name, run in (("blocking requests", run_blocking), ("pooled httpx", run_pooled)):
+            elapsed = asyncio.run(run(url, args.requests, args.concurrency))
+            print(f"{name:>18}: {args.requests / elapsed:8.1f} req/s ({elapsed:.2f}s for {args.requests})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Latency of the auth (public_id) and login (username) lookups as the user table grows.
+Both should stay flat, they're served by ix_user_public_id and ix_user_username_lower.
+
+    python -m benchmarks.user_lookup --sizes 1000 10000 100000 1000000 --ilike
+
+Uses a fresh SQLite file unless DATABASE_URI is set. --ilike also times the old ILIKE queries.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from uuid import uuid4
+
+from . import BENCH_ENV
+
+BATCH = 50000
+
+
+def timed(session, queries) -> tuple:
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        query(session)
+        times.append(time.perf_counter() - start)
+        session.expunge_all()
+
+    times.sort()
+    return statistics.median(times) * 1e6, times[int(len(times) * 0.95)] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--ilike", action="store_true")
+    args = parser.parse_args()
+
+    if "DATABASE_URI" not in os.environ:
+        os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'users.db')}"
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    from app import database
+    from app.migrate import migrate
+    from app.models import User
+
+    migrate()
+    public_ids = []
+    size = 0
+
+    print(f"{'users':>9} {'query':>18} {'p50 us':>9} {'p95 us':>9}")
+    for target in sorted(args.sizes):
+        for start in range(size, target, BATCH):
+            rows = [dict(username=f"User{i}", password="x", public_id=uuid4().hex.upper(),
+                         active=True, is_admin=False, requests_made=0)
+                    for i in range(start, min(start + BATCH, target))]
+            public_ids.extend(row["public_id"] for row in rows)
+            with database.engine.begin() as connection:
+                connection.execute(User.__table__.insert(), rows)
+        size = target
+
+        picks = random.sample(range(size), min(args.lookups, size))
+        cases = {
+            "public_id ==": [lambda s, i=i: s.query(User).filter(User.public_id == public_ids[i]).one() for i in picks],
+            "lower(username) ==": [lambda s, i=i: s.query(User).filter(User.username_is(f"user{i}")).one() for i in picks],
+        }
+        if args.ilike:
+            cases.update({
+                "public_id ilike": [lambda s, i=i: s.query(User).filter(User.public_id.ilike(public_ids[i])).one() for i in picks],
+                "username ilike": [lambda s, i=i: s.query(User).filter(User.username.ilike(f"user{i}")).one() for i in picks],
+            })
+
+        session = database.SessionLocal()
+        for name, queries in cases.items():
+            p50, p95 = timed(session, queries)
+            print(f"{size:>9} {name:>18} {p50:>9.0f} {p95:>9.0f}")
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Throughput of `python -m app.serve` as WORKERS goes up, with the caches shared between workers.
+Each worker count gets a fresh server on the same seeded database, load comes from --clients processes
+so the load generator isn't the bottleneck, and Twitter is benchmarks.fake_twitter.
+
+    python -m benchmarks.worker_scaling --workers 1 2 4 --scenarios get_user get_tweets
+
+Speedup is against the first worker count, efficiency is speedup per added worker. With --min-efficiency
+it exits with status 1 when any count falls below it, which only makes sense on a machine with that many
+free cores (this one has {cores}). --save writes the results and the machine's core count as JSON, results
+from several cores are in benchmarks/baselines/.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+
+from typing import List
+
+from . import BENCH_ENV, fake_twitter, serve
+from .load import SCENARIOS, run_scenario, seed_database
+
+
+def client(base_url: str, pid: int, name: str, tokens: List[str], total: int, concurrency: int, warmup: int) -> float:
+    return asyncio.run(run_scenario(base_url, pid, name, tokens, total, concurrency, warmup))["throughput"]
+
+
+def throughput(pool, base_url: str, pid: int, name: str, tokens: List[str], args) -> float:
+    """Requests a second across every client, each running its share at the same time"""
+    share = [(base_url, pid, name, tokens, args.requests // args.clients, max(args.concurrency // args.clients, 1),
+              args.warmup)] * args.clients
+    return sum(pool.starmap(client, share))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.format(cores=os.cpu_count()),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=["get_user", "get_tweets"])
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--warmup", type=int, default=50, help="per client")
+    parser.add_argument("--clients", type=int, default=max((os.cpu_count() or 1) // 2, 1))
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.01, help="fake Twitter latency, seconds")
+    parser.add_argument("--port", type=int, default=8911)
+    parser.add_argument("--twitter-port", type=int, default=8910)
+    parser.add_argument("--min-efficiency", type=float)
+    parser.add_argument("--save", metavar="RESULTS")
+    args = parser.parse_args()
+
+    if "DATABASE_URI" not in os.environ:
+        os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'scaling.db')}"
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    tokens = seed_database(args.users, 1000)
+    results = {name: {} for name in args.scenarios}
+
+    with fake_twitter(args.twitter_port, args.latency, FAKE_TWITTER_RATE_LIMIT=10 ** 9) as twitter_url, \
+            multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+        env = {key: os.environ[key] for key in BENCH_ENV}
+        command = [sys.executable, "-m", "app.serve", "--host", "127.0.0.1", "--port", str(args.port),
+                   "--log-level", "warning"]
+
+        for workers in args.workers:
+            with serve("app.main:app", args.port, dict(env, TWITTER_API_URL=twitter_url, WORKERS=workers),
+                       command) as server:
+                for name in args.scenarios:
+                    results[name][workers] = throughput(pool, f"http://127.0.0.1:{args.port}", server.pid, name,
+                                                        tokens, args)
+
+    if args.save:
+        report = {"cores": os.cpu_count(), "python": platform.python_version(), "machine": platform.node(),
+                  "settings": dict(requests=args.requests, concurrency=args.concurrency, clients=args.clients,
+                                   users=args.users, latency=args.latency),
+                  "throughput": results}
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as out:
+            json.dump(report, out, indent=2)
+        print(f"saved results to {args.save}")
+
+    below = False
+    print(f"{'scenario':>12} {'workers':>8} {'req/s':>8} {'speedup':>8} {'efficiency':>11}")
+    for name, by_workers in results.items():
+        first = args.workers[0]
+        for workers, rate in by_workers.items():
+            speedup = rate / by_workers[first]
+            efficiency = speedup / (workers / first)
+            ok = args.min_efficiency is None or efficiency >= args.min_efficiency
+            below = below or not ok
+            print(f"{name:>12} {workers:>8} {rate:>8.0f} {speedup:>7.2f}x {efficiency:>10.0%} {'' if ok else 'BELOW'}")
+
+    sys.exit(1 if below else 0)
+
+
+if __name__ == "__main__":
+    main()